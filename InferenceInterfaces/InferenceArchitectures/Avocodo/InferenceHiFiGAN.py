@@ -68,9 +68,15 @@ class HiFiGANGeneratorAvocodo(torch.nn.Module):
         self.load_state_dict(torch.load(path_to_weights, map_location='cpu')["generator"])
 
     def forward(self, c, normalize_before=False):
+        """
+        c is either a single spectrogram (in_channels, T) or a padded batch of spectrograms (B, in_channels, T)
+        """
         if normalize_before:
             c = (c - self.mean) / self.scale
-        c = self.input_conv(c.unsqueeze(0))
+        is_batch = c.dim() == 3
+        if not is_batch:
+            c = c.unsqueeze(0)
+        c = self.input_conv(c)
         for i in range(self.num_upsamples):
             c = self.upsamples[i](c)
             cs = 0.0  # initialize
@@ -78,6 +84,8 @@ class HiFiGANGeneratorAvocodo(torch.nn.Module):
                 cs = cs + self.blocks[i * self.num_blocks + j](c)
             c = cs / self.num_blocks
         c = self.output_conv(c)
+        if is_batch:
+            return c.squeeze(1)
         return c.squeeze()
 
     def remove_weight_norm(self):
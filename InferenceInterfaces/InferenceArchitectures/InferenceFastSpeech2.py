@@ -1,6 +1,7 @@
 from abc import ABC
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
 from Layers.Conformer import Conformer
 from Layers.DurationPredictor import DurationPredictor
@@ -9,7 +10,9 @@ from Layers.PostNet import PostNet
 from Layers.VariancePredictor import VariancePredictor
 from Utility.utils import make_non_pad_mask
 from Utility.utils import make_pad_mask
+from Layers.Conformer_accent_mha import ACCENT_EMBEDDING_DIR
 from Layers.Conformer_accent_mha import Conformer_accent_mha # Added
+from Layers.Conformer_accent_mha import load_state_dict_tolerating_missing_accent_weights
 
 
 
@@ -73,7 +76,8 @@ class FastSpeech2(torch.nn.Module, ABC):
                  # additional features
                  utt_embed_dim=704,
                  connect_utt_emb_at_encoder_out=True,
-                 lang_embs=100):
+                 lang_embs=100,
+                 accent_embeddings=ACCENT_EMBEDDING_DIR):
         super().__init__()
         self.idim = idim
         self.odim = odim
@@ -83,6 +87,9 @@ class FastSpeech2(torch.nn.Module, ABC):
         self.use_scaled_pos_enc = use_scaled_pos_enc
         self.multilingual_model = lang_embs is not None
         self.multispeaker_model = utt_embed_dim is not None
+        if "decoder.accent_emb" in weights:
+            # the checkpoint brings its own accent embeddings, so the directory they were loaded from is not needed
+            accent_embeddings = weights["decoder.accent_emb"]
 
         embed = torch.nn.Sequential(torch.nn.Linear(idim, 100),
                                     torch.nn.Tanh(),
@@ -131,7 +138,8 @@ class FastSpeech2(torch.nn.Module, ABC):
                                  positionwise_conv_kernel_size=positionwise_conv_kernel_size,
                                  macaron_style=use_macaron_style_in_conformer,
                                  use_cnn_module=use_cnn_in_conformer,
-                                 cnn_module_kernel=conformer_dec_kernel_size)
+                                 cnn_module_kernel=conformer_dec_kernel_size,
+                                 accent_embeddings=accent_embeddings)
         self.feat_out = torch.nn.Linear(adim, odim * reduction_factor)
         self.postnet = PostNet(idim=idim,
                                odim=odim,
@@ -140,7 +148,7 @@ class FastSpeech2(torch.nn.Module, ABC):
                                n_filts=postnet_filts,
                                use_batch_norm=use_batch_norm,
                                dropout_rate=postnet_dropout_rate)
-        self.load_state_dict(weights)
+        load_state_dict_tolerating_missing_accent_weights(self, weights)
 
     def _forward(self, text_tensors, text_lens, gold_speech=None, speech_lens=None,
                  gold_durations=None, gold_pitch=None, gold_energy=None,
@@ -187,7 +195,11 @@ class FastSpeech2(torch.nn.Module, ABC):
             pitch_embeddings = self.pitch_embed(pitch_predictions.transpose(1, 2)).transpose(1, 2)
             energy_embeddings = self.energy_embed(energy_predictions.transpose(1, 2)).transpose(1, 2)
             encoded_texts = encoded_texts + energy_embeddings + pitch_embeddings
-            encoded_texts = self.length_regulator(encoded_texts, duration_predictions, duration_scaling_factor)
+            expanded_durations = self.length_regulator.expand_durations(duration_predictions, duration_scaling_factor, duration_masks)
+            encoded_texts = self.length_regulator(encoded_texts, expanded_durations)
+            if encoded_texts.size(0) > 1:
+                # in a padded batch the decoder and the postnet must not see the frames of the padded tail
+                speech_lens = expanded_durations.sum(dim=1)
         else:
             duration_predictions = self.duration_predictor(encoded_texts, duration_masks)
 
@@ -201,7 +213,7 @@ class FastSpeech2(torch.nn.Module, ABC):
             encoded_texts = self.length_regulator(encoded_texts, gold_durations)  # (B, Lmax, adim)
 
         # forward decoder
-        if speech_lens is not None and not is_inference:
+        if speech_lens is not None:
             if self.reduction_factor > 1:
                 olens_in = speech_lens.new([olen // self.reduction_factor for olen in speech_lens])
             else:
@@ -213,7 +225,13 @@ class FastSpeech2(torch.nn.Module, ABC):
         before_outs = self.feat_out(zs).view(zs.size(0), -1, self.odim)  # (B, Lmax, odim)
 
         # postnet -> (B, Lmax//r * r, odim)
-        after_outs = before_outs + self.postnet(before_outs.transpose(1, 2)).transpose(1, 2)
+        if speech_lens is not None:
+            speech_pad_masks = make_pad_mask(speech_lens, device=before_outs.device)
+            before_outs = before_outs.masked_fill(speech_pad_masks.unsqueeze(-1), 0.0)
+            after_outs = before_outs + self.postnet(before_outs.transpose(1, 2), speech_pad_masks).transpose(1, 2)
+            after_outs = after_outs.masked_fill(speech_pad_masks.unsqueeze(-1), 0.0)
+        else:
+            after_outs = before_outs + self.postnet(before_outs.transpose(1, 2)).transpose(1, 2)
 
         return before_outs, after_outs, duration_predictions, pitch_predictions, energy_predictions
 
@@ -289,6 +307,51 @@ class FastSpeech2(torch.nn.Module, ABC):
             return after_outs[0], d_outs[0], pitch_predictions[0], energy_predictions[0]
         return after_outs[0]
 
+    @torch.no_grad()
+    def batch_inference(self,
+                        texts,
+                        utterance_embedding,
+                        lang_emb=None,
+                        duration_scaling_factor=1.0,
+                        pitch_variance_scale=1.0,
+                        energy_variance_scale=1.0):
+        """
+        Generate the spectrograms for a list of vectorized phoneme sequences in a single padded batch.
+
+        Args:
+            texts: list of input sequences of vectorized phonemes, each of shape (T_i, idim)
+            utterance_embedding: embedding of speaker information, shared by all sequences (utt_embed_dim) or one per sequence (B, utt_embed_dim)
+            lang_emb: language embedding, shared by all sequences or one per sequence
+            duration_scaling_factor: see forward
+            pitch_variance_scale: see forward
+            energy_variance_scale: see forward
+
+        Returns:
+            padded batch of mel spectrograms (B, Lmax, odim) which is zero beyond the valid frames, the amount of valid frames per spectrogram (B,)
+            and the predicted durations (B, Tmax)
+
+        """
+        self.eval()
+        device = texts[0].device
+        ilens = torch.tensor([text.shape[0] for text in texts], dtype=torch.long, device=device)
+        text_tensors = pad_sequence(texts, batch_first=True)
+        if utterance_embedding is not None and utterance_embedding.dim() == 1:
+            utterance_embedding = utterance_embedding.unsqueeze(0).expand(len(texts), -1)
+        if lang_emb is not None and lang_emb.dim() == 1:
+            lang_emb = lang_emb.unsqueeze(0).expand(len(texts), -1)
+
+        _, after_outs, d_outs, _, _ = self._forward(text_tensors,
+                                                    ilens,
+                                                    is_inference=True,
+                                                    utterance_embedding=utterance_embedding,
+                                                    lang_embs=lang_emb,
+                                                    duration_scaling_factor=duration_scaling_factor,
+                                                    pitch_variance_scale=pitch_variance_scale,
+                                                    energy_variance_scale=energy_variance_scale)
+        self.train()
+        mel_lengths = self.length_regulator.expand_durations(d_outs, duration_scaling_factor, make_pad_mask(ilens, device=device)).sum(dim=1)
+        return after_outs, mel_lengths, d_outs
+
     def _source_mask(self, ilens):
         x_masks = make_non_pad_mask(ilens).to(next(self.parameters()).device)
         return x_masks.unsqueeze(-2)
@@ -297,8 +360,12 @@ class FastSpeech2(torch.nn.Module, ABC):
 def _scale_variance(sequence, scale):
     if scale == 1.0:
         return sequence
-    average = sequence[0][sequence[0] != 0.0].mean()
-    sequence = sequence - average  # center sequence around 0
-    sequence = sequence * scale  # scale the variance
-    sequence = sequence + average  # move center back to original with changed variance
-    return sequence
+    scaled_sequences = list()
+    for single_sequence in sequence:  # every element of a batch has its own center
+        average = single_sequence[single_sequence != 0.0].mean()
+        single_sequence = single_sequence - average  # center sequence around 0
+        single_sequence = single_sequence * scale  # scale the variance
+        single_sequence = single_sequence + average  # move center back to original with changed variance
+        scaled_sequences.append(single_sequence)
+    return torch.stack(scaled_sequences)
+
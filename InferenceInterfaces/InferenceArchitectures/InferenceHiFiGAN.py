@@ -1,3 +1,5 @@
+import math
+
 import torch
 
 from Layers.ResidualBlock import HiFiGANResidualBlock as ResidualBlock
@@ -26,6 +28,13 @@ class HiFiGANGenerator(torch.nn.Module):
         assert len(resblock_dilations) == len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_kernel_sizes)
         self.num_blocks = len(resblock_kernel_sizes)
+        self.hop_length = math.prod(upsample_scales)
+        self.receptive_field_frames = _receptive_field_in_frames(kernel_size=kernel_size,
+                                                                 upsample_scales=upsample_scales,
+                                                                 upsample_kernel_sizes=upsample_kernel_sizes,
+                                                                 resblock_kernel_sizes=resblock_kernel_sizes,
+                                                                 resblock_dilations=resblock_dilations,
+                                                                 use_additional_convs=use_additional_convs)
         self.input_conv = torch.nn.Conv1d(in_channels,
                                           channels,
                                           kernel_size,
@@ -62,9 +71,15 @@ class HiFiGANGenerator(torch.nn.Module):
         self.load_state_dict(torch.load(path_to_weights, map_location='cpu')["generator"])
 
     def forward(self, c, normalize_before=False):
+        """
+        c is either a single spectrogram (in_channels, T) or a padded batch of spectrograms (B, in_channels, T)
+        """
         if normalize_before:
             c = (c - self.mean) / self.scale
-        c = self.input_conv(c.unsqueeze(0))
+        is_batch = c.dim() == 3
+        if not is_batch:
+            c = c.unsqueeze(0)
+        c = self.input_conv(c)
         for i in range(self.num_upsamples):
             c = self.upsamples[i](c)
             cs = 0.0  # initialize
@@ -72,8 +87,44 @@ class HiFiGANGenerator(torch.nn.Module):
                 cs = cs + self.blocks[i * self.num_blocks + j](c)
             c = cs / self.num_blocks
         c = self.output_conv(c)
+        if is_batch:
+            return c.squeeze(1)
         return c.squeeze(0).squeeze(0)
 
+    def stream(self, c, chunk_frames=100, overlap_frames=4):
+        """
+        Vocodes a spectrogram (in_channels, T) in overlapping windows and yields the waveform block by block,
+        so the first audio is available after one window and the memory does not grow with the length of the input.
+
+        Every window is extended by the receptive field of the generator on both sides, so apart from the
+        crossfaded overlap the concatenated blocks match what forward produces for the whole spectrogram.
+
+        Args:
+            c: spectrogram to be vocoded
+            chunk_frames: how many spectrogram frames are turned into waveform per block
+            overlap_frames: how many frames consecutive blocks share to be crossfaded
+        """
+        total_frames = c.size(1)
+        previous_tail = None
+        for start in range(0, total_frames, chunk_frames):
+            end = min(start + chunk_frames, total_frames)
+            end_with_overlap = min(end + overlap_frames, total_frames)
+            window_start = max(0, start - self.receptive_field_frames)
+            window_end = min(total_frames, end_with_overlap + self.receptive_field_frames)
+            # inference mode must not be active while the generator is suspended, it would leak into the caller
+            with torch.inference_mode():
+                wave = self(c[:, window_start:window_end])
+                wave = wave[(start - window_start) * self.hop_length:(end_with_overlap - window_start) * self.hop_length]
+                if previous_tail is not None:
+                    fade_in = torch.linspace(0.0, 1.0, previous_tail.size(0), device=wave.device)
+                    wave[:previous_tail.size(0)] = previous_tail * (1.0 - fade_in) + wave[:previous_tail.size(0)] * fade_in
+                    previous_tail = None
+                overlap_samples = (end_with_overlap - end) * self.hop_length
+                if overlap_samples > 0:
+                    previous_tail = wave[-overlap_samples:]
+                    wave = wave[:-overlap_samples]
+            yield wave
+
     def remove_weight_norm(self):
         def _remove_weight_norm(m):
             try:
@@ -89,3 +140,25 @@ class HiFiGANGenerator(torch.nn.Module):
                 torch.nn.utils.weight_norm(m)
 
         self.apply(_apply_weight_norm)
+
+
+def _receptive_field_in_frames(kernel_size, upsample_scales, upsample_kernel_sizes, resblock_kernel_sizes, resblock_dilations, use_additional_convs):
+    """
+    How many input frames on each side influence an output sample of the generator, rounded up.
+    """
+    context = (kernel_size - 1) // 2  # input conv, measured in frames
+    samples_per_frame = 1
+    for upsample_scale, upsample_kernel_size in zip(upsample_scales, upsample_kernel_sizes):
+        context += math.ceil(upsample_kernel_size / upsample_scale / 2)
+        samples_per_frame *= upsample_scale
+        block_contexts = list()
+        for resblock_kernel_size, dilations in zip(resblock_kernel_sizes, resblock_dilations):
+            block_context = 0
+            for dilation in dilations:
+                block_context += (resblock_kernel_size - 1) // 2 * dilation
+                if use_additional_convs:
+                    block_context += (resblock_kernel_size - 1) // 2
+            block_contexts.append(block_context)
+        context += math.ceil(max(block_contexts) / samples_per_frame)
+    context += math.ceil(((kernel_size - 1) // 2) / samples_per_frame)  # output conv
+    return context
@@ -1,5 +1,7 @@
 import itertools
 import os
+import queue
+import threading
 
 import librosa.display as lbd
 import matplotlib.pyplot as plt
@@ -11,10 +13,11 @@ import torch
 from InferenceInterfaces.InferenceArchitectures.InferenceFastSpeech2 import FastSpeech2
 from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import HiFiGANGenerator
 from InferenceInterfaces.InferenceArchitectures.Avocodo.InferenceHiFiGAN import HiFiGANGeneratorAvocodo
-from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
+from Preprocessing.ConditionCache import get_condition_cache
 from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
 from Preprocessing.TextFrontend import get_language_id
 from Preprocessing.Language_embedding import LanguageEmbedding
+from Preprocessing.LanguageEmbeddingTable import get_language_embedding_table
 
 class InferenceFastSpeech2(torch.nn.Module):
 
@@ -42,6 +45,7 @@ class InferenceFastSpeech2(torch.nn.Module):
             self.mel2wav = HiFiGANGeneratorAvocodo(path_to_weights=os.path.join("Models", "Avocodo", "best.pt")).to(torch.device(device))
         self.default_utterance_embedding = checkpoint["default_emb"].to(self.device)
         self.lang_emb = None
+        self.input_is_phones = False
         self.phone2mel.eval()
         self.mel2wav.eval()
         if self.use_lang_id:
@@ -56,15 +60,15 @@ class InferenceFastSpeech2(torch.nn.Module):
 
 
     def set_utterance_embedding(self, path_to_reference_audio):
-        wave, sr = soundfile.read(path_to_reference_audio)
-        self.default_utterance_embedding = ProsodicConditionExtractor(sr=sr).extract_condition_from_reference_wave(wave).to(self.device)
+        self.default_utterance_embedding = get_condition_cache().get(path_to_reference_audio).to(self.device)
         if self.noise_reduce:
             self.update_noise_profile()
 
     def set_language_embedding(self, path_to_reference_audio, use_avg=True):
         # select between {at_emb, vd_emb, ivg_emb, goi_emb, interp_at_vd_emb, spanish_emb, fr_emb }
         if use_avg == True:
-            self.default_lang_emb = torch.from_numpy(torch.load(path_to_reference_audio)).to(self.device) # reference audio is actually a .pt file, that is averaged
+            # reference audio is actually a .pt file that is averaged (or just the name of one in the table, e.g. at), the files are only loaded once
+            self.default_lang_emb = get_language_embedding_table().embedding_of(path_to_reference_audio).view(1, 1, -1).to(self.device)
             print("default_lang_emb: " + str(path_to_reference_audio))
         else:
             emb = LanguageEmbedding()
@@ -119,21 +123,15 @@ class InferenceFastSpeech2(torch.nn.Module):
         #emb = LanguageEmbedding()
 
         with torch.inference_mode():
-            phones = self.text2phone.string_to_tensor(text, input_phonemes=self.input_is_phones, path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/hpo_vd_wean_0002.wav").to(torch.device(self.device))
+            phones = self._text_to_phones(text)
             #print(self.default_lang_emb)
-            mel, durations, pitch, energy = self.phone2mel(phones,
-                                                           return_duration_pitch_energy=True,
-                                                           utterance_embedding=self.default_utterance_embedding,
-                                                           durations=durations,
-                                                           pitch=pitch,
-                                                           energy=energy,
-                                                           #lang_emb=emb.get_emb_from_path(path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/hpo_vd_wean_0002.wav"),
-                                                           #lang_emb=emb.get_emb_from_path(path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/spo_at_berlin_001.wav"),
-                                                           lang_emb=self.default_lang_emb.squeeze(0),
-                                                           duration_scaling_factor=duration_scaling_factor,
-                                                           pitch_variance_scale=pitch_variance_scale,
-                                                           energy_variance_scale=energy_variance_scale)
-            mel = mel.transpose(0, 1)
+            mel, durations, pitch, energy = self._phones_to_mel(phones,
+                                                                durations=durations,
+                                                                pitch=pitch,
+                                                                energy=energy,
+                                                                duration_scaling_factor=duration_scaling_factor,
+                                                                pitch_variance_scale=pitch_variance_scale,
+                                                                energy_variance_scale=energy_variance_scale)
             wave = self.mel2wav(mel)
         if view:
             from Utility.utils import cumsum_durations
@@ -156,10 +154,111 @@ class InferenceFastSpeech2(torch.nn.Module):
             ax[0].set_title(text)
             plt.subplots_adjust(left=0.05, bottom=0.1, right=0.95, top=.9, wspace=0.0, hspace=0.0)
             plt.show()
+        return self._reduce_noise(wave)
+
+    def _text_to_phones(self, text):
+        return self.text2phone.string_to_tensor(text, input_phonemes=self.input_is_phones, path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/hpo_vd_wean_0002.wav").to(torch.device(self.device))
+
+    def _phones_to_mel(self,
+                       phones,
+                       durations=None,
+                       pitch=None,
+                       energy=None,
+                       duration_scaling_factor=1.0,
+                       pitch_variance_scale=1.0,
+                       energy_variance_scale=1.0):
+        """
+        returns the spectrogram as (80, T) together with the durations, pitch and energy that were used
+        """
+        mel, durations, pitch, energy = self.phone2mel(phones,
+                                                       return_duration_pitch_energy=True,
+                                                       utterance_embedding=self.default_utterance_embedding,
+                                                       durations=durations,
+                                                       pitch=pitch,
+                                                       energy=energy,
+                                                       #lang_emb=emb.get_emb_from_path(path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/hpo_vd_wean_0002.wav"),
+                                                       #lang_emb=emb.get_emb_from_path(path_to_wavfile="/data/vokquant/data/aridialect/aridialect_wav16000/spo_at_berlin_001.wav"),
+                                                       lang_emb=self.default_lang_emb.squeeze(0),
+                                                       duration_scaling_factor=duration_scaling_factor,
+                                                       pitch_variance_scale=pitch_variance_scale,
+                                                       energy_variance_scale=energy_variance_scale)
+        return mel.transpose(0, 1), durations, pitch, energy
+
+    def _vocode_blocks(self, mel, chunk_frames=None, overlap_frames=4):
+        """
+        yields the waveform of a spectrogram, in blocks of chunk_frames frames if the vocoder supports streaming.
+        The noise reduction gates each signal it gets on its own, so on blocks it would leave seams at their
+        boundaries. With noise_reduce the whole spectrogram is therefore vocoded and denoised in one piece.
+        """
+        if chunk_frames is not None and hasattr(self.mel2wav, "stream") and not self.noise_reduce:
+            for wave in self.mel2wav.stream(mel, chunk_frames=chunk_frames, overlap_frames=overlap_frames):
+                yield self._reduce_noise(wave)
+        else:
+            with torch.inference_mode():
+                wave = self.mel2wav(mel)
+            yield self._reduce_noise(wave)
+
+    def _reduce_noise(self, wave):
         if self.noise_reduce:
-            wave = torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
+            return torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
         return wave
 
+    def stream(self,
+               text,
+               chunk_frames=100,
+               overlap_frames=4,
+               duration_scaling_factor=1.0,
+               pitch_variance_scale=1.0,
+               energy_variance_scale=1.0):
+        """
+        Synthesizes the spectrogram of a text and yields the waveform in blocks while it is being vocoded,
+        so the time until the first audio is available does not depend on the length of the text.
+
+        Args:
+            text: the string to be read
+            chunk_frames: how many spectrogram frames are vocoded per block, with noise_reduce the whole utterance is a single block
+            overlap_frames: how many frames consecutive blocks share to be crossfaded
+            duration_scaling_factor: see forward
+            pitch_variance_scale: see forward
+            energy_variance_scale: see forward
+        """
+        with torch.inference_mode():
+            mel, *_ = self._phones_to_mel(self._text_to_phones(text),
+                                          duration_scaling_factor=duration_scaling_factor,
+                                          pitch_variance_scale=pitch_variance_scale,
+                                          energy_variance_scale=energy_variance_scale)
+        yield from self._vocode_blocks(mel, chunk_frames=chunk_frames, overlap_frames=overlap_frames)
+
+    def synthesize_batch(self,
+                         texts,
+                         duration_scaling_factor=1.0,
+                         pitch_variance_scale=1.0,
+                         energy_variance_scale=1.0):
+        """
+        Synthesizes a list of texts with one padded pass through FastSpeech2, which saves a lot of the per sentence overhead
+        when reading long texts on the CPU. The vocoder gets every spectrogram on its own and only up to its length, because
+        the padded tail would leak into the last samples through its convolutions.
+
+        Args:
+            texts: A list of strings to be read
+            duration_scaling_factor: see forward
+            pitch_variance_scale: see forward
+            energy_variance_scale: see forward
+
+        Returns:
+            a list of waves, one for each text
+        """
+        with torch.inference_mode():
+            phones = [self._text_to_phones(text) for text in texts]
+            mels, mel_lengths, _ = self.phone2mel.batch_inference(phones,
+                                                                  utterance_embedding=self.default_utterance_embedding,
+                                                                  lang_emb=self.default_lang_emb.squeeze(0),
+                                                                  duration_scaling_factor=duration_scaling_factor,
+                                                                  pitch_variance_scale=pitch_variance_scale,
+                                                                  energy_variance_scale=energy_variance_scale)
+            waves = [self.mel2wav(mel[:int(mel_length)].transpose(0, 1)) for mel, mel_length in zip(mels, mel_lengths)]
+        return [self._reduce_noise(wave) for wave in waves]
+
     def read_to_file(self,
                      text_list,
                      file_location,
@@ -169,8 +268,13 @@ class InferenceFastSpeech2(torch.nn.Module):
                      silent=False,
                      dur_list=None,
                      pitch_list=None,
-                     energy_list=None):
+                     energy_list=None,
+                     batch_size=1,
+                     stream_chunk_frames=None):
         """
+        The texts go through a pipeline: the next sentence is phonemized and the previous one is vocoded
+        while the current one goes through FastSpeech2, and the audio is appended to the file as soon as it is ready.
+
         Args:
             silent: Whether to be verbose about the process
             text_list: A list of strings to be read
@@ -187,44 +291,98 @@ class InferenceFastSpeech2(torch.nn.Module):
             energy_variance_scale: reasonable values are 0.6 < scale < 1.4.
                                    1.0 means no scaling happens, higher values increase variance of the energy curve,
                                    lower values decrease variance of the energy curve.
+            batch_size: how many sentences are synthesized together, only possible if no durations, pitch or energy are given
+            stream_chunk_frames: if set, the vocoder works on blocks of this many frames which are written to the file as soon as
+                                 they are ready. Ignored with noise_reduce, which needs the whole utterance
         """
+        silence = torch.zeros([24000]).numpy()
+        if batch_size > 1 and not dur_list and not pitch_list and not energy_list:
+            text_list = [text for text in text_list if text.strip() != ""]
+            with soundfile.SoundFile(file_location, mode="w", samplerate=48000, channels=1) as output_file:
+                for batch_start in range(0, len(text_list), batch_size):
+                    if not silent:
+                        for text in text_list[batch_start:batch_start + batch_size]:
+                            print("Now synthesizing: {}".format(text))
+                    for wave in self.synthesize_batch(text_list[batch_start:batch_start + batch_size],
+                                                      duration_scaling_factor=duration_scaling_factor,
+                                                      pitch_variance_scale=pitch_variance_scale,
+                                                      energy_variance_scale=energy_variance_scale):
+                        output_file.write(wave.cpu().numpy())
+                        output_file.write(silence)
+            return
         if not dur_list:
             dur_list = []
         if not pitch_list:
             pitch_list = []
         if not energy_list:
             energy_list = []
-        wav = None
-        silence = torch.zeros([24000])
-        for (text, durations, pitch, energy) in itertools.zip_longest(text_list, dur_list, pitch_list, energy_list):
-            if text.strip() != "":
-                if not silent:
-                    print("Now synthesizing: {}".format(text))
-                if wav is None:
-                    if durations is not None:
-                        durations = durations.to(self.device)
-                    if pitch is not None:
-                        pitch = pitch.to(self.device)
-                    if energy is not None:
-                        energy = energy.to(self.device)
-                    wav = self(text,
-                               durations=durations,
-                               pitch=pitch,
-                               energy=energy,
-                               duration_scaling_factor=duration_scaling_factor,
-                               pitch_variance_scale=pitch_variance_scale,
-                               energy_variance_scale=energy_variance_scale).cpu()
-                    wav = torch.cat((wav, silence), 0)
-                else:
-                    wav = torch.cat((wav, self(text,
-                                               durations=durations.to(self.device),
-                                               pitch=pitch.to(self.device),
-                                               energy=energy.to(self.device),
-                                               duration_scaling_factor=duration_scaling_factor,
-                                               pitch_variance_scale=pitch_variance_scale,
-                                               energy_variance_scale=energy_variance_scale).cpu()), 0)
-                    wav = torch.cat((wav, silence), 0)
-        soundfile.write(file=file_location, data=wav.cpu().numpy(), samplerate=48000)
+        jobs = [job for job in itertools.zip_longest(text_list, dur_list, pitch_list, energy_list) if job[0].strip() != ""]
+        phone_queue = queue.Queue(maxsize=2)
+        mel_queue = queue.Queue(maxsize=2)
+        errors = list()
+        with soundfile.SoundFile(file_location, mode="w", samplerate=48000, channels=1) as output_file:
+            phonemizer_thread = threading.Thread(target=self._phonemizer_worker, args=(jobs, phone_queue, errors), daemon=True)
+            vocoder_thread = threading.Thread(target=self._vocoder_worker, args=(mel_queue, output_file, silence, stream_chunk_frames, errors), daemon=True)
+            phonemizer_thread.start()
+            vocoder_thread.start()
+            try:
+                while True:
+                    job = phone_queue.get()
+                    if job is None:
+                        break
+                    text, phones, durations, pitch, energy = job
+                    if not silent:
+                        print("Now synthesizing: {}".format(text))
+                    with torch.inference_mode():
+                        mel, *_ = self._phones_to_mel(phones,
+                                                      durations=durations,
+                                                      pitch=pitch,
+                                                      energy=energy,
+                                                      duration_scaling_factor=duration_scaling_factor,
+                                                      pitch_variance_scale=pitch_variance_scale,
+                                                      energy_variance_scale=energy_variance_scale)
+                    mel_queue.put(mel)
+            except Exception as e:
+                errors.append(e)
+                while phone_queue.get() is not None:
+                    pass  # unblock the phonemizer, it stops as soon as it sees the error
+            finally:
+                mel_queue.put(None)
+                vocoder_thread.join()
+                phonemizer_thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _phonemizer_worker(self, jobs, phone_queue, errors):
+        try:
+            for text, durations, pitch, energy in jobs:
+                if len(errors) > 0:
+                    break
+                with torch.inference_mode():
+                    phones = self._text_to_phones(text)
+                phone_queue.put((text,
+                                 phones,
+                                 durations.to(self.device) if durations is not None else None,
+                                 pitch.to(self.device) if pitch is not None else None,
+                                 energy.to(self.device) if energy is not None else None))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            phone_queue.put(None)
+
+    def _vocoder_worker(self, mel_queue, output_file, silence, stream_chunk_frames, errors):
+        while True:
+            mel = mel_queue.get()
+            if mel is None:
+                return
+            if len(errors) > 0:
+                continue  # keep consuming, so the producer never blocks on a full queue
+            try:
+                for wave in self._vocode_blocks(mel, chunk_frames=stream_chunk_frames):
+                    output_file.write(wave.cpu().numpy())
+                output_file.write(silence)
+            except Exception as e:
+                errors.append(e)
 
     def read_aloud(self,
                    text,
@@ -232,9 +390,24 @@ class InferenceFastSpeech2(torch.nn.Module):
                    duration_scaling_factor=1.0,
                    pitch_variance_scale=1.0,
                    energy_variance_scale=1.0,
-                   blocking=False):
+                   blocking=False,
+                   stream_chunk_frames=None):
+        """
+        stream_chunk_frames: if set, playback starts as soon as the first block of this many frames is vocoded.
+                             Streamed playback is always blocking. Ignored with noise_reduce, which needs the whole utterance.
+        """
         if text.strip() == "":
             return
+        if stream_chunk_frames is not None:
+            with sounddevice.OutputStream(samplerate=48000, channels=1, dtype="float32") as output_stream:
+                for wave in self.stream(text,
+                                        chunk_frames=stream_chunk_frames,
+                                        duration_scaling_factor=duration_scaling_factor,
+                                        pitch_variance_scale=pitch_variance_scale,
+                                        energy_variance_scale=energy_variance_scale):
+                    output_stream.write(wave.cpu().float().numpy().reshape(-1, 1))
+                output_stream.write(torch.zeros([36000, 1]).numpy())
+            return
         wav = self(text,
                    view,
                    duration_scaling_factor=duration_scaling_factor,
@@ -6,7 +6,6 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 import os
-import numpy as np
 import matplotlib.pyplot as plt
 
 from Layers.Attention import RelPositionMultiHeadedAttention
@@ -18,6 +17,8 @@ from Layers.MultiSequential import repeat
 from Layers.PositionalEncoding import RelPositionalEncoding
 from Layers.Swish import Swish
 
+ACCENT_EMBEDDING_DIR = '/nas/projects/vokquant/IMS-Toucan_lang_emb_conformer/Preprocessing/embeds_mls_test/trained_on_12_but_only_wass/'
+
 
 class Conformer_accent_mha(torch.nn.Module):
     """
@@ -47,13 +48,17 @@ class Conformer_accent_mha(torch.nn.Module):
         use_cnn_module (bool): Whether to use convolution module.
         cnn_module_kernel (int): Kernerl size of convolution module.
         padding_idx (int): Padding idx for input_layer=embed.
+        accent_embeddings (Union[str, torch.Tensor]): Directory with one accent embedding file (*.pt) per accent, or the embeddings
+            as a tensor (#accents, dim). They are loaded once and kept as a buffer, so they also end up in the checkpoints.
+        accent_attention_heads (int): The number of heads of the attention from the decoder states to the accent embeddings.
+        active_accents (list): Indexes of the accent embeddings the decoder can attend to, all others are zeroed.
 
     """
 
     def __init__(self, idim, attention_dim=256, attention_heads=4, linear_units=2048, num_blocks=6, dropout_rate=0.1, positional_dropout_rate=0.1,
                  attention_dropout_rate=0.0, input_layer="conv2d", normalize_before=True, concat_after=False, positionwise_conv_kernel_size=1,
                  macaron_style=False, use_cnn_module=False, cnn_module_kernel=31, zero_triu=False, utt_embed=None, connect_utt_emb_at_encoder_out=True,
-                 spk_emb_bottleneck_size=128):
+                 spk_emb_bottleneck_size=128, accent_embeddings=ACCENT_EMBEDDING_DIR, accent_attention_heads=16, active_accents=(1,)):
         super(Conformer_accent_mha, self).__init__()
 
         activation = Swish()
@@ -98,6 +103,14 @@ class Conformer_accent_mha(torch.nn.Module):
             self.after_norm = LayerNorm(attention_dim)
         self.dropout = nn.Dropout(p=dropout_rate)
 
+        # attention from the decoder states to the accent embeddings
+        self.register_buffer("accent_emb", load_accent_embeddings(accent_embeddings, attention_dim))  # (#accents, attention_dim)
+        self.active_accents = list(active_accents)  # in inference you can try to make all accents zero except one
+        self.accent_attention = nn.MultiheadAttention(attention_dim, accent_attention_heads, 0.1, batch_first=True)
+        self.accent_ffn = PositionWiseFFN(attention_dim, 2048)
+        self.accent_concat_linear = torch.nn.Linear(2 * attention_dim, attention_dim)
+        self.visualize_attn_weights = False  # plots the attention weights of the first datapoint to heatmap.png in every forward pass
+
     def forward(self, xs, masks, utterance_embedding=None, lang_embs=None):
         """
         Encode input sequence.
@@ -129,75 +142,25 @@ class Conformer_accent_mha(torch.nn.Module):
             xs = xs[0]
 
 #####################
-        x_q = xs.to(device='cuda:0')
-        print("x_q.shape: ", x_q.shape)    # x_q.shape:  torch.Size([8, 55, 384])
-        batch = x_q.shape[0] # save batch size as it is in the query
         residual = xs
-        self.accent_emb = []
-        c=0
-        for embs in next(os.walk('/nas/projects/vokquant/IMS-Toucan_lang_emb_conformer/Preprocessing/embeds_mls_test/trained_on_12_but_only_wass/'))[2]:
-            self.accent_emb.append(torch.load(os.path.join('/nas/projects/vokquant/IMS-Toucan_lang_emb_conformer/Preprocessing/embeds_mls_test/trained_on_12_but_only_wass/', embs )))
-            print(str(c) + ": " + str(embs))
-            c+=1
-        self.accent_emb = np.concatenate(self.accent_emb)       # created shape: (12, 1, 192)
-        self.accent_emb = torch.Tensor(self.accent_emb).repeat(1,1,1,2)
-        self.accent_emb = self.accent_emb.squeeze(0)
-        x_acc_emb = self.accent_emb.permute(1, 0, 2).repeat(batch,1,1).to(device='cuda:0') # [8, 12, 384]
-        x_acc_emb[:,:1,:] = 0 # in inference you can try to make all speakers in x_acc_emb zero except one
-        x_acc_emb[:,2:,:] = 0
-        # x_acc_emb[:,11,:] = 0
-        multihead_attn = nn.MultiheadAttention(384, 16, 0.1, batch_first=True).to(device='cuda:0')
-        attn_output, attn_weights = multihead_attn(x_q, x_acc_emb, x_acc_emb)
-        #print("attn_output.shape: ", attn_output.shape, "attn_weights.shape: ", attn_weights.shape, "\n")  # example: attn_output.shape:  torch.Size([8, 55, 384]) attn_weights.shape:  torch.Size([8, 55, 12])
-
-        visualize_attn_weights = True
-        if visualize_attn_weights:
-            #print("attn_weights[0]: ", attn_weights[0], "attn_weights.shape: ", attn_weights.shape)
-            attn_weights_0 = attn_weights[0].to(device='cpu') # visualize attn_weights in a plot, assuming attn_weights has shape (batch_size, query_length, key_length)
-            attn_weights_0 = F.softmax(attn_weights_0, dim=1) # apply softmax to get values between 0 and 1 that sum to 1
-            fig, ax = plt.subplots(figsize=(6, 6)) # plot the attention weights as a heatmap
-            im = ax.imshow(attn_weights_0.detach().numpy(), cmap='hot', interpolation='nearest', extent=[-0.5, 11.5, -0.5, 54.5])
-            ax.set_xticks(range(attn_weights.shape[2]))
-            ax.set_xticklabels([str(i) for i in range(attn_weights.shape[2])])
-            plt.colorbar(im)
-            plt.savefig('heatmap.png')
-
-        attn_output = attn_output.to(device='cuda:0')
-        #residual connection around mha:
-        attn_output = (x_q + attn_output)
+        x_acc_emb = torch.zeros_like(self.accent_emb)
+        x_acc_emb[self.active_accents] = self.accent_emb[self.active_accents]
+        x_acc_emb = x_acc_emb.unsqueeze(0).expand(xs.size(0), -1, -1)  # (#batch, #accents, attention_dim)
+        attn_output, attn_weights = self.accent_attention(xs, x_acc_emb, x_acc_emb)
+        # example: attn_output.shape:  torch.Size([8, 55, 384]) attn_weights.shape:  torch.Size([8, 55, 12])
 
-        # create an instance of PositionwiseFeedForward class
-        ffn_size = 2048
-        ffn = PositionWiseFFN(attn_output.size(-1), ffn_size) # 384, 2048
+        if self.visualize_attn_weights:
+            self._plot_attn_weights(attn_weights)
+
+        #residual connection around mha:
+        attn_output = (xs + attn_output)
 
         # apply position-wise feed-forward network on attn_output
-        ffn_output = ffn(attn_output)
-        #print("ffn_output.shape: ", ffn_output.shape) # ffn_output.shape:  torch.Size([8, 55, 384])
-        # batch_norm = nn.BatchNorm1d(num_features=384, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True).to(device='cuda:0')
-        # attn_output = batch_norm(attn_output.permute(0, 2, 1)).permute(0, 2, 1).to(device='cuda:0')
-        
-        linear = torch.nn.Linear(2*attn_output.size(-1), attn_output.size(-1)).to(device='cuda:0')
-        # concatenate:
-        concatenated = torch.cat([xs, ffn_output], dim=-1)
-        x = linear(concatenated)
-
-        #print("concatenated.shape: ", concatenated.shape) # concatenated.shape:  torch.Size([8, 55, 768])
-        #print("residual.shape: ", residual.shape) # residual.shape:  torch.Size([8, 55, 384])
-        #print("self.concat_linear(concatenated).shape: ", self.concat_linear(concatenated).shape) # self.concat_linear(concatenated).shape:  torch.Size([8, 55, 384])
-        #print("xs.shape: ", xs.shape) # xs.shape:  torch.Size([8, 55, 384])
-        #xs = residual + self.concat_linear(concatenated)
-        #xs = np.concatenate([xs, attn_output], axis=-1)
-        #xs = residual + self.linear(cat(xs, concatenated))
-
-        # x -> x + linear(concat(x, att(x)))
-        #xs = residual + attn_output
-        #xs = residual + 0.001*self.dropout(attn_output)
-        # OR:
-        # x_concat = torch.cat((residual, attn_output), dim=-1)
-        # x = residual + self.concat_linear(x_concat)
-        #xs = concatenated
-        xs = residual + x
+        ffn_output = self.accent_ffn(attn_output)
 
+        # x -> x + linear(concat(x, ffn(x + att(x))))
+        concatenated = torch.cat([xs, ffn_output], dim=-1)
+        xs = residual + self.accent_concat_linear(concatenated)
 
 #####################
 
@@ -217,13 +180,65 @@ class Conformer_accent_mha(torch.nn.Module):
         hs = self.hs_emb_projection(torch.cat([hs, speaker_embeddings_expanded], dim=-1))
         return hs
 
+    @staticmethod
+    def _plot_attn_weights(attn_weights):
+        # visualize attn_weights in a plot, assuming attn_weights has shape (batch_size, query_length, key_length)
+        attn_weights_0 = attn_weights[0].detach().cpu()
+        attn_weights_0 = F.softmax(attn_weights_0, dim=1)  # apply softmax to get values between 0 and 1 that sum to 1
+        fig, ax = plt.subplots(figsize=(6, 6))  # plot the attention weights as a heatmap
+        im = ax.imshow(attn_weights_0.numpy(), cmap='hot', interpolation='nearest', aspect='auto')
+        ax.set_xticks(range(attn_weights.shape[2]))
+        ax.set_xticklabels([str(i) for i in range(attn_weights.shape[2])])
+        plt.colorbar(im)
+        plt.savefig('heatmap.png')
+        plt.close(fig)
+
+
+def load_accent_embeddings(accent_embeddings, attention_dim):
+    """
+    Loads the accent embeddings from a directory with one *.pt file per accent (in the order of the sorted file names)
+    and repeats them along the last dimension until they have the size of the attention dimension, e.g. 192 -> 384.
+    """
+    if isinstance(accent_embeddings, str):
+        if not os.path.isdir(accent_embeddings):
+            raise FileNotFoundError(f"The accent embedding directory {accent_embeddings} does not exist, "
+                                    f"pass the directory or a tensor of embeddings as accent_embeddings instead")
+        files = sorted(file for file in os.listdir(accent_embeddings) if file.endswith(".pt"))
+        if len(files) == 0:
+            raise FileNotFoundError(f"No accent embeddings found in {accent_embeddings}")
+        for index, file in enumerate(files):
+            print(f"{index}: {file}")
+        accent_embeddings = torch.stack([torch.load(os.path.join(accent_embeddings, file), map_location="cpu").view(-1) for file in files])
+    accent_embeddings = torch.as_tensor(accent_embeddings, dtype=torch.float32).view(len(accent_embeddings), -1)
+    if attention_dim % accent_embeddings.size(1) != 0:
+        raise ValueError(f"The accent embeddings of size {accent_embeddings.size(1)} cannot be repeated to the attention dimension {attention_dim}.")
+    return accent_embeddings.repeat(1, attention_dim // accent_embeddings.size(1))
+
+
+def load_state_dict_tolerating_missing_accent_weights(model, state_dict):
+    """
+    Works like model.load_state_dict, except that the weights of the accent attention may be missing, which is the case for
+    all checkpoints from before the accent attention became part of the decoder. Those weights keep their initialization
+    and a warning is printed, every other missing or unexpected key is still an error.
+    """
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    missing_accent_keys = [key for key in missing_keys if any(part.startswith("accent_") for part in key.split("."))]
+    other_missing_keys = [key for key in missing_keys if key not in missing_accent_keys]
+    if len(other_missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise RuntimeError(f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+                           f"missing keys {other_missing_keys}, unexpected keys {unexpected_keys}")
+    if len(missing_accent_keys) > 0:
+        print(f"Warning: the checkpoint has no weights for {len(missing_accent_keys)} parameters and buffers of the accent attention, "
+              f"it was probably saved before the accent attention was trained. They keep their initialization.")
+
+
 class PositionWiseFFN(torch.nn.Module):
     def __init__(self, d_model, d_ff):
         super(PositionWiseFFN, self).__init__()
-        self.fc1 = torch.nn.Linear(d_model, 2*d_ff).to(device='cuda:0')
-        self.fc2 = torch.nn.Linear(d_ff, d_model).to(device='cuda:0')
-        self.norm1 = torch.nn.LayerNorm(2*d_ff).to(device='cuda:0')
-        self.norm2 = torch.nn.LayerNorm(d_model).to(device='cuda:0')
+        self.fc1 = torch.nn.Linear(d_model, 2*d_ff)
+        self.fc2 = torch.nn.Linear(d_ff, d_model)
+        self.norm1 = torch.nn.LayerNorm(2*d_ff)
+        self.norm2 = torch.nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(0.1)
 
 
@@ -6,6 +6,8 @@
 
 from torch import nn
 
+from Utility.utils import masked_group_norm
+
 
 class ConvolutionModule(nn.Module):
     """
@@ -28,12 +30,14 @@ class ConvolutionModule(nn.Module):
         self.pointwise_conv2 = nn.Conv1d(channels, channels, kernel_size=1, stride=1, padding=0, bias=bias, )
         self.activation = activation
 
-    def forward(self, x):
+    def forward(self, x, pad_masks=None):
         """
         Compute convolution module.
 
         Args:
             x (torch.Tensor): Input tensor (#batch, time, channels).
+            pad_masks (torch.Tensor): Mask tensor containing indices of padded part (#batch, time). If given, the padded frames
+                                      neither leak into the convolution nor into the statistics of the norm.
 
         Returns:
             torch.Tensor: Output tensor (#batch, time, channels).
@@ -47,8 +51,12 @@ class ConvolutionModule(nn.Module):
         x = nn.functional.glu(x, dim=1)  # (batch, channel, dim)
 
         # 1D Depthwise Conv
-        x = self.depthwise_conv(x)
-        x = self.activation(self.norm(x))
+        if pad_masks is None:
+            x = self.depthwise_conv(x)
+            x = self.activation(self.norm(x))
+        else:
+            x = self.depthwise_conv(x.masked_fill(pad_masks.unsqueeze(1), 0.0))
+            x = self.activation(masked_group_norm(x, self.norm, pad_masks))
 
         x = self.pointwise_conv2(x)
 
@@ -53,6 +53,9 @@ class DurationPredictor(torch.nn.Module):
     def _forward(self, xs, x_masks=None, is_inference=False):
         xs = xs.transpose(1, -1)  # (B, idim, Tmax)
         for f in self.conv:
+            if x_masks is not None and not self.training:
+                # the padded frames of a batch must not leak into the convolutions in inference
+                xs = xs.masked_fill(x_masks.unsqueeze(1), 0.0)
             xs = f(xs)  # (B, C, Tmax)
 
         # NOTE: calculate in log domain
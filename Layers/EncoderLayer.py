@@ -123,7 +123,10 @@ class EncoderLayer(nn.Module):
             residual = x
             if self.normalize_before:
                 x = self.norm_conv(x)
-            x = residual + self.dropout(self.conv_module(x))
+            # in eval mode the padded frames are masked, so every sequence of a batch gets the same result as on its own.
+            # Training is left the way the existing checkpoints were trained.
+            pad_masks = None if self.training or mask is None else ~mask[:, -1, :]
+            x = residual + self.dropout(self.conv_module(x, pad_masks))
             if not self.normalize_before:
                 x = self.norm_conv(x)
 
@@ -46,14 +46,32 @@ class LengthRegulator(torch.nn.Module, ABC):
         Returns:
             Tensor: replicated input tensor based on durations (B, T*, D).
         """
+        ds = self.expand_durations(ds, alpha)
+
+        return pad_list([self._repeat_one_sequence(x, d) for x, d in zip(xs, ds)], self.pad_value)
+
+    def expand_durations(self, ds, alpha=1.0, pad_masks=None):
+        """
+        The durations the sequences are actually repeated with: scaled by alpha, and every sequence that would not produce a single frame
+        gets one frame per phoneme instead. Their sum is the amount of frames of each sequence.
+
+        Args:
+            ds (LongTensor): Batch of durations of each frame (B, T).
+            alpha (float, optional): Alpha value to control speed of speech.
+            pad_masks (Tensor, optional): Mask tensor containing indices of padded part (B, T), those phonemes never get a frame.
+        """
         if alpha != 1.0:
             assert alpha > 0
             ds = torch.round(ds.float() * alpha).long()
 
-        if ds.sum() == 0:
-            ds[ds.sum(dim=1).eq(0)] = 1
+        empty_sequences = ds.sum(dim=1).eq(0)
+        if empty_sequences.any():
+            ds = ds.clone()
+            ds[empty_sequences] = 1
+            if pad_masks is not None:
+                ds = ds.masked_fill(pad_masks, 0)
 
-        return pad_list([self._repeat_one_sequence(x, d) for x, d in zip(xs, ds)], self.pad_value)
+        return ds
 
     def _repeat_one_sequence(self, x, d):
         """
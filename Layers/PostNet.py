@@ -4,6 +4,8 @@ Taken from ESPNet
 
 import torch
 
+from Utility.utils import masked_group_norm
+
 
 class PostNet(torch.nn.Module):
     """
@@ -59,16 +61,27 @@ class PostNet(torch.nn.Module):
             self.postnet += [torch.nn.Sequential(torch.nn.Conv1d(ichans, odim, n_filts, stride=1, padding=(n_filts - 1) // 2, bias=False, ),
                                                  torch.nn.Dropout(dropout_rate), )]
 
-    def forward(self, xs):
+    def forward(self, xs, pad_masks=None):
         """
         Calculate forward propagation.
 
         Args:
             xs (Tensor): Batch of the sequences of padded input tensors (B, idim, Tmax).
+            pad_masks (Tensor, optional): Mask tensor containing indices of padded part (B, Tmax). If given, the padded frames
+                                          neither leak into the convolutions nor into the statistics of the norms.
 
         Returns:
             Tensor: Batch of padded output tensor. (B, odim, Tmax).
         """
         for i in range(len(self.postnet)):
-            xs = self.postnet[i](xs)
+            if pad_masks is None:
+                xs = self.postnet[i](xs)
+            else:
+                for module in self.postnet[i]:
+                    if isinstance(module, torch.nn.Conv1d):
+                        xs = module(xs.masked_fill(pad_masks.unsqueeze(1), 0.0))
+                    elif isinstance(module, torch.nn.GroupNorm):
+                        xs = masked_group_norm(xs, module, pad_masks)
+                    else:
+                        xs = module(xs)
         return xs
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import librosa
 import librosa.core as lb
 import librosa.display as lbd
@@ -11,14 +13,22 @@ from torchaudio.transforms import Resample
 
 class AudioPreprocessor:
 
-    def __init__(self, input_sr, output_sr=None, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False, device="cpu", fmax_for_spec=8000):
+    def __init__(self, input_sr, output_sr=None, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False, device="cpu", fmax_for_spec=8000, spec_backend="librosa"):
         """
         The parameters are by default set up to do well
         on a 16kHz signal. A different sampling rate may
         require different hop_length and n_fft (e.g.
         doubling frequency --> doubling hop_length and
         doubling n_fft)
-        """
+
+        spec_backend can be "torch" to compute the
+        spectrograms with torch.stft instead of librosa,
+        see batched_logmelfilterbank. The results
+        differ only by floating point noise.
+        """
+        if spec_backend not in ("librosa", "torch"):
+            raise ValueError(f"Unknown spectrogram backend {spec_backend}, use librosa or torch.")
+        self.spec_backend = spec_backend
         self.cut_silence = cut_silence
         self.device = device
         self.sr = input_sr
@@ -99,15 +109,15 @@ class AudioPreprocessor:
         """
         if fmax is None:
             fmax = self.fmax_for_spec
+        if self.spec_backend == "torch":
+            return batched_logmelfilterbank([audio], sampling_rate, n_fft=self.n_fft, hop_length=self.hop_length, n_mels=self.mel_buckets, fmin=fmin, fmax=fmax, eps=eps)[0]
         if isinstance(audio, torch.Tensor):
             audio = audio.numpy()
         # get amplitude spectrogram
         x_stft = librosa.stft(audio, n_fft=self.n_fft, hop_length=self.hop_length, win_length=None, window="hann", pad_mode="reflect")
         spc = np.abs(x_stft).T
         # get mel basis
-        fmin = 0 if fmin is None else fmin
-        fmax = sampling_rate / 2 if fmax is None else fmax
-        mel_basis = librosa.filters.mel(sampling_rate, self.n_fft, self.mel_buckets, fmin, fmax)
+        mel_basis = get_mel_basis(sampling_rate, self.n_fft, self.mel_buckets, fmin, fmax)
         # apply log and return
         return torch.Tensor(np.log10(np.maximum(eps, np.dot(spc, mel_basis.T)))).transpose(0, 1)
 
@@ -172,6 +182,63 @@ class AudioPreprocessor:
         return self.logmelfilterbank(audio=audio, sampling_rate=explicit_sampling_rate)
 
 
+@lru_cache(maxsize=None)
+def get_mel_basis(sampling_rate, n_fft, n_mels, fmin=40, fmax=None):
+    """
+    librosa's mel filterbank, which is the same for every call with the same arguments, so it is only computed once.
+    The array is shared between all callers and therefore read-only.
+    """
+    fmin = 0 if fmin is None else fmin
+    fmax = sampling_rate / 2 if fmax is None else fmax
+    mel_basis = librosa.filters.mel(sr=sampling_rate, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    mel_basis.flags.writeable = False
+    return mel_basis
+
+
+@lru_cache(maxsize=None)
+def get_mel_basis_tensor(sampling_rate, n_fft, n_mels, fmin=40, fmax=None, device="cpu"):
+    return torch.tensor(get_mel_basis(sampling_rate, n_fft, n_mels, fmin, fmax), dtype=torch.float32, device=device)
+
+
+@lru_cache(maxsize=None)
+def get_hann_window(n_fft, device="cpu"):
+    # periodic, like the one librosa uses
+    return torch.hann_window(n_fft, periodic=True, device=device)
+
+
+def batched_logmelfilterbank(audios, sampling_rate, n_fft=1024, hop_length=256, n_mels=80, fmin=40, fmax=8000, eps=1e-10, device="cpu"):
+    """
+    The same as AudioPreprocessor.logmelfilterbank, but with torch.stft for
+    many audios of different lengths at once, optionally on the GPU.
+
+    Every audio is reflect-padded on its own like librosa does it, then they
+    are zero-padded to the same length and go through the STFT together. The
+    frames that only exist because of the zero-padding are cut off again.
+
+    Args:
+        audios: list of 1D waves (tensors or numpy arrays)
+
+    Returns:
+        list of log-mel spectrograms (n_mels x frames), one per audio and on the cpu
+    """
+    device = str(device)
+    padded = list()
+    frames = list()
+    for audio in audios:
+        audio = torch.as_tensor(audio, dtype=torch.float32, device=device)
+        padded.append(torch.nn.functional.pad(audio.view(1, 1, -1), (n_fft // 2, n_fft // 2), mode="reflect").view(-1))
+        frames.append(1 + len(audio) // hop_length)
+    batch = torch.nn.utils.rnn.pad_sequence(padded, batch_first=True)
+    spectrum = torch.stft(batch,
+                          n_fft=n_fft,
+                          hop_length=hop_length,
+                          window=get_hann_window(n_fft, device),
+                          center=False,
+                          return_complex=True).abs()
+    log_mels = torch.log10(torch.clamp(torch.matmul(get_mel_basis_tensor(sampling_rate, n_fft, n_mels, fmin, fmax, device), spectrum), min=eps))
+    return [log_mel[:, :frame_count].cpu() for log_mel, frame_count in zip(log_mels, frames)]
+
+
 if __name__ == '__main__':
     import soundfile
 
@@ -0,0 +1,61 @@
+"""
+Computing the spectrograms for vocoder training with librosa in the
+DataLoader workers, one segment at a time, makes loading CPU-bound. This
+module does the same for a whole batch of wave segments at once, on the
+device the batch is on: resampling, STFT, mel filterbank and log.
+
+The result matches AudioPreprocessor.logmelfilterbank up to floating point
+noise, the mel filterbank is even the same one from librosa. The tolerance is
+checked by Tests/test_batched_mel_featurizer.py.
+"""
+
+import torch
+from torchaudio.transforms import Resample
+
+from Preprocessing.AudioPreprocessor import get_mel_basis
+
+
+class BatchedMelFeaturizer(torch.nn.Module):
+
+    def __init__(self, input_sr=48000, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, fmin=40, fmax=8000, eps=1e-10):
+        """
+        The defaults are those of HiFiGANDataset, which produces 16kHz spectrograms for 48kHz waves.
+
+        Args:
+            input_sr: sampling rate of the waves that go in
+            output_sr: sampling rate the spectrograms are computed at
+        """
+        super().__init__()
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.eps = eps
+        if output_sr is not None and output_sr != input_sr:
+            self.resample = Resample(orig_freq=input_sr, new_freq=output_sr)
+        else:
+            self.resample = torch.nn.Identity()
+            output_sr = input_sr
+        # librosa uses a periodic hann window by default
+        self.register_buffer("window", torch.hann_window(n_fft, periodic=True), persistent=False)
+        self.register_buffer("mel_basis",
+                             torch.tensor(get_mel_basis(output_sr, n_fft, melspec_buckets, fmin, fmax), dtype=torch.float32),
+                             persistent=False)
+
+    @torch.no_grad()
+    def forward(self, waves):
+        """
+        Args:
+            waves: batch of wave segments of the same length (batch x samples)
+
+        Returns:
+            log-mel spectrograms (batch x melspec_buckets x frames), like logmelfilterbank for every wave
+        """
+        waves = self.resample(waves.float())
+        spectrum = torch.stft(waves,
+                              n_fft=self.n_fft,
+                              hop_length=self.hop_length,
+                              window=self.window,
+                              center=True,
+                              pad_mode="reflect",
+                              return_complex=True).abs()
+        return torch.log10(torch.clamp(torch.matmul(self.mel_basis, spectrum), min=self.eps))
+
@@ -0,0 +1,129 @@
+"""
+Setting a reference voice at inference time, comparing speakers in the
+evaluation and reading texts with the same few speakers over and over again
+all run the ECAPA and the x-vector encoder on the same reference files. This
+cache keeps the 704 dimensional condition of every reference file on disk,
+addressed by the path, the modification time and the size of the file
+together with the version of the condition extractor, so a changed file or
+a changed extractor leads to a new computation. The most recently used
+conditions are also kept in memory, so serving them needs no disk access.
+
+To compute the conditions of a directory of reference voices in advance:
+
+    python -m Preprocessing.ConditionCache --reference_dir audios/speakers
+"""
+
+import argparse
+import hashlib
+import os
+from collections import OrderedDict
+
+import soundfile as sf
+import torch
+from tqdm import tqdm
+
+from Preprocessing.ProsodicConditionExtractor import CONDITION_EXTRACTOR_VERSION
+from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg")
+
+
+class ConditionCache:
+
+    def __init__(self, cache_dir="Models/ConditionCache", max_conditions_in_memory=256, device="cpu"):
+        """
+        Args:
+            cache_dir: directory the conditions are written to
+            max_conditions_in_memory: how many of the most recently used conditions are kept in memory
+            device: device the condition extractor runs on, the conditions are always returned on the cpu
+        """
+        self.cache_dir = cache_dir
+        self.max_conditions_in_memory = max_conditions_in_memory
+        self.device = device
+        self.conditions = OrderedDict()
+        self.extractors = dict()  # the extractor depends on the sampling rate, so there is one per sampling rate that occurred
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, path):
+        stat = os.stat(path)
+        key = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{CONDITION_EXTRACTOR_VERSION}".encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, path):
+        """
+        Returns:
+            the condition of the reference audio at the path, as ProsodicConditionExtractor.extract_condition_from_reference_wave would
+        """
+        cache_path = self.path_for(path)
+        if cache_path in self.conditions:
+            self.conditions.move_to_end(cache_path)
+            return self.conditions[cache_path]
+        if os.path.exists(cache_path):
+            condition = torch.load(cache_path, map_location="cpu")
+        else:
+            condition = self._extract(path)
+            _save_atomically(condition, cache_path)
+        self.conditions[cache_path] = condition
+        if len(self.conditions) > self.max_conditions_in_memory:
+            self.conditions.popitem(last=False)
+        return condition
+
+    def precompute(self, paths):
+        """
+        Computes the conditions of all paths that are not cached yet, without keeping them in memory.
+        """
+        missing = [path for path in paths if not os.path.exists(self.path_for(path))]
+        print(f"Computing the conditions of {len(missing)} of {len(paths)} files that are not cached yet...")
+        for path in tqdm(missing):
+            _save_atomically(self._extract(path), self.path_for(path))
+
+    def _extract(self, path):
+        wave, sr = sf.read(path)
+        if sr not in self.extractors:
+            self.extractors[sr] = ProsodicConditionExtractor(sr=sr, device=self.device)
+        return self.extractors[sr].extract_condition_from_reference_wave(wave).cpu()
+
+
+def _save_atomically(condition, cache_path):
+    torch.save(condition, cache_path + f".{os.getpid()}.tmp")
+    os.replace(cache_path + f".{os.getpid()}.tmp", cache_path)
+
+
+_condition_caches = dict()
+
+
+def get_condition_cache(cache_dir="Models/ConditionCache", device="cpu"):
+    """
+    The cache for the cache_dir and the device that is shared by everything in this process, so the conditions
+    in memory and the loaded extractors are reused by e.g. every InferenceFastSpeech2 that is created. Every device
+    gets its own instance, so the extractors run where the caller asked for.
+    """
+    key = (cache_dir, str(device))
+    if key not in _condition_caches:
+        _condition_caches[key] = ConditionCache(cache_dir=cache_dir, device=device)
+    return _condition_caches[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='IMS Speech Synthesis Toolkit - Precompute Reference Conditions')
+
+    parser.add_argument('--reference_dir',
+                        type=str,
+                        help="Directory that is searched recursively for reference audios.",
+                        required=True)
+
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        help="Directory of the cache.",
+                        default="Models/ConditionCache")
+
+    parser.add_argument('--gpu_id',
+                        type=str,
+                        help="Which GPU to run the extractor on. 'cpu' runs it on the CPU.",
+                        default="cpu")
+
+    args = parser.parse_args()
+
+    reference_paths = sorted(os.path.join(directory, file) for directory, _, files in os.walk(args.reference_dir) for file in files
+                             if file.lower().endswith(AUDIO_EXTENSIONS))
+    ConditionCache(cache_dir=args.cache_dir, device="cpu" if args.gpu_id == "cpu" else f"cuda:{args.gpu_id}").precompute(reference_paths)
@@ -0,0 +1,79 @@
+"""
+The averaged language and dialect embeddings are a handful of small files,
+e.g. at_emb_trained.pt or vd_emb_trained.pt, but they are needed for every
+utterance of a corpus. This table loads all of them once, stacks them into a
+single tensor and maps every name to its row, so a datapoint only needs to
+keep the index of its embedding.
+"""
+
+import os
+
+import numpy as np
+import torch
+
+LANGUAGE_EMBEDDING_DIR = "./Preprocessing/embeds_mls_test"
+LANGUAGE_EMBEDDING_SUFFIX = "_emb_trained.pt"
+
+
+class LanguageEmbeddingTable:
+
+    def __init__(self, embedding_dir=LANGUAGE_EMBEDDING_DIR):
+        """
+        Args:
+            embedding_dir: directory with one {name}_emb_trained.pt per language or dialect, e.g. at_emb_trained.pt
+        """
+        self.embedding_dir = embedding_dir
+        files = sorted(file for file in os.listdir(embedding_dir) if file.endswith(LANGUAGE_EMBEDDING_SUFFIX))
+        self.names = [file[:-len(LANGUAGE_EMBEDDING_SUFFIX)] for file in files]
+        self.name_to_index = {name: index for index, name in enumerate(self.names)}
+        self.embeddings = torch.stack([_load_embedding(os.path.join(embedding_dir, file)) for file in files]) if len(files) > 0 else torch.zeros(0, 192)
+        self._embeddings_from_other_files = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def index_of(self, name):
+        if name not in self.name_to_index:
+            raise KeyError(f"There is no {name}{LANGUAGE_EMBEDDING_SUFFIX} in {self.embedding_dir}, the table knows {', '.join(self.names)}.")
+        return self.name_to_index[name]
+
+    def index_of_filepath(self, filepath):
+        """
+        the index of the dialect an audio belongs to, which is the second part of its file name, e.g. vd for hpo_vd_wean_0002.wav
+        """
+        return self.index_of(os.path.basename(filepath).split('_')[1])
+
+    def embedding_of(self, name_or_path):
+        """
+        Args:
+            name_or_path: the name of an embedding in the table, e.g. at, or the path to any averaged embedding file
+
+        Returns:
+            the embedding as a 1D tensor
+        """
+        if name_or_path in self.name_to_index:
+            return self.embeddings[self.name_to_index[name_or_path]]
+        file = os.path.basename(name_or_path)
+        if os.path.abspath(os.path.dirname(name_or_path)) == os.path.abspath(self.embedding_dir) and file.endswith(LANGUAGE_EMBEDDING_SUFFIX):
+            return self.embeddings[self.index_of(file[:-len(LANGUAGE_EMBEDDING_SUFFIX)])]
+        # files that are not in the table, e.g. embeddings of a different model, are also only loaded once
+        if name_or_path not in self._embeddings_from_other_files:
+            self._embeddings_from_other_files[name_or_path] = _load_embedding(name_or_path)
+        return self._embeddings_from_other_files[name_or_path]
+
+
+def _load_embedding(path):
+    # the averaged embeddings are saved as numpy arrays of shape (1, 1, 192)
+    return torch.as_tensor(np.asarray(torch.load(path, map_location="cpu")), dtype=torch.float32).view(-1)
+
+
+_language_embedding_tables = dict()
+
+
+def get_language_embedding_table(embedding_dir=LANGUAGE_EMBEDDING_DIR):
+    """
+    The table for the embedding_dir that is shared by everything in this process.
+    """
+    if embedding_dir not in _language_embedding_tables:
+        _language_embedding_tables[embedding_dir] = LanguageEmbeddingTable(embedding_dir=embedding_dir)
+    return _language_embedding_tables[embedding_dir]
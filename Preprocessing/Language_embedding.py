@@ -1,6 +1,10 @@
-from speechbrain.pretrained import EncoderClassifier
 import torch
 
+from Utility.model_registry import get_speechbrain_encoder
+
+LANGUAGE_ENCODER = ("/data/vokquant/speechbrain/recipes/CommonLanguage/lang_id/results/ECAPA-TDNN/1986/save/ckpt/",
+                    "/data/vokquant/IMS-Toucan_lang_emb/Preprocessing/pretrained_models/lang-id-commonlanguage_ecapa")
+
 
 class LanguageEmbedding:
 
@@ -12,21 +16,16 @@ class LanguageEmbedding:
         #                                                   savedir="pretrained_models/lang-id-commonlanguage_ecapa")
 
         #  Use 45+WASS model:
+        # the encoder is only loaded by the first LanguageEmbedding in a process, all others share it
         print("attention this is only the pretrained model!!!")
-        self.language_id = EncoderClassifier.from_hparams(source="/data/vokquant/speechbrain/recipes/CommonLanguage/lang_id/results/ECAPA-TDNN/1986/save/ckpt/",
-                                                          run_opts={"device": str(device)},
-                                                          savedir="/data/vokquant/IMS-Toucan_lang_emb/Preprocessing/pretrained_models/lang-id-commonlanguage_ecapa")
+        self.language_id = get_speechbrain_encoder(*LANGUAGE_ENCODER, device=device)
+
     def get_language_embedding(self, input_waves=None):
-        print("attention this is only the pretrained model!!!")
-        # print(input_waves.size())
         embeddings = self.language_id.encode_batch(input_waves)
-        # print((embeddings.size()))
         return embeddings
 
     def get_emb_from_path(self, path_to_wavfile=None):
-        print("attention this is only the pretrained model!!!")
         audio = self.language_id.load_audio(path_to_wavfile)
-        print(self.language_id.encode_batch(audio).size())
         return self.language_id.encode_batch(audio).squeeze(0)
         
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+"""
+Applying a long list of replacements with one str.replace after the
+other copies the string for every replacement that matches. The
+OrderedReplacer compiles such a list once and then applies it with as
+few passes as possible, while producing exactly the same result as
+the ordered sequence of str.replace calls.
+
+- consecutive single character replacements are composed into one
+  translation table (replacing single characters maps every character
+  independently, so the composition is exact), so every character is
+  replaced at most once
+- consecutive multi character replacements that are tokens ending in the
+  same separator (like the SAMPA phones coming from festival, e.g. 'ah_')
+  are applied in one pass over the tokens. If a replacement
+  could have created a new match together with the following token
+  (e.g. 'Ehn_' -> 'ɛːn' followed by 'l_' makes 'nl_' match later on),
+  the string is processed with the ordered replacements instead, so
+  the result stays identical.
+- everything else falls back to str.replace
+"""
+
+import re
+
+
+class OrderedReplacer:
+
+    def __init__(self, replacements):
+        """
+        Args:
+            replacements: list of (old, new) pairs, applied in order
+        """
+        self.stages = list()
+        run = list()
+        for replacement in replacements:
+            if len(run) > 0 and (len(replacement[0]) == 1) != (len(run[0][0]) == 1):
+                self.stages.extend(_compile_run(run))
+                run = list()
+            run.append(replacement)
+        if len(run) > 0:
+            self.stages.extend(_compile_run(run))
+
+    def __call__(self, text):
+        for stage in self.stages:
+            text = stage(text)
+        return text
+
+
+def apply_sequentially(text, replacements):
+    """
+    the reference semantics of the OrderedReplacer
+    """
+    for old, new in replacements:
+        text = text.replace(old, new)
+    return text
+
+
+def _compile_run(run):
+    if len(run[0][0]) == 1:
+        return [_TranslationStage(run)]
+    separator = run[0][0][-1]
+    if len(run) > 1 and _TokenStage.is_applicable(run, separator):
+        return [_TokenStage(run, separator)]
+    return [_ReplaceStage(old, new) for old, new in run]
+
+
+class _TranslationStage:
+
+    def __init__(self, replacements):
+        self.table = dict()
+        for old, _ in replacements:
+            new = apply_sequentially(old, replacements)
+            if new != old:
+                self.table[old] = new
+        self.translation_table = {ord(old): new for old, new in self.table.items()}
+        # if no character is turned into another character of the table, the composed replacements can be
+        # applied one after the other in any order, which is faster than str.translate for non-ascii text
+        self.is_order_independent = not any(char in self.table for new in self.table.values() for char in new)
+
+    def __call__(self, text):
+        if not self.is_order_independent:
+            return text.translate(self.translation_table)
+        for old, new in self.table.items():
+            if old in text:
+                text = text.replace(old, new)
+        return text
+
+
+class _ReplaceStage:
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def __call__(self, text):
+        return text.replace(self.old, self.new)
+
+
+class _TokenStage:
+
+    def __init__(self, replacements, separator):
+        self.replacements = replacements
+        self.separator = separator
+        self.body_to_new = {old[:-1]: new for old, new in replacements}
+        self.max_body_length = max(len(old) - 1 for old, _ in replacements)
+        self.token_regex = re.compile("([^" + re.escape(separator) + "]*)" + re.escape(separator))
+        self.cascades = _find_cascades(replacements)
+        # if no replacement involves a space, words are independent and only the words with a possible cascade need the ordered replacements
+        self.words_are_independent = all(" " not in old and " " not in new for old, new in replacements)
+        self.lookup = dict()
+
+    @staticmethod
+    def is_applicable(replacements, separator):
+        olds = [old for old, _ in replacements]
+        if len(set(olds)) != len(olds):
+            return False
+        for old in olds:
+            if len(old) < 2 or not old.endswith(separator) or separator in old[:-1]:
+                return False
+        for earlier_index, earlier in enumerate(olds):
+            for later in olds[earlier_index + 1:]:
+                if later.endswith(earlier):
+                    return False  # a shorter token would be replaced inside of a longer one first
+        return True
+
+    def __call__(self, text):
+        replaced_text, could_cascade = self._replace_in_one_pass(text)
+        if not could_cascade:
+            return replaced_text
+        if not self.words_are_independent:
+            return apply_sequentially(text, self.replacements)
+        replaced_words = list()
+        for word in text.split(" "):
+            replaced_word, could_cascade = self._replace_in_one_pass(word)
+            replaced_words.append(apply_sequentially(word, self.replacements) if could_cascade else replaced_word)
+        return " ".join(replaced_words)
+
+    def _replace_in_one_pass(self, text):
+        previous_old = None
+        could_cascade = False
+
+        def replace_token(match):
+            nonlocal previous_old, could_cascade
+            token = match.group(1)
+            old, new = self._look_up(token)
+            if previous_old is not None and (previous_old, token) in self.cascades:
+                could_cascade = True
+            previous_old = old
+            return new
+
+        return self.token_regex.sub(replace_token, text), could_cascade
+
+    def _look_up(self, token):
+        """
+        Without cascades, the replacement with the longest match is the one that consumes the separator
+        after a token, since it comes earliest in the order (see is_applicable). Returns the pattern
+        of that replacement (None if there is none) and what the token and the separator turn into.
+        """
+        if token not in self.lookup:
+            if len(self.lookup) > 100000:
+                self.lookup.clear()
+            self.lookup[token] = (None, token + self.separator)
+            for length in range(min(len(token), self.max_body_length), 0, -1):
+                if token[-length:] in self.body_to_new:
+                    self.lookup[token] = (token[-length:] + self.separator, token[:-length] + self.body_to_new[token[-length:]])
+                    break
+        return self.lookup[token]
+
+
+def _find_cascades(replacements):
+    """
+    Finds the pairs of consecutive tokens where the replacement of the first token can make a later
+    replacement match across the boundary to the second token, before the second token is replaced
+    on its own. E.g. 'Ehn_l_' becomes 'ɛːnl_' after 'Ehn_' is replaced, then 'nl_' matches before
+    'l_' gets its turn. The pairs are returned as (pattern that consumes the first separator, second
+    token). The check is conservative, a pair that is found does not necessarily cascade.
+    """
+    bodies = [old[:-1] for old, _ in replacements]
+    body_to_index = {body: index for index, body in enumerate(bodies)}
+
+    def index_of_token(token):
+        # the replacement that consumes the separator after the token if nothing cascades
+        for length in range(len(token), 0, -1):
+            if token[-length:] in body_to_index:
+                return body_to_index[token[-length:]]
+        return len(replacements)
+
+    cascades = set()
+    for cascading_index, body in enumerate(bodies):
+        for split in range(1, len(body) + 1):
+            left, token = body[:split], body[split:]  # the token can also be empty, as in 'Ehn__'
+            if cascading_index >= index_of_token(token):
+                continue
+            for previous_old, previous_new in replacements[:cascading_index]:
+                # the part left of the token has to come from the output of the previous replacement
+                # (or reach even further to the left, which we treat as a possible cascade as well)
+                if previous_new.endswith(left) or left.endswith(previous_new):
+                    cascades.add((previous_old, token))
+    return cascades
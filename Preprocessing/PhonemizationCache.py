@@ -0,0 +1,145 @@
+"""
+Phonemizing with espeak or festival means a subprocess call for every
+sentence, even though the same sentences come back over and over again
+(progress plots after every epoch, evaluation scripts, repeated prompts).
+This cache maps (frontend version, SAMPA mapping, language, text, flags) to
+the finished phone string. It has an in-memory LRU layer and an optional
+persistent sqlite layer. Entries of an older frontend version or an edited
+SAMPA mapping are never hit again and get evicted from the sqlite file like
+any other unused entry.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PhonemizationCache:
+
+    def __init__(self, max_entries_in_memory=50000, path_to_db=None, max_entries_on_disk=1000000):
+        """
+        Args:
+            max_entries_in_memory: how many phone strings the in-memory LRU keeps before it evicts the least recently used one
+            path_to_db: path to a sqlite file that persists the cache across processes, None keeps everything in memory only
+            max_entries_on_disk: how many phone strings the sqlite file keeps before the least recently used ones are evicted
+        """
+        self.max_entries_in_memory = max_entries_in_memory
+        self.max_entries_on_disk = max_entries_on_disk
+        self.path_to_db = path_to_db
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._connection = None
+        self._connection_pid = None
+        if path_to_db is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path_to_db)), exist_ok=True)
+            self._get_connection()
+
+    def get(self, key):
+        """
+        returns the cached phone string for the key or None
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            if self.path_to_db is not None:
+                connection = self._get_connection()
+                row = connection.execute("SELECT phones FROM phonemizations WHERE key = ?", (_serialize_key(key),)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE phonemizations SET last_access = ? WHERE key = ?", (time.time(), _serialize_key(key)))
+                    connection.commit()
+                    self._put_in_memory(key, row[0])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, phones):
+        with self.lock:
+            self._put_in_memory(key, phones)
+            if self.path_to_db is not None:
+                connection = self._get_connection()
+                connection.execute("INSERT OR REPLACE INTO phonemizations (key, phones, last_access) VALUES (?, ?, ?)", (_serialize_key(key), phones, time.time()))
+                entries_on_disk = connection.execute("SELECT COUNT(*) FROM phonemizations").fetchone()[0]
+                if entries_on_disk > self.max_entries_on_disk:
+                    # evict a tenth at once, so we don't have to evict again with every single insertion
+                    connection.execute("DELETE FROM phonemizations WHERE key IN (SELECT key FROM phonemizations ORDER BY last_access ASC LIMIT ?)",
+                                       (entries_on_disk - self.max_entries_on_disk + self.max_entries_on_disk // 10,))
+                connection.commit()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits"  : self.disk_hits,
+            "misses"     : self.misses,
+            "hit_rate"   : (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            "in_memory"  : len(self.memory),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.path_to_db is not None:
+                connection = self._get_connection()
+                connection.execute("DELETE FROM phonemizations")
+                connection.commit()
+
+    def _put_in_memory(self, key, phones):
+        self.memory[key] = phones
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries_in_memory:
+            self.memory.popitem(last=False)
+
+    def _get_connection(self):
+        # sqlite connections must not be shared with forked processes such as DataLoader workers, so every process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path_to_db, timeout=30, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS phonemizations (key TEXT PRIMARY KEY, phones TEXT NOT NULL, last_access REAL NOT NULL)")
+            self._connection.commit()
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["_connection"] = None
+        state["_connection_pid"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def _serialize_key(key):
+    return "\x1f".join(str(element) for element in key)
+
+
+_caches = dict()
+
+
+def get_phonemization_cache(path_to_db=None, max_entries_in_memory=50000, max_entries_on_disk=1000000):
+    """
+    All frontends of a process that use the same storage share one cache, so
+    e.g. the frontend that is created anew for every progress plot still hits.
+    Asking for the same storage with different limits is an error, because the
+    limits of the cache that already exists would silently win.
+    """
+    if path_to_db in _caches:
+        cache = _caches[path_to_db]
+        if (cache.max_entries_in_memory, cache.max_entries_on_disk) != (max_entries_in_memory, max_entries_on_disk):
+            raise ValueError(f"The phonemization cache for {path_to_db} already exists with max_entries_in_memory={cache.max_entries_in_memory} "
+                             f"and max_entries_on_disk={cache.max_entries_on_disk}, it cannot be shared with "
+                             f"max_entries_in_memory={max_entries_in_memory} and max_entries_on_disk={max_entries_on_disk}.")
+    else:
+        _caches[path_to_db] = PhonemizationCache(max_entries_in_memory=max_entries_in_memory,
+                                                 path_to_db=path_to_db,
+                                                 max_entries_on_disk=max_entries_on_disk)
+    return _caches[path_to_db]
@@ -3,9 +3,15 @@ import torch
 import torch.multiprocessing
 import torch.multiprocessing
 from numpy import trim_zeros
-from speechbrain.pretrained import EncoderClassifier
+from torch.nn.utils.rnn import pad_sequence
+from tqdm import tqdm
 
 from Preprocessing.AudioPreprocessor import AudioPreprocessor
+from Utility.model_registry import ECAPA_SPEAKER_ENCODER
+from Utility.model_registry import XVECTOR_SPEAKER_ENCODER
+from Utility.model_registry import get_speechbrain_encoder
+
+CONDITION_EXTRACTOR_VERSION = 1  # increase this whenever the extracted conditions change, so cached ones are computed again
 
 
 class ProsodicConditionExtractor:
@@ -13,13 +19,9 @@ class ProsodicConditionExtractor:
     def __init__(self, sr, device=torch.device("cpu")):
         self.ap = AudioPreprocessor(input_sr=sr, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False)
         # https://huggingface.co/speechbrain/spkrec-ecapa-voxceleb
-        self.speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                                           run_opts={"device": str(device)},
-                                                                           savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
+        self.speaker_embedding_func_ecapa = get_speechbrain_encoder(*ECAPA_SPEAKER_ENCODER, device=device)
         # https://huggingface.co/speechbrain/spkrec-xvect-voxceleb
-        self.speaker_embedding_func_xvector = EncoderClassifier.from_hparams(source="speechbrain/spkrec-xvect-voxceleb",
-                                                                             run_opts={"device": str(device)},
-                                                                             savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_xvector")
+        self.speaker_embedding_func_xvector = get_speechbrain_encoder(*XVECTOR_SPEAKER_ENCODER, device=device)
 
     def extract_condition_from_reference_wave(self, wave, already_normalized=False):
         if already_normalized:
@@ -33,6 +35,56 @@ class ProsodicConditionExtractor:
                                             spk_emb_xvector.cpu()], dim=0)
         return combined_utt_condition
 
+    def extract_conditions_from_reference_waves(self, waves, already_normalized=False, batch_size=32):
+        """
+        The same as extract_condition_from_reference_wave for many waves, but the
+        encoders run on padded batches of waves with similar lengths.
+
+        Returns:
+            one condition per wave, or None for the waves the encoders fail on
+        """
+        if not already_normalized:
+            waves = [torch.tensor(trim_zeros(self.ap.audio_to_wave_tensor(normalize=True, audio=wave).numpy())) for wave in waves]
+        device = self.speaker_embedding_func_ecapa.device
+        try:
+            spk_embs_ecapa = encode_batched(self.speaker_embedding_func_ecapa, waves, batch_size=batch_size, device=device)
+            spk_embs_xvector = encode_batched(self.speaker_embedding_func_xvector, waves, batch_size=batch_size, device=device)
+        except RuntimeError:
+            # e.g. an audio without any voiced segments whatsoever, so the waves are encoded one by one to find it
+            conditions = list()
+            for wave in waves:
+                try:
+                    conditions.append(self.extract_condition_from_reference_wave(wave, already_normalized=True))
+                except RuntimeError:
+                    conditions.append(None)
+            return conditions
+        return [torch.cat([spk_emb_ecapa, spk_emb_xvector], dim=0) for spk_emb_ecapa, spk_emb_xvector in zip(spk_embs_ecapa, spk_embs_xvector)]
+
+
+@torch.inference_mode()
+def encode_batched(encoder, waves, batch_size=32, device="cpu", show_progress=False):
+    """
+    Runs a SpeechBrain encoder on batches of waves. The waves are sorted by length, so there is
+    little padding in a batch, and the encoder is told the relative length of every wave.
+
+    Args:
+        encoder: a SpeechBrain EncoderClassifier
+        waves: list of 1D waves (tensors or numpy arrays)
+
+    Returns:
+        one embedding per wave on the cpu, in the order of the waves
+    """
+    embeddings = [None] * len(waves)
+    order = sorted(range(len(waves)), key=lambda index: len(waves[index]))
+    for batch_start in tqdm(range(0, len(order), batch_size), disable=not show_progress):
+        batch_indexes = order[batch_start:batch_start + batch_size]
+        batch = pad_sequence([torch.as_tensor(waves[index], dtype=torch.float32) for index in batch_indexes], batch_first=True)
+        wav_lens = torch.tensor([len(waves[index]) for index in batch_indexes], dtype=torch.float32) / batch.size(1)
+        batch_embeddings = encoder.encode_batch(wavs=batch.to(device), wav_lens=wav_lens.to(device))
+        for index, embedding in zip(batch_indexes, batch_embeddings.view(len(batch_indexes), -1).cpu()):
+            embeddings[index] = embedding
+    return embeddings
+
 
 if __name__ == '__main__':
     wave, sr = sf.read("./audios/Versuch.wav")
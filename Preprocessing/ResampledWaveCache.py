@@ -0,0 +1,171 @@
+"""
+Training the vocoder on a new random subset of the corpora in every run means
+reading and resampling mostly the same files over and over again. This cache
+keeps every file once, already resampled to the sampling rate the vocoder
+needs, as int16 in a .npy file. The cache file of a wave is addressed by the
+path, the modification time and the size of the original file together with
+the target sampling rate, so a changed file is resampled again. Later runs
+only memory-map the cache files. If the cache grows larger than its size cap,
+the least recently used files are evicted.
+
+To fill the cache before training:
+
+    python -m Preprocessing.ResampledWaveCache --file_lists libritts vctk --sampling_rate 48000
+"""
+
+import argparse
+import hashlib
+import os
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+import torch.multiprocessing
+from tqdm import tqdm
+
+INT16_SCALE = 32767
+
+
+class ResampledWaveCache:
+
+    def __init__(self, cache_dir, max_size_in_gb=None):
+        """
+        Args:
+            cache_dir: directory the cache files are written to
+            max_size_in_gb: when the cache files take up more space than this, the least recently used ones are deleted. None means no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_size_in_bytes = None if max_size_in_gb is None else int(max_size_in_gb * 1e9)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = None  # path of every cache file -> (size, last access), only scanned once it's needed for an eviction
+
+    def path_for(self, path, sampling_rate):
+        stat = os.stat(path)
+        key = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{sampling_rate}".encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def load(self, paths, sampling_rate, loading_processes=1):
+        """
+        Memory-maps the resampled waves of the paths. The ones that are not in the cache yet are resampled and added first.
+
+        Returns:
+            one int16 array per path, in the same order. Use to_float_tensor to turn (parts of) them into audio
+        """
+        waves = list()
+        for cache_path in self.fill(paths, sampling_rate, loading_processes=loading_processes):
+            waves.append(np.load(cache_path, mmap_mode="r"))
+            os.utime(cache_path)  # the access time is what the eviction goes by
+            if self._index is not None:
+                self._index[cache_path] = (os.path.getsize(cache_path), os.path.getmtime(cache_path))
+        self.evict()
+        return waves
+
+    def fill(self, paths, sampling_rate, loading_processes=1):
+        """
+        Resamples the waves of the paths that are not in the cache yet and returns the paths of the cache files of all of them.
+        """
+        cache_paths = [self.path_for(path, sampling_rate) for path in paths]
+        jobs = [(path, cache_path, sampling_rate) for path, cache_path in zip(paths, cache_paths) if not os.path.exists(cache_path)]
+        if len(jobs) > 0:
+            print(f"Resampling {len(jobs)} of {len(paths)} files that are not cached yet...")
+            if loading_processes == 1:
+                for job in tqdm(jobs):
+                    cache_resampled_wave(job)
+            else:
+                with torch.multiprocessing.Pool(processes=loading_processes) as pool:
+                    for _ in tqdm(pool.imap_unordered(cache_resampled_wave, jobs, chunksize=max(1, len(jobs) // (loading_processes * 4))), total=len(jobs)):
+                        pass
+            if self._index is not None:
+                for _, cache_path, _ in jobs:
+                    self._index[cache_path] = (os.path.getsize(cache_path), os.path.getmtime(cache_path))
+        return cache_paths
+
+    def evict(self):
+        """
+        deletes the least recently used cache files until the cache fits into its size cap again
+        """
+        if self.max_size_in_bytes is None:
+            return
+        if self._index is None:
+            self._index = dict()
+            for directory, _, files in os.walk(self.cache_dir):
+                for file in files:
+                    if file.endswith(".npy"):
+                        stat = os.stat(os.path.join(directory, file))
+                        self._index[os.path.join(directory, file)] = (stat.st_size, stat.st_mtime)
+        total_size = sum(size for size, _ in self._index.values())
+        if total_size <= self.max_size_in_bytes:
+            return
+        evicted = 0
+        for cache_path in sorted(self._index, key=lambda cache_path: self._index[cache_path][1]):
+            if total_size <= self.max_size_in_bytes:
+                break
+            # arrays that are memory-mapped right now stay valid, the file is only really gone once they are closed
+            try:
+                os.remove(cache_path)
+            except FileNotFoundError:
+                pass
+            total_size -= self._index.pop(cache_path)[0]
+            evicted += 1
+        print(f"Evicted {evicted} files from the resampled wave cache to stay below {self.max_size_in_bytes / 1e9} GB.")
+
+
+def cache_resampled_wave(job):
+    path, cache_path, sampling_rate = job
+    if os.path.exists(cache_path):
+        return cache_path
+    wave, sr = sf.read(path)
+    if sr != sampling_rate:
+        wave = librosa.resample(y=wave, orig_sr=sr, target_sr=sampling_rate)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # the suffix is kept, otherwise np.save would append another .npy to the temporary file
+    np.save(cache_path + f".{os.getpid()}.tmp.npy", np.round(np.clip(wave, -1.0, 1.0) * INT16_SCALE).astype(np.int16))
+    os.replace(cache_path + f".{os.getpid()}.tmp.npy", cache_path)
+    return cache_path
+
+
+def to_float_tensor(wave):
+    """
+    turns a cached int16 wave (or a part of it) back into audio
+    """
+    return torch.from_numpy(np.asarray(wave, dtype=np.float32) / INT16_SCALE)
+
+
+if __name__ == '__main__':
+    import Utility.file_lists
+
+    parser = argparse.ArgumentParser(description='IMS Speech Synthesis Toolkit - Fill the Resampled Wave Cache')
+
+    parser.add_argument('--file_lists',
+                        nargs="+",
+                        help="Names of the corpora in Utility/file_lists.py, e.g. libritts for get_file_list_libritts.",
+                        required=True)
+
+    parser.add_argument('--sampling_rate',
+                        type=int,
+                        help="Sampling rate the waves are resampled to.",
+                        default=48000)
+
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        help="Directory of the cache.",
+                        default="Corpora/ResampledWaveCache")
+
+    parser.add_argument('--max_size_in_gb',
+                        type=float,
+                        help="Size cap of the cache, the least recently used files are evicted beyond it.",
+                        default=None)
+
+    parser.add_argument('--loading_processes',
+                        type=int,
+                        help="How many processes resample in parallel.",
+                        default=40)
+
+    args = parser.parse_args()
+
+    cache = ResampledWaveCache(cache_dir=args.cache_dir, max_size_in_gb=args.max_size_in_gb)
+    for file_list_name in args.file_lists:
+        print(f"Warming up the cache for {file_list_name}")
+        cache.fill(getattr(Utility.file_lists, f"get_file_list_{file_list_name}")(), sampling_rate=args.sampling_rate, loading_processes=args.loading_processes)
+        cache.evict()
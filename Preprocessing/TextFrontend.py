@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 
+import hashlib
 import re
 import sys
 import os
+import numpy
 import torch
 import phonemizer
 from phonemizer.backend import EspeakBackend
@@ -13,7 +15,10 @@ from pypinyin import pinyin
 
 from Preprocessing.articulatory_features import generate_feature_table
 from Preprocessing.articulatory_features import get_phone_to_id
+from Preprocessing.OrderedReplacer import OrderedReplacer
+from Preprocessing.PhonemizationCache import get_phonemization_cache
 
+TEXT_FRONTEND_VERSION = 1  # increase this whenever the phone strings change (cleaning, replacement rules, phonemizer settings), so cached ones are phonemized again
 
 
 class ArticulatoryCombinedTextFrontend:
@@ -25,21 +30,29 @@ class ArticulatoryCombinedTextFrontend:
                  silent=True,
                  allow_unknown=False,
                  add_silence_to_end=True,
-                 path_to_sampa_mapping_list="Preprocessing/sampa_to_ipa_punct.txt"):
+                 path_to_sampa_mapping_list="Preprocessing/sampa_to_ipa_punct.txt",
+                 use_phonemization_cache=True,
+                 path_to_phonemization_cache=None):
         """
         Mostly preparing ID lookups
+
+        use_phonemization_cache: whether finished phone strings are cached, so the same sentence is only phonemized once per process
+        path_to_phonemization_cache: optional sqlite file to persist the phonemization cache across processes
         """
         self.allow_unknown = allow_unknown
         self.use_explicit_eos = use_explicit_eos
         self.use_stress = use_lexical_stress
         self.add_silence_to_end = add_silence_to_end
         self.sampa_to_ipa_dict = dict()
+        self.phonemization_cache = get_phonemization_cache(path_to_db=path_to_phonemization_cache) if use_phonemization_cache else None
         
         #FestivalBackend.set_executable("/data/vokquant/CSTR-HTSVoice-Library-ver0.99/festival/bin/festival")
         FestivalBackend.set_festival_path("/data/vokquant/CSTR-HTSVoice-Library-ver0.99/festival/bin/festival")
 
         with open(path_to_sampa_mapping_list, "r", encoding='utf8') as f:
             sampa_to_ipa = f.read()
+        # the mapping changes the phone strings of at and vd, so cached ones must not be served for an edited mapping
+        self.sampa_mapping_hash = hashlib.sha1(sampa_to_ipa.encode("utf8")).hexdigest()
         sampa_to_ipa_list = sampa_to_ipa.split("\n")
         for pair in sampa_to_ipa_list:
             if pair.strip() != "":
@@ -193,6 +206,28 @@ class ArticulatoryCombinedTextFrontend:
         self.phone_to_id = get_phone_to_id()
         self.id_to_phone = {v: k for k, v in self.phone_to_id.items()}
 
+        # dense lookups, so that string_to_tensor can encode an utterance with a single gather instead of phone by phone
+        self.feature_table = torch.Tensor(list(self.phone_to_vector.values()))
+        highest_codepoint = max(ord(symbol) for symbol in list(self.phone_to_vector) + list(MODIFIER_TO_FEATURE))
+        self.codepoint_to_row = numpy.full(highest_codepoint + 1, -1, dtype=numpy.int64)
+        for row, phone in enumerate(self.phone_to_vector):
+            self.codepoint_to_row[ord(phone)] = row
+        self.codepoint_to_modifier = numpy.full(highest_codepoint + 1, -1, dtype=numpy.int64)
+        for modifier, feature in MODIFIER_TO_FEATURE.items():
+            self.codepoint_to_modifier[ord(modifier)] = feature
+
+        # reverse index from the articulatory features (without the modifiers) to the phone ids the aligner works with
+        self.features_to_id = dict()
+        for phone, vector in self.phone_to_vector.items():
+            if phone in self.phone_to_id:
+                self.features_to_id.setdefault(numpy.array(vector[11:], dtype=numpy.int8).tobytes(), self.phone_to_id[phone])
+
+        # the normalization of the phonemizer output is compiled once here instead of applying the long lists of replacements one after the other for every sentence
+        replacements = REPLACEMENTS + [(char, "") for char in sorted(UNSUPPORTED_IPA_CHARACTERS)]
+        self.replace_for_feature_extraction = OrderedReplacer(replacements)
+        self.replace_for_segmental_units = OrderedReplacer(replacements + SUPRASEGMENTAL_REPLACEMENTS)
+        self.replace_sampa_with_ipa = OrderedReplacer(SAMPA_TO_IPA_REPLACEMENTS)
+
     def string_to_tensor(self, text, view=False, device="cpu", handle_missing=True, input_phonemes=False, path_to_wavfile="", write_to_file=False):
         """
         Fixes unicode errors, expands some abbreviations,
@@ -222,69 +257,47 @@ class ArticulatoryCombinedTextFrontend:
             text_file.close()
 
             
-        phones_vector = list()
         # turn into numeric vectors
-        stressed_flag = False
-
-        for char in phones:
-            if char == '\u02C8':
-                # primary stress
-                # affects following phoneme
-                stressed_flag = True
-            elif char == '\u02D0':
-                # lengthened
-                # affects previous phoneme
-                phones_vector[-1][8] = 1
-            elif char == '\u02D1':
-                # half length
-                # affects previous phoneme
-                phones_vector[-1][9] = 1
-            elif char == '\u0306':
-                # shortened
-                # affects previous phoneme
-                phones_vector[-1][10] = 1
-            elif char == "˥":
-                # very high tone
-                # affects previous phoneme
-                phones_vector[-1][1] = 1
-            elif char == "˦":
-                # high tone
-                # affects previous phoneme
-                phones_vector[-1][2] = 1
-            elif char == "˧":
-                # mid tone
-                # affects previous phoneme
-                phones_vector[-1][3] = 1
-            elif char == "˨":
-                # low tone
-                # affects previous phoneme
-                phones_vector[-1][4] = 1
-            elif char == "˩":
-                # very low tone
-                # affects previous phoneme
-                phones_vector[-1][5] = 1
-            elif char == '\u030C':
-                # rising tone
-                # affects previous phoneme
-                phones_vector[-1][6] = 1
-            elif char == '\u0302':
-                # falling tone
-                # affects previous phoneme
-                phones_vector[-1][7] = 1
-            else:
-                if handle_missing:
-                    try:
-                        phones_vector.append(self.phone_to_vector[char].copy())
-                    except KeyError:
-                        print("unknown phoneme: {}".format(char))
-                else:
-                    phones_vector.append(self.phone_to_vector[char].copy())  # leave error handling to elsewhere
-
-                if stressed_flag:
-                    stressed_flag = False
-                    phones_vector[-1][0] = 1
-
-        return torch.Tensor(phones_vector, device=device)
+        codepoints = numpy.frombuffer(phones.encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.int64)
+        codepoints[codepoints >= len(self.codepoint_to_row)] = 0  # nothing is assigned to codepoint 0, so it counts as unknown
+        rows = self.codepoint_to_row[codepoints]
+        modifiers = self.codepoint_to_modifier[codepoints]
+
+        unknown = (rows == -1) & (modifiers == -1)
+        if unknown.any():
+            if not handle_missing:
+                raise KeyError(phones[numpy.flatnonzero(unknown)[0]])  # leave error handling to elsewhere
+            for position in numpy.flatnonzero(unknown):
+                print("unknown phoneme: {}".format(phones[position]))
+
+        is_phone = rows != -1
+        phone_index = numpy.cumsum(is_phone) - 1  # for every character, the index of the last phone up to it
+        # primary stress affects the following phoneme, all other modifiers (length and tone) affect the previous phoneme
+        is_stress = modifiers == MODIFIER_TO_FEATURE['\u02C8']
+        is_modifier = modifiers > MODIFIER_TO_FEATURE['\u02C8']
+        modified_phones = numpy.concatenate([phone_index[is_stress] + 1, phone_index[is_modifier]])
+        modified_features = numpy.concatenate([modifiers[is_stress], modifiers[is_modifier]])
+        applicable = (modified_phones >= 0) & (modified_phones < is_phone.sum())
+
+        phones_vector = self.feature_table[torch.from_numpy(rows[is_phone])]
+        phones_vector[torch.from_numpy(modified_phones[applicable]), torch.from_numpy(modified_features[applicable])] = 1
+        return phones_vector.to(device)
+
+    def text_vectors_to_id_sequence(self, text_vector):
+        """
+        Turns the articulatory vectors of an utterance back into the phone IDs that
+        the aligner needs for the CTC loss and the pathfinding. Word boundaries are
+        skipped, since they are not always present in audio. The first 11 dimensions
+        are modifiers, so they are ignored when looking up the phone.
+        """
+        features = text_vector.detach().cpu().numpy()
+        features = features[features[:, 19] == 0][:, 11:].astype(numpy.int8)
+        ids = list()
+        for row in features:
+            phone_id = self.features_to_id.get(row.tobytes())
+            if phone_id is not None:
+                ids.append(phone_id)
+        return torch.LongTensor(ids)
 
     def phonemize_from_labelfile(self, text, path_to_wavfile, include_eos_symbol=True):
         if os.path.exists(path_to_wavfile):
@@ -324,6 +337,17 @@ class ArticulatoryCombinedTextFrontend:
                 .replace("\t", " ").replace("¡", "").replace("¿", "").replace(",", "~")
 
     def get_phone_string(self, text, include_eos_symbol=True, for_feature_extraction=False, for_plot_labels=False, path_to_wavfile=""):
+        if self.phonemization_cache is None or self.g2p_lang == "at-lab":
+            # the labels are read from files, there is no expensive phonemizer call to save
+            return self._get_phone_string(text, include_eos_symbol, for_feature_extraction, for_plot_labels, path_to_wavfile)
+        key = (TEXT_FRONTEND_VERSION, self.sampa_mapping_hash, self.g2p_lang, text, include_eos_symbol, for_feature_extraction, for_plot_labels, self.add_silence_to_end, self.use_stress)
+        phones = self.phonemization_cache.get(key)
+        if phones is None:
+            phones = self._get_phone_string(text, include_eos_symbol, for_feature_extraction, for_plot_labels, path_to_wavfile)
+            self.phonemization_cache.put(key, phones)
+        return phones
+
+    def _get_phone_string(self, text, include_eos_symbol, for_feature_extraction, for_plot_labels, path_to_wavfile):
         # expand abbreviations
         #print("get_phone_string 'text': \n"+ text)
         utt = self.expand_abbreviations(text)
@@ -371,267 +395,13 @@ class ArticulatoryCombinedTextFrontend:
             phones = phones.replace('5', "˧\u030C")
             phones = phones.replace('6', "˧\u0302")
             phones = phones.replace('7', "˧")
-        replacements = [
-            # punctuation in languages with non-latin script
-            ("。", "."),
-            ("【", '"'),
-            ("】", '"'),
-            ("、", ","),
-            ("‥", "…"),
-            ("؟", "?"),
-            ("،", ","),
-            ("“", '"'),
-            ("”", '"'),
-            ("؛", ","),
-            # latin script punctuation
-            ("/", " "),
-            ("—", ""),
-            ("...", "…"),
-            #("\n", " "),
-            ("\t", " "),
-            ("¡", ""),
-            ("¿", ""),
-            # unifying some phoneme representations
-            ("ɫ", "l"),  # alveolopalatal
-            ("ɚ", "ə"),
-            ('ᵻ', 'ɨ'),
-            ("ɧ", "ç"),  # velopalatal
-            ("ɥ", "j"),  # labiopalatal
-            ("ɬ", "s"),  # lateral
-            ("ɮ", "z"),  # lateral
-            ('ɺ', 'ɾ'),  # lateral
-            ('\u02CC', ""),  # secondary stress
-            ('\u030B', "˥"),
-            ('\u0301', "˦"),
-            ('\u0304', "˧"),
-            ('\u0300', "˨"),
-            ('\u030F', "˩"),
-            # symbols that indicate a pause or silence
-            ('"', "~"),
-            ("-", "~"),
-            ("-", "~"),
-            ("…", "."),
-            (":", "~"),
-            (";", "~"),
-            (",", "~")  # make sure this remains the final one when adding new ones
-        ]
-        replacements_sampa_to_ipa = [
-            # Lorenz sampa to IPA
-            ('schwa_',"ə"),
-            ('gsth_',"ɡ"),
-            ('bsth_',"b"),
-            ('dsth_',"d"),
-            ('P2h6_',"øːɐ"),
-            ('P9hn_',"œːn"),
-            ('P9P2_',"œø"),
-            ('P3hn_',"ɛː"),
-            ('sil_',"~"),
-            ('aAN_',"aɑ"),
-            ('aeN_',"aeŋ"),
-            ('aen_',"aen"),
-            ('Ah6_',"ɑːɐ"),
-            ('ah6_',"aɐː"),
-            ('Ahn_',"ɑːn"),
-            ('AhN_',"ɑːŋ"),
-            ('ahn_',"aːn"),
-            ('ahN_',"aːŋ"),
-            ('aO1_',"aɔɶ"),
-            ('ao1_',"aoɶ"),
-            ('aoN_',"aoŋ"),
-            ('yh6_',"ʏːɐ"),
-            ('yP6_',"ʏɐ"),
-            ('UP6_',"ʊɐ"),
-            ('uP6_',"uɐ"),
-            ('EP6_',"e"),
-            ('eP6_',"eɐ"),
-            ('EeN_',"ɛeŋ"),
-            ('Eh6_',"ɛːn"),
-            ('Ehn_',"ɛːn"),
-            ('EhN_',"ɛːŋ"),
-            ('ih6_',"iːɐ"),
-            ('ihn_',"iːn"),
-            ('ihN_',"iːŋ"),
-            ('kch_',"kx"),
-            ('e~:_',"eː"),
-            ('iP6_',"iɐ"),
-            ('oaN_',"oaŋ"),
-            ('OaN_',"ɔaŋ"),
-            ('Oan_',"ɔan"),
-            ('oan_',"oan"),
-            ('Oh6_',"ɔːɐ"),
-            ('oh6_',"oːɐ"),
-            ('Ohn_',"ɔːn"),
-            ('ohn_',"oːn"),
-            ('P6N_',"ɐŋ"),
-            ('P6n_',"ɐn"),
-            ('P6O_',"ɐɔ"),
-            ('P6U_',"ɐʊ"),
-            ('P96_',"œɐ"),
-            ('P9e_',"œe"),
-            ('P9h_',"œː"),
-            ('pau_',"~"),
-            ('OP6_',"ɔɐ"),
-            ('P1h_',"ɶ"),
-            ('P2h_',"øː"),
-            ('P3h_',"ɛː"),
-            ('P1:_',"ɶ"),
-            ('uh6_',"uːɐ"),
-            ('Uh6_',"ʊːɐ"),
-            ('A6_',"ɑɐ"),
-            ('a6_',"aɐ"),
-            ('aA_',"aɑ"),
-            ('ae_',"ae"),
-            ('aE_',"aɛ"),
-            ('ah_',"aː"),
-            ('Ah_',"ɑː"),
-            ('AI_',"ɑɪ"),
-            ('aI_',"aɪ"),
-            ('AN_',"ɑŋ"),
-            ('aN_',"aŋ"),
-            ('An_',"ɑn"),
-            ('an_',"an"),
-            ('ao_',"ao"),
-            ('aO_',"aɔ"),
-            ('aU_',"aʊ"),
-            ('Y6_',"ʏɐ"),
-            ('yh_',"ʏː"),
-            ('bf_',"bf"),
-            ('ch_',"x"),
-            ('dF_',"d"),
-            ('E6_',"ɛɐ"),
-            ('ea_',"ea"),
-            ('Ea_',"ɛa"),
-            ('eE_',"eɛ"),
-            ('Ee_',"ɛe"),
-            ('eh_',"eː"),
-            ('Eh_',"ɛː"),
-            ('Ei_',"ɛi"),
-            ('EN_',"ɛŋ"),
-            ('En_',"ɛn"),
-            ('GS_',"ʔ"),
-            ('I6_',"ɪɐ"),
-            ('i6_',"iɐ"),
-            ('iE_',"iɛ"),
-            ('ih_',"iː"),
-            ('Ii_',"ɪi"),
-            ('iN_',"iŋ"),
-            ('in_',"in"),
-            ('iV_',"i"),
-            ('kH_',"kɥ"),
-            ('ks_',"ks"),
-            ('ll_',"ɭ"),
-            ('ml_',"mɭ"),
-            ('Nl_',"ŋɭ"),
-            ('nl_',"nɭ"),
-            ('O6_',"ɔɐ"),
-            ('Oa_',"ɔ"),
-            ('oa_',"o"),
-            ('Oe_',"ɔe"),
-            ('OE_',"ɔɛ"),
-            ('oe_',"oe"),
-            ('Oh_',"ɔː"),
-            ('oh_',"oː"),
-            ('oI_',"oɪ"),
-            ('oi_',"oi"),
-            ('ON_',"ɔŋ"),
-            ('On_',"ɔn"),
-            ('Oo_',"ɔo"),
-            ('OU_',"ɔʊ"),
-            ('OY_',"ɔʏ"),
-            ('P2_',"ø"),
-            ('P6_',"ɐ"),
-            ('P9_',"œ"),
-            ('pH_',"pɥ"),
-            ('Qh_',"ɒː"),
-            ('RX_',"ʀχ"),
-            ('sh_',"sː"),
-            ('tH_',"tɥ"),
-            ('tS_',"tʃ"),
-            ('ts_',"ts"),
-            ('U6_',"ʊɐ"),
-            ('ua_',"u"),
-            ('ue_',"u"),
-            ('uh_',"uː"),
-            ('Ui_',"ʊi"),
-            ('ui_',"ui"),
-            ('uI_',"uɪ"),
-            ('uN_',"uŋ"),
-            ('Uu_',"ʊu"),
-            ('a_',"a"),
-            ('B_',"β"),
-            ('b_',"b"),
-            ('E_',"ɛ"),
-            ('C_',"ç"),
-            ('D_',"ð"),
-            ('d_',"d"),
-            ('e_',"e"),
-            ('f_',"f"),
-            ('G_',"ɣ"),
-            ('g_',"ɡ"),
-            ('h_',"h"),
-            ('I_',"ɪ"),
-            ('i_',"i"),
-            ('j_',"j"),
-            ('k_',"k"),
-            ('L_',"ʎ"),
-            ('l_',"l"),
-            ('m_',"m"),
-            ('N_',"ŋ"),
-            ('n_',"n"),
-            ('O_',"ɔ"),
-            ('o_',"o"),
-            ('p_',"p"),
-            ('R_',"ʀ"),
-            ('r_',"r"),
-            ('S_',"ʃ"),
-            ('s_',"s"),
-            ('t_',"t"),
-            ('U_',"ʊ"),
-            ('u_',"u"),
-            ('v_',"v"),
-            ('Y_',"ʏ"),
-            ('y_',"y"),
-            ('Z_',"ʒ"),
-            ('z_',"z")
-        ]
-
-        unsupported_ipa_characters = {'̹', '̙', '̞', '̯', '̤', '̪', '̩', '̠', '̟', 'ꜜ',
-                                      '̃', '̬', '̽', 'ʰ', '|', '̝', '•', 'ˠ', '↘',
-                                      '‖', '̰', '‿', 'ᷝ', '̈', 'ᷠ', '̜', 'ʷ', 'ʲ',
-                                      '̚', '↗', 'ꜛ', '̻', '̥', 'ˁ', '̘', '͡', '̺'}
-        for char in unsupported_ipa_characters:
-            replacements.append((char, ""))
-
-        if not for_feature_extraction:
-            # in case we want to plot etc., we only need the segmental units, so we remove everything else.
-            replacements = replacements + [
-                ('\u02C8', ""),  # primary stress
-                ('\u02D0', ""),  # lengthened
-                ('\u02D1', ""),  # half length
-                ('\u0306', ""),  # shortened
-                ("˥", ""),  # very high tone
-                ("˦", ""),  # high tone
-                ("˧", ""),  # mid tone
-                ("˨", ""),  # low tone
-                ("˩", ""),  # very low tone
-                ('\u030C', ""),  # rising tone
-                ('\u0302', "")  # falling tone
-            ]
-        #for replacement in replacements:
-        #    phones = phones.replace(replacement[0], replacement[1])
         print(self.g2p_lang)
-        if self.g2p_lang == "at-lab":
-            for replacement in replacements:
-                phones = phones.replace(replacement[0], replacement[1])
-        elif self.g2p_lang=="at" or self.g2p_lang=="vd":
-
-            for replacement in replacements:
-                phones = phones.replace(replacement[0], replacement[1])
-            for replacement_sampaipa in replacements_sampa_to_ipa:
-                phones = phones.replace(replacement_sampaipa[0], replacement_sampaipa[1])
+        if for_feature_extraction:
+            phones = self.replace_for_feature_extraction(phones)
         else:
-            for replacement in replacements:
-                phones = phones.replace(replacement[0], replacement[1])
+            phones = self.replace_for_segmental_units(phones)
+        if self.g2p_lang == "at" or self.g2p_lang == "vd":
+            phones = self.replace_sampa_with_ipa(phones)
         
         phones = re.sub("~+", "~", phones)
         phones = re.sub(r"\s+", " ", phones)
@@ -741,3 +511,263 @@ if __name__ == '__main__':
     #tf = ArticulatoryCombinedTextFrontend(language="vi")
     #tf.string_to_tensor("Xin chào thế giới, quả là một ngày tốt lành để học nói tiếng Việt!", view=True)
     #tf.string_to_tensor("ba bà bá bạ bả bã", view=True)
+
+
+# the modifiers in the phone strings and the index of the articulatory feature they set
+MODIFIER_TO_FEATURE = {
+    '\u02C8': 0,  # primary stress
+    '\u02D0': 8,  # lengthened
+    '\u02D1': 9,  # half length
+    '\u0306': 10,  # shortened
+    "˥"     : 1,  # very high tone
+    "˦"     : 2,  # high tone
+    "˧"     : 3,  # mid tone
+    "˨"     : 4,  # low tone
+    "˩"     : 5,  # very low tone
+    '\u030C': 6,  # rising tone
+    '\u0302': 7  # falling tone
+}
+
+REPLACEMENTS = [
+    # punctuation in languages with non-latin script
+    ("。", "."),
+    ("【", '"'),
+    ("】", '"'),
+    ("、", ","),
+    ("‥", "…"),
+    ("؟", "?"),
+    ("،", ","),
+    ("“", '"'),
+    ("”", '"'),
+    ("؛", ","),
+    # latin script punctuation
+    ("/", " "),
+    ("—", ""),
+    ("...", "…"),
+    #("\n", " "),
+    ("\t", " "),
+    ("¡", ""),
+    ("¿", ""),
+    # unifying some phoneme representations
+    ("ɫ", "l"),  # alveolopalatal
+    ("ɚ", "ə"),
+    ('ᵻ', 'ɨ'),
+    ("ɧ", "ç"),  # velopalatal
+    ("ɥ", "j"),  # labiopalatal
+    ("ɬ", "s"),  # lateral
+    ("ɮ", "z"),  # lateral
+    ('ɺ', 'ɾ'),  # lateral
+    ('\u02CC', ""),  # secondary stress
+    ('\u030B', "˥"),
+    ('\u0301', "˦"),
+    ('\u0304', "˧"),
+    ('\u0300', "˨"),
+    ('\u030F', "˩"),
+    # symbols that indicate a pause or silence
+    ('"', "~"),
+    ("-", "~"),
+    ("-", "~"),
+    ("…", "."),
+    (":", "~"),
+    (";", "~"),
+    (",", "~")  # make sure this remains the final one when adding new ones
+]
+SAMPA_TO_IPA_REPLACEMENTS = [
+    # Lorenz sampa to IPA
+    ('schwa_',"ə"),
+    ('gsth_',"ɡ"),
+    ('bsth_',"b"),
+    ('dsth_',"d"),
+    ('P2h6_',"øːɐ"),
+    ('P9hn_',"œːn"),
+    ('P9P2_',"œø"),
+    ('P3hn_',"ɛː"),
+    ('sil_',"~"),
+    ('aAN_',"aɑ"),
+    ('aeN_',"aeŋ"),
+    ('aen_',"aen"),
+    ('Ah6_',"ɑːɐ"),
+    ('ah6_',"aɐː"),
+    ('Ahn_',"ɑːn"),
+    ('AhN_',"ɑːŋ"),
+    ('ahn_',"aːn"),
+    ('ahN_',"aːŋ"),
+    ('aO1_',"aɔɶ"),
+    ('ao1_',"aoɶ"),
+    ('aoN_',"aoŋ"),
+    ('yh6_',"ʏːɐ"),
+    ('yP6_',"ʏɐ"),
+    ('UP6_',"ʊɐ"),
+    ('uP6_',"uɐ"),
+    ('EP6_',"e"),
+    ('eP6_',"eɐ"),
+    ('EeN_',"ɛeŋ"),
+    ('Eh6_',"ɛːn"),
+    ('Ehn_',"ɛːn"),
+    ('EhN_',"ɛːŋ"),
+    ('ih6_',"iːɐ"),
+    ('ihn_',"iːn"),
+    ('ihN_',"iːŋ"),
+    ('kch_',"kx"),
+    ('e~:_',"eː"),
+    ('iP6_',"iɐ"),
+    ('oaN_',"oaŋ"),
+    ('OaN_',"ɔaŋ"),
+    ('Oan_',"ɔan"),
+    ('oan_',"oan"),
+    ('Oh6_',"ɔːɐ"),
+    ('oh6_',"oːɐ"),
+    ('Ohn_',"ɔːn"),
+    ('ohn_',"oːn"),
+    ('P6N_',"ɐŋ"),
+    ('P6n_',"ɐn"),
+    ('P6O_',"ɐɔ"),
+    ('P6U_',"ɐʊ"),
+    ('P96_',"œɐ"),
+    ('P9e_',"œe"),
+    ('P9h_',"œː"),
+    ('pau_',"~"),
+    ('OP6_',"ɔɐ"),
+    ('P1h_',"ɶ"),
+    ('P2h_',"øː"),
+    ('P3h_',"ɛː"),
+    ('P1:_',"ɶ"),
+    ('uh6_',"uːɐ"),
+    ('Uh6_',"ʊːɐ"),
+    ('A6_',"ɑɐ"),
+    ('a6_',"aɐ"),
+    ('aA_',"aɑ"),
+    ('ae_',"ae"),
+    ('aE_',"aɛ"),
+    ('ah_',"aː"),
+    ('Ah_',"ɑː"),
+    ('AI_',"ɑɪ"),
+    ('aI_',"aɪ"),
+    ('AN_',"ɑŋ"),
+    ('aN_',"aŋ"),
+    ('An_',"ɑn"),
+    ('an_',"an"),
+    ('ao_',"ao"),
+    ('aO_',"aɔ"),
+    ('aU_',"aʊ"),
+    ('Y6_',"ʏɐ"),
+    ('yh_',"ʏː"),
+    ('bf_',"bf"),
+    ('ch_',"x"),
+    ('dF_',"d"),
+    ('E6_',"ɛɐ"),
+    ('ea_',"ea"),
+    ('Ea_',"ɛa"),
+    ('eE_',"eɛ"),
+    ('Ee_',"ɛe"),
+    ('eh_',"eː"),
+    ('Eh_',"ɛː"),
+    ('Ei_',"ɛi"),
+    ('EN_',"ɛŋ"),
+    ('En_',"ɛn"),
+    ('GS_',"ʔ"),
+    ('I6_',"ɪɐ"),
+    ('i6_',"iɐ"),
+    ('iE_',"iɛ"),
+    ('ih_',"iː"),
+    ('Ii_',"ɪi"),
+    ('iN_',"iŋ"),
+    ('in_',"in"),
+    ('iV_',"i"),
+    ('kH_',"kɥ"),
+    ('ks_',"ks"),
+    ('ll_',"ɭ"),
+    ('ml_',"mɭ"),
+    ('Nl_',"ŋɭ"),
+    ('nl_',"nɭ"),
+    ('O6_',"ɔɐ"),
+    ('Oa_',"ɔ"),
+    ('oa_',"o"),
+    ('Oe_',"ɔe"),
+    ('OE_',"ɔɛ"),
+    ('oe_',"oe"),
+    ('Oh_',"ɔː"),
+    ('oh_',"oː"),
+    ('oI_',"oɪ"),
+    ('oi_',"oi"),
+    ('ON_',"ɔŋ"),
+    ('On_',"ɔn"),
+    ('Oo_',"ɔo"),
+    ('OU_',"ɔʊ"),
+    ('OY_',"ɔʏ"),
+    ('P2_',"ø"),
+    ('P6_',"ɐ"),
+    ('P9_',"œ"),
+    ('pH_',"pɥ"),
+    ('Qh_',"ɒː"),
+    ('RX_',"ʀχ"),
+    ('sh_',"sː"),
+    ('tH_',"tɥ"),
+    ('tS_',"tʃ"),
+    ('ts_',"ts"),
+    ('U6_',"ʊɐ"),
+    ('ua_',"u"),
+    ('ue_',"u"),
+    ('uh_',"uː"),
+    ('Ui_',"ʊi"),
+    ('ui_',"ui"),
+    ('uI_',"uɪ"),
+    ('uN_',"uŋ"),
+    ('Uu_',"ʊu"),
+    ('a_',"a"),
+    ('B_',"β"),
+    ('b_',"b"),
+    ('E_',"ɛ"),
+    ('C_',"ç"),
+    ('D_',"ð"),
+    ('d_',"d"),
+    ('e_',"e"),
+    ('f_',"f"),
+    ('G_',"ɣ"),
+    ('g_',"ɡ"),
+    ('h_',"h"),
+    ('I_',"ɪ"),
+    ('i_',"i"),
+    ('j_',"j"),
+    ('k_',"k"),
+    ('L_',"ʎ"),
+    ('l_',"l"),
+    ('m_',"m"),
+    ('N_',"ŋ"),
+    ('n_',"n"),
+    ('O_',"ɔ"),
+    ('o_',"o"),
+    ('p_',"p"),
+    ('R_',"ʀ"),
+    ('r_',"r"),
+    ('S_',"ʃ"),
+    ('s_',"s"),
+    ('t_',"t"),
+    ('U_',"ʊ"),
+    ('u_',"u"),
+    ('v_',"v"),
+    ('Y_',"ʏ"),
+    ('y_',"y"),
+    ('Z_',"ʒ"),
+    ('z_',"z")
+]
+
+UNSUPPORTED_IPA_CHARACTERS = {'̹', '̙', '̞', '̯', '̤', '̪', '̩', '̠', '̟', 'ꜜ',
+                              '̃', '̬', '̽', 'ʰ', '|', '̝', '•', 'ˠ', '↘',
+                              '‖', '̰', '‿', 'ᷝ', '̈', 'ᷠ', '̜', 'ʷ', 'ʲ',
+                              '̚', '↗', 'ꜛ', '̻', '̥', 'ˁ', '̘', '͡', '̺'}
+
+# in case we want to plot etc., we only need the segmental units, so we remove everything else.
+SUPRASEGMENTAL_REPLACEMENTS = [
+    ('\u02C8', ""),  # primary stress
+    ('\u02D0', ""),  # lengthened
+    ('\u02D1', ""),  # half length
+    ('\u0306', ""),  # shortened
+    ("˥", ""),  # very high tone
+    ("˦", ""),  # high tone
+    ("˧", ""),  # mid tone
+    ("˨", ""),  # low tone
+    ("˩", ""),  # very low tone
+    ('\u030C', ""),  # rising tone
+    ('\u0302', "")  # falling tone
+]
@@ -0,0 +1,151 @@
+"""
+Compares the vectorized to_adj_matrix of the Aligner with the double loop
+it replaced, on random matrices of many shapes, including single rows and
+single columns, and the numba monotonic alignment search with the pure python
+version it replaced, which has to give bit-identical results.
+
+    python -m pytest Tests/test_aligner.py
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import binarize_alignment
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import binarize_alignment_batch
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import to_adj_matrix
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import to_node_index
+
+
+def to_adj_matrix_with_loops(mat):
+    # the implementation before the vectorization, kept here as the reference
+    rows = mat.shape[0]
+    cols = mat.shape[1]
+
+    row_ind = []
+    col_ind = []
+    data = []
+
+    for i in range(rows):
+        for j in range(cols):
+
+            node = to_node_index(i, j, cols)
+
+            if j < cols - 1:
+                right_node = to_node_index(i, j + 1, cols)
+                weight_right = mat[i, j + 1]
+                row_ind.append(node)
+                col_ind.append(right_node)
+                data.append(weight_right)
+
+            if i < rows - 1 and j < cols:
+                bottom_node = to_node_index(i + 1, j, cols)
+                weight_bottom = mat[i + 1, j]
+                row_ind.append(node)
+                col_ind.append(bottom_node)
+                data.append(weight_bottom)
+
+            if i < rows - 1 and j < cols - 1:
+                bottom_right_node = to_node_index(i + 1, j + 1, cols)
+                weight_bottom_right = mat[i + 1, j + 1]
+                row_ind.append(node)
+                col_ind.append(bottom_right_node)
+                data.append(weight_bottom_right)
+
+    adj_mat = coo_matrix((data, (row_ind, col_ind)), shape=(rows * cols, rows * cols))
+    return adj_mat.tocsr()
+
+
+def binarize_alignment_in_python(alignment_prob):
+    # the implementation before numba, kept here as the reference
+    opt = np.zeros_like(alignment_prob)
+    alignment_prob = alignment_prob + (np.abs(alignment_prob).max() + 1.0)  # make all numbers positive and add an offset to avoid log of 0 later
+    attn_map = np.log(alignment_prob)
+    attn_map[0, 1:] = -np.inf
+    log_p = np.zeros_like(attn_map)
+    log_p[0, :] = attn_map[0, :]
+    prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    for i in range(1, attn_map.shape[0]):
+        for j in range(attn_map.shape[1]):  # for each text dim
+            prev_log = log_p[i - 1, j]
+            prev_j = j
+            if j - 1 >= 0 and log_p[i - 1, j - 1] >= log_p[i - 1, j]:
+                prev_log = log_p[i - 1, j - 1]
+                prev_j = j - 1
+            log_p[i, j] = attn_map[i, j] + prev_log
+            prev_ind[i, j] = prev_j
+    # now backtrack
+    curr_text_idx = attn_map.shape[1] - 1
+    for i in range(attn_map.shape[0] - 1, -1, -1):
+        opt[i, curr_text_idx] = 1
+        curr_text_idx = prev_ind[i, curr_text_idx]
+    opt[0, curr_text_idx] = 1
+    return opt
+
+
+def random_shapes(rng, amount):
+    shapes = [(1, 1), (1, 2), (2, 1), (1, 17), (17, 1), (1, 40), (120, 1), (2, 2), (3, 5), (5, 3)]
+    shapes += [(int(rng.integers(1, 120)), int(rng.integers(1, 40))) for _ in range(amount)]
+    return shapes
+
+
+def test_same_matrix_as_double_loop():
+    rng = np.random.default_rng(0)
+    for index, shape in enumerate(random_shapes(rng, amount=150)):
+        mat = (1.0 - rng.random(shape)).astype(np.float32 if index % 2 == 0 else np.float64)
+        if index % 3 == 0:
+            mat = np.round(mat, 1)  # ties between the paths
+        reference = to_adj_matrix_with_loops(mat)
+        vectorized = to_adj_matrix(mat)
+        assert vectorized.shape == reference.shape, shape
+        if reference.nnz > 0:
+            # without a single edge, the loops build the matrix from empty lists, which numpy makes float64
+            assert vectorized.dtype == reference.dtype, shape
+        assert np.array_equal(vectorized.indptr, reference.indptr), shape
+        assert np.array_equal(vectorized.indices, reference.indices), shape
+        assert np.array_equal(vectorized.data, reference.data), shape
+
+
+def test_same_shortest_path_as_double_loop():
+    rng = np.random.default_rng(1)
+    for shape in random_shapes(rng, amount=50):
+        if shape == (1, 1):
+            continue  # a single node has no path
+        mat = (1.0 - rng.random(shape)).astype(np.float32)
+        reference_distances, reference_predecessors = dijkstra(csgraph=to_adj_matrix_with_loops(mat), directed=True, indices=0, return_predecessors=True)
+        distances, predecessors = dijkstra(csgraph=to_adj_matrix(mat), directed=True, indices=0, return_predecessors=True)
+        assert np.array_equal(distances, reference_distances), shape
+        assert np.array_equal(predecessors, reference_predecessors), shape
+
+
+def test_alignment_search_identical_to_python():
+    rng = np.random.default_rng(2)
+    for index, shape in enumerate(random_shapes(rng, amount=200)):
+        alignment = rng.random(shape).astype(np.float32 if index % 2 == 0 else np.float64)
+        if index % 5 == 0:
+            alignment = np.round(alignment, 1)  # ties between the paths
+        reference = binarize_alignment_in_python(alignment.copy())
+        result = binarize_alignment(alignment.copy())
+        assert result.dtype == reference.dtype, shape
+        assert np.array_equal(result, reference), shape
+
+
+def test_batched_alignment_search_identical_to_python():
+    rng = np.random.default_rng(3)
+    for _ in range(10):
+        mel_lens = rng.integers(1, 150, 8)
+        text_lens = rng.integers(1, 40, 8)
+        alignments = rng.random((8, mel_lens.max(), text_lens.max())).astype(np.float32)
+        results = binarize_alignment_batch(alignments, mel_lens, text_lens)
+        for index in range(len(alignments)):
+            reference = binarize_alignment_in_python(alignments[index, :mel_lens[index], :text_lens[index]].copy())
+            assert np.array_equal(results[index, :mel_lens[index], :text_lens[index]], reference), index
+            assert results[index].sum() == reference.sum(), index  # nothing outside of the lengths
+
+
+if __name__ == '__main__':
+    test_same_matrix_as_double_loop()
+    test_same_shortest_path_as_double_loop()
+    test_alignment_search_identical_to_python()
+    test_batched_alignment_search_identical_to_python()
+    print("to_adj_matrix and the alignment search match the implementations they replaced.")
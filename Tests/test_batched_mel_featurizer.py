@@ -0,0 +1,57 @@
+"""
+Checks that the spectrograms of BatchedMelFeaturizer and of the torch backend
+batched_logmelfilterbank stay within a fixed tolerance of the librosa based
+AudioPreprocessor.logmelfilterbank, on fixed-seed audio.
+
+    python -m pytest Tests/test_batched_mel_featurizer.py
+"""
+
+import torch
+
+from Preprocessing.AudioPreprocessor import AudioPreprocessor
+from Preprocessing.AudioPreprocessor import batched_logmelfilterbank
+from Preprocessing.BatchedMelFeaturizer import BatchedMelFeaturizer
+
+# the spectrograms are log10 of the mel energies, so an absolute error of the log
+# is a relative error of the energies: 1e-4 corresponds to about 0.023%
+MAX_ABS_ERROR = 1e-4
+MAX_REL_ERROR = 10 ** MAX_ABS_ERROR - 1
+
+
+def random_audio(generator, length, amplitude=1.0):
+    return (torch.rand(length, generator=generator) - 0.5) * amplitude
+
+
+def assert_within_tolerance(reference, spec, what):
+    assert reference.shape == spec.shape, f"{what}: shape {tuple(spec.shape)} instead of {tuple(reference.shape)}"
+    max_abs_error = (reference - spec).abs().max().item()
+    max_rel_error = ((10 ** spec - 10 ** reference).abs() / 10 ** reference).max().item()
+    assert max_abs_error <= MAX_ABS_ERROR, f"{what}: max abs error of the log-mel spectrogram is {max_abs_error:.2e}"
+    assert max_rel_error <= MAX_REL_ERROR, f"{what}: max rel error of the mel energies is {max_rel_error:.2e}"
+
+
+def test_featurizer_matches_logmelfilterbank():
+    generator = torch.Generator().manual_seed(0)
+    ap = AudioPreprocessor(input_sr=48000, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False)
+    featurizer = BatchedMelFeaturizer()
+    # segments of different loudness, as HiFiGANDataset cuts them
+    segments = torch.stack([random_audio(generator, 24576, amplitude) for amplitude in torch.linspace(0.01, 1.0, 8).tolist()])
+    for index, (segment, spec) in enumerate(zip(segments, featurizer(segments))):
+        reference = ap.audio_to_mel_spec_tensor(ap.resample(segment), explicit_sampling_rate=16000, normalize=False)
+        assert_within_tolerance(reference, spec, f"segment {index}")
+
+
+def test_batched_logmelfilterbank_matches_logmelfilterbank():
+    generator = torch.Generator().manual_seed(1)
+    ap = AudioPreprocessor(input_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False)
+    # audios of different lengths in one batch, including one shorter than a second
+    audios = [random_audio(generator, length).numpy() for length in (16000, 23456, 40000, 1300)]
+    for index, (audio, spec) in enumerate(zip(audios, batched_logmelfilterbank(audios, 16000))):
+        reference = ap.logmelfilterbank(audio, sampling_rate=16000)
+        assert_within_tolerance(reference, spec, f"audio {index}")
+
+
+if __name__ == '__main__':
+    test_featurizer_matches_logmelfilterbank()
+    test_batched_logmelfilterbank_matches_logmelfilterbank()
+    print("The batched spectrograms are within the tolerance of logmelfilterbank.")
@@ -0,0 +1,91 @@
+"""
+Compares the OrderedReplacer with the str.replace loop it replaced, on the
+replacement lists of the TextFrontend. The corpus is made of the test
+sentences in Utility, phone strings that are generated from the
+replacement lists (with a fixed seed) and, if the environment variable
+PHONE_STRING_CORPUS points to a file, every line of that file, e.g. the
+output of a phonemizer for a whole dataset.
+
+    python -m pytest Tests/test_ordered_replacer.py
+"""
+
+import glob
+import os
+import random
+
+from Preprocessing.OrderedReplacer import OrderedReplacer
+from Preprocessing.TextFrontend import REPLACEMENTS
+from Preprocessing.TextFrontend import SAMPA_TO_IPA_REPLACEMENTS
+from Preprocessing.TextFrontend import SUPRASEGMENTAL_REPLACEMENTS
+from Preprocessing.TextFrontend import UNSUPPORTED_IPA_CHARACTERS
+
+GENERAL_REPLACEMENTS = REPLACEMENTS + [(char, "") for char in sorted(UNSUPPORTED_IPA_CHARACTERS)]
+REPLACEMENT_LISTS = {
+    "feature_extraction": GENERAL_REPLACEMENTS,
+    "segmental_units"   : GENERAL_REPLACEMENTS + SUPRASEGMENTAL_REPLACEMENTS,
+    "sampa_to_ipa"      : SAMPA_TO_IPA_REPLACEMENTS,
+    }
+
+
+def replace_one_after_the_other(text, replacements):
+    # the implementation get_phone_string used before the OrderedReplacer, kept here as the reference
+    for old, new in replacements:
+        text = text.replace(old, new)
+    return text
+
+
+def load_corpus():
+    corpus = list()
+    for path in sorted(glob.glob("Utility/*sentences*.txt")) + ([os.environ["PHONE_STRING_CORPUS"]] if "PHONE_STRING_CORPUS" in os.environ else []):
+        with open(path, "r", encoding="utf8") as file:
+            corpus.extend(line.rstrip("\n") for line in file)
+    return corpus
+
+
+def generate_phone_strings(replacements, amount, seed=0):
+    """
+    strings made of the patterns, their bodies without the separator and their replacements, with punctuation and spaces in between,
+    plus strings shaped like the festival output (whole tokens grouped into words)
+    """
+    rng = random.Random(seed)
+    pieces = [old for old, _ in replacements] + [old[:-1] for old, _ in replacements if len(old) > 1] + [new for _, new in replacements]
+    characters = sorted({char for old, new in replacements for char in old + new} | set("_ .,~?!abc"))
+    strings = list()
+    for _ in range(amount):
+        parts = list()
+        for _ in range(rng.randint(0, 30)):
+            choice = rng.random()
+            parts.append(rng.choice(pieces) if choice < 0.6 else rng.choice(characters) if choice < 0.9 else " ")
+        strings.append("".join(parts))
+        strings.append(" ".join("".join(rng.choice(replacements)[0] for _ in range(rng.randint(1, 8))) for _ in range(rng.randint(1, 10))))
+    return strings
+
+
+def assert_same_as_reference(replacements, texts):
+    replacer = OrderedReplacer(replacements)
+    for text in texts:
+        assert replacer(text) == replace_one_after_the_other(text, replacements), f"the OrderedReplacer differs from the str.replace loop on {text!r}"
+
+
+def test_corpus():
+    corpus = load_corpus()
+    assert len(corpus) > 0
+    for replacements in REPLACEMENT_LISTS.values():
+        assert_same_as_reference(replacements, corpus)
+
+
+def test_generated_phone_strings():
+    for index, replacements in enumerate(REPLACEMENT_LISTS.values()):
+        assert_same_as_reference(replacements, generate_phone_strings(replacements, amount=20000, seed=index))
+
+
+def test_cascading_festival_tokens():
+    # 'Ehn_' -> 'ɛːn' followed by 'l_' lets 'nl_' match before 'l_' gets its turn
+    assert_same_as_reference(SAMPA_TO_IPA_REPLACEMENTS, ["Ehn_l_", "a_Ehn_l_ t_", "Ehn__", "Ehn_l_ Ehn_l_"])
+
+
+if __name__ == '__main__':
+    test_corpus()
+    test_generated_phone_strings()
+    test_cascading_festival_tokens()
+    print("The OrderedReplacer matches the str.replace loop.")
@@ -5,9 +5,11 @@ import auraloss
 import torch
 import torch.multiprocessing
 from torch.optim.lr_scheduler import MultiStepLR
+from torch.utils.data import ConcatDataset
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 
+from Preprocessing.BatchedMelFeaturizer import BatchedMelFeaturizer
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.AdversarialLosses import DiscriminatorAdversarialLoss
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.AdversarialLosses import GeneratorAdversarialLoss
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.FeatureMatchingLoss import FeatureMatchLoss
@@ -16,6 +18,18 @@ from Utility.utils import delete_old_checkpoints
 from Utility.utils import get_most_recent_checkpoint
 
 
+def sampling_rate_of(dataset):
+    """
+    the sampling rate the waves of a HiFiGANDataset, or of a ConcatDataset of them, are resampled to
+    """
+    if isinstance(dataset, ConcatDataset):
+        sampling_rates = {sampling_rate_of(sub_dataset) for sub_dataset in dataset.datasets}
+        if len(sampling_rates) != 1:
+            raise ValueError(f"The datasets have different sampling rates {sorted(sampling_rates)}, but they have to share one.")
+        return sampling_rates.pop()
+    return dataset.desired_samplingrate
+
+
 def train_loop(generator,
                discriminator,
                train_dataset,
@@ -36,6 +50,8 @@ def train_loop(generator,
     step_counter = 0
     epoch = 0
 
+    # 16kHz spectrogram as input, 48kHz wave as output, see Blizzard 2021 DelightfulTTS
+    featurizer = BatchedMelFeaturizer(input_sr=sampling_rate_of(train_dataset), output_sr=16000).to(device)
     mel_l1 = MelSpectrogramLoss().to(device)
     feat_match_criterion = FeatureMatchLoss().to(device)
     discriminator_adv_criterion = DiscriminatorAdversarialLoss().to(device)
@@ -98,7 +114,7 @@ def train_loop(generator,
             ############################
 
             gold_wave = datapoint[0].to(device).unsqueeze(1)
-            melspec = datapoint[1].to(device)
+            melspec = featurizer(datapoint[1].to(device))[:, :, :-1]
             pred_wave = g(melspec)
             signal_loss = torch.tensor([0.0]).to(device)
             if use_signal_processing_losses:
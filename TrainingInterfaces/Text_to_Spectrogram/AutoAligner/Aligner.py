@@ -6,11 +6,13 @@ import numpy as np
 import torch
 import torch.multiprocessing
 import torch.nn as nn
+from numba import jit
 from scipy.sparse import coo_matrix
 from scipy.sparse.csgraph import dijkstra
 from torch.nn import CTCLoss
 from torch.nn.utils.rnn import pack_padded_sequence
 from torch.nn.utils.rnn import pad_packed_sequence
+from torch.nn.utils.rnn import pad_sequence
 
 from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
 
@@ -60,9 +62,15 @@ class Aligner(torch.nn.Module):
         self.ctc_loss = CTCLoss(blank=144, zero_infinity=True)
         self.vector_to_id = dict()
 
-    def forward(self, x, lens=None):
+    def forward(self, x, lens=None, mask_padding=False):
+        if mask_padding:
+            # setting the padded frames to 0 after every convolution makes them look like the zero padding
+            # of the convolutions, so every element of a batch gets the same output as it would get on its own
+            padding_mask = (torch.arange(x.size(1), device=x.device).unsqueeze(0) >= lens.to(x.device).unsqueeze(1)).unsqueeze(2)
         for conv in self.convs:
             x = conv(x)
+            if mask_padding:
+                x = x.masked_fill(padding_mask, 0.0)
 
         if lens is not None:
             x = pack_padded_sequence(x, lens.cpu(), batch_first=True, enforce_sorted=False)
@@ -94,19 +102,44 @@ class Aligner(torch.nn.Module):
             phones.append(self.tf.id_to_phone[int(id_of_phone)])
         return "".join(phones)
 
+    @torch.inference_mode()
+    def inference_batch(self, mels, tokens):
+        """
+        Aligns a batch of utterances with MAS. Gives the same results as calling inference with
+        pathfinding="MAS" and return_ctc=True on every utterance, but runs the network on the
+        whole padded batch at once.
+
+        Args:
+            mels: list of spectrograms (frames x n_mels)
+            tokens: list of phone ID sequences (as in the aligner cache, so without word boundaries)
+
+        Returns:
+            a list of alignment matrices (frames x tokens) and a list of CTC losses
+        """
+        device = next(self.parameters()).device
+        mel_lens = torch.LongTensor([len(mel) for mel in mels])
+        token_lens = torch.LongTensor([len(token_ids) for token_ids in tokens])
+        pred = self(pad_sequence(mels, batch_first=True).to(device), lens=mel_lens, mask_padding=True)
+        ctc_losses = torch.nn.functional.ctc_loss(pred.transpose(0, 1).log_softmax(2),
+                                                  pad_sequence(tokens, batch_first=True).to(device),
+                                                  mel_lens,
+                                                  token_lens,
+                                                  blank=144,
+                                                  reduction="none",
+                                                  zero_infinity=True)
+        ctc_losses = (ctc_losses.cpu() / token_lens.clamp(min=1)).tolist()  # the same normalization as the mean reduction of self.ctc_loss for a single utterance
+        pred = pred.cpu().numpy()
+        pred_max = np.zeros((len(mels), int(mel_lens.max()), int(token_lens.max())), dtype=pred.dtype)
+        for index, token_ids in enumerate(tokens):
+            pred_max[index, :mel_lens[index], :token_lens[index]] = pred[index, :mel_lens[index]][:, token_ids.numpy()]
+        alignment_matrices = binarize_alignment_batch(pred_max, mel_lens.numpy(), token_lens.numpy())
+        return [alignment_matrices[index, :mel_lens[index], :token_lens[index]] for index in range(len(mels))], ctc_losses
+
     @torch.inference_mode()
     def inference(self, mel, tokens, save_img_for_debug=None, train=False, pathfinding="MAS", return_ctc=False):
         if not train:
-            tokens_indexed = list()  # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
-            for vector in tokens:
-                if vector[19] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                    for phone in self.tf.phone_to_vector:
-                        if vector.cpu().numpy().tolist()[11:] == self.tf.phone_to_vector[phone][11:]:
-                            # the first 10 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                            tokens_indexed.append(self.tf.phone_to_id[phone])
-                            # this is terribly inefficient, but it's fine
-                            break
-            tokens = np.asarray(tokens_indexed)
+            # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
+            tokens = self.tf.text_vectors_to_id_sequence(tokens).numpy()
         else:
             tokens = tokens.cpu().detach().numpy()
 
@@ -116,8 +149,6 @@ class Aligner(torch.nn.Module):
                                      torch.LongTensor([len(tokens)])).item()
         pred = pred.squeeze().cpu().detach().numpy()
         pred_max = pred[:, tokens]
-        path_probs = 1. - pred_max
-        adj_matrix = to_adj_matrix(path_probs)
 
         if pathfinding == "MAS":
 
@@ -157,6 +188,8 @@ class Aligner(torch.nn.Module):
 
         elif pathfinding == "dijkstra":
 
+            path_probs = 1. - pred_max
+            adj_matrix = to_adj_matrix(path_probs)
             dist_matrix, predecessors, *_ = dijkstra(csgraph=adj_matrix,
                                                      directed=True,
                                                      indices=0,
@@ -226,13 +259,38 @@ def binarize_alignment(alignment_prob):
     """
     # assumes mel x text
     opt = np.zeros_like(alignment_prob)
+    _monotonic_alignment_search(_to_attention_map(alignment_prob), opt)
+    return opt
+
+
+def binarize_alignment_batch(alignment_probs, mel_lens, text_lens):
+    """
+    Binarizes a padded batch of alignments (batch x mel x text) with MAS. Every alignment
+    is cut to its lengths, so the result is the same as calling binarize_alignment on each
+    of them separately. Everything outside of the lengths is 0 in the result.
+    """
+    opts = np.zeros_like(alignment_probs)
+    attn_maps = np.zeros_like(alignment_probs)
+    mel_lens = np.asarray(mel_lens, dtype=np.int64).reshape(-1)
+    text_lens = np.asarray(text_lens, dtype=np.int64).reshape(-1)
+    for index in range(len(alignment_probs)):
+        attn_maps[index, :mel_lens[index], :text_lens[index]] = _to_attention_map(alignment_probs[index, :mel_lens[index], :text_lens[index]])
+    _batched_monotonic_alignment_search(attn_maps, mel_lens, text_lens, opts)
+    return opts
+
+
+def _to_attention_map(alignment_prob):
     alignment_prob = alignment_prob + (np.abs(alignment_prob).max() + 1.0)  # make all numbers positive and add an offset to avoid log of 0 later
-    alignment_prob * alignment_prob * (1.0 / alignment_prob.max())  # normalize to (0,  1]
     attn_map = np.log(alignment_prob)
     attn_map[0, 1:] = -np.inf
+    return attn_map
+
+
+@jit(nopython=True)
+def _monotonic_alignment_search(attn_map, opt):
     log_p = np.zeros_like(attn_map)
     log_p[0, :] = attn_map[0, :]
-    prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    prev_ind = np.zeros(attn_map.shape, dtype=np.int64)
     for i in range(1, attn_map.shape[0]):
         for j in range(attn_map.shape[1]):  # for each text dim
             prev_log = log_p[i - 1, j]
@@ -248,7 +306,12 @@ def binarize_alignment(alignment_prob):
         opt[i, curr_text_idx] = 1
         curr_text_idx = prev_ind[i, curr_text_idx]
     opt[0, curr_text_idx] = 1
-    return opt
+
+
+@jit(nopython=True)
+def _batched_monotonic_alignment_search(attn_maps, mel_lens, text_lens, opts):
+    for index in range(attn_maps.shape[0]):
+        _monotonic_alignment_search(attn_maps[index, :mel_lens[index], :text_lens[index]], opts[index, :mel_lens[index], :text_lens[index]])
 
 
 def to_node_index(i, j, cols):
@@ -263,35 +326,16 @@ def to_adj_matrix(mat):
     rows = mat.shape[0]
     cols = mat.shape[1]
 
-    row_ind = []
-    col_ind = []
-    data = []
-
-    for i in range(rows):
-        for j in range(cols):
-
-            node = to_node_index(i, j, cols)
-
-            if j < cols - 1:
-                right_node = to_node_index(i, j + 1, cols)
-                weight_right = mat[i, j + 1]
-                row_ind.append(node)
-                col_ind.append(right_node)
-                data.append(weight_right)
-
-            if i < rows - 1 and j < cols:
-                bottom_node = to_node_index(i + 1, j, cols)
-                weight_bottom = mat[i + 1, j]
-                row_ind.append(node)
-                col_ind.append(bottom_node)
-                data.append(weight_bottom)
-
-            if i < rows - 1 and j < cols - 1:
-                bottom_right_node = to_node_index(i + 1, j + 1, cols)
-                weight_bottom_right = mat[i + 1, j + 1]
-                row_ind.append(node)
-                col_ind.append(bottom_right_node)
-                data.append(weight_bottom_right)
+    i = np.arange(rows).reshape(-1, 1, 1)
+    j = np.arange(cols).reshape(1, -1, 1)
+    # every node gets an edge to the right, to the bottom and to the bottom right, in this order
+    neighbour_i = np.broadcast_to(i + np.array([0, 1, 1]), (rows, cols, 3))
+    neighbour_j = np.broadcast_to(j + np.array([1, 0, 1]), (rows, cols, 3))
+    exists = (neighbour_i < rows) & (neighbour_j < cols)
+
+    row_ind = np.broadcast_to(to_node_index(i, j, cols), (rows, cols, 3))[exists]
+    col_ind = to_node_index(neighbour_i[exists], neighbour_j[exists], cols)
+    data = mat[neighbour_i[exists], neighbour_j[exists]]
 
     adj_mat = coo_matrix((data, (row_ind, col_ind)), shape=(rows * cols, rows * cols))
     return adj_mat.tocsr()
@@ -5,14 +5,25 @@ import warnings
 import soundfile as sf
 import torch
 from numpy import trim_zeros
-from speechbrain.pretrained import EncoderClassifier
 from torch.multiprocessing import Manager
 from torch.multiprocessing import Process
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
 from Preprocessing.AudioPreprocessor import AudioPreprocessor
+from Preprocessing.ProsodicConditionExtractor import encode_batched
 from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
+from Utility.FeatureStore import FeatureStore
+from Utility.FeatureStore import FeatureStoreWriter
+from Utility.FeatureStore import feature_store_exists
+from Utility.model_registry import ECAPA_SPEAKER_ENCODER
+from Utility.model_registry import get_speechbrain_encoder
+
+# version 1: (datapoints, norm_waves, speaker_embeddings, filepaths), every datapoint is [text, text_len, speech, speech_len]
+# version 2: (datapoints, norm_waves, speaker_embeddings, filepaths, version), every datapoint additionally contains the phone IDs of the text
+ALIGNER_CACHE_FORMAT_VERSION = 2
+# since the feature store, the cache is a directory of memory-mapped columns instead of the pickled aligner_train_cache.pt
+ALIGNER_STORE = "aligner_train_store"
 
 
 class AlignerDataset(Dataset):
@@ -28,9 +39,19 @@ class AlignerDataset(Dataset):
                  rebuild_cache=False,
                  verbose=False,
                  device="cpu",
-                 phone_input=False):
+                 phone_input=False,
+                 embedding_batch_size=32,
+                 embedding_threads=None):
+        """
+        Args:
+            embedding_batch_size: how many waves of similar length the speaker embedding function encodes at once
+            embedding_threads: how many threads torch uses for the speaker embeddings when they are computed on the CPU. None means one per core
+        """
         os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
+        self.tf = ArticulatoryCombinedTextFrontend(language=lang)
+        if not rebuild_cache and not feature_store_exists(os.path.join(cache_dir, ALIGNER_STORE)) and os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")):
+            convert_aligner_cache_to_store(cache_dir, tf=self.tf)
+        if not feature_store_exists(os.path.join(cache_dir, ALIGNER_STORE)) or rebuild_cache:
             if cut_silences:
                 torch.set_num_threads(1)
                 torch.hub.load(repo_or_dir='snakers4/silero-vad',
@@ -69,42 +90,41 @@ class AlignerDataset(Dataset):
             for process in process_list:
                 process.join()
             self.datapoints = list(self.datapoints)
-            tensored_datapoints = list()
             # we had to turn all of the tensors to numpy arrays to avoid shared memory
-            # issues. Now that the multi-processing is over, we can convert them back
-            # to tensors to save on conversions in the future.
-            print("Converting into convenient format...")
-            norm_waves = list()
-            filepaths = list()
-            for datapoint in tqdm(self.datapoints):
-                tensored_datapoints.append([torch.Tensor(datapoint[0]),
-                                            torch.LongTensor(datapoint[1]),
-                                            torch.Tensor(datapoint[2]),
-                                            torch.LongTensor(datapoint[3])])
-                norm_waves.append(torch.Tensor(datapoint[-2]))
-                filepaths.append(datapoint[-1])
-
-            self.datapoints = tensored_datapoints
-
-            # add speaker embeddings
-            self.speaker_embeddings = list()
-            speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                                          run_opts={"device": str(device)},
-                                                                          savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
+            # issues. Now that the multi-processing is over, they go into the feature
+            # store together with the speaker embeddings, one datapoint at a time.
+            print("Computing the speaker embeddings...")
+            speaker_embedding_func_ecapa = get_speechbrain_encoder(*ECAPA_SPEAKER_ENCODER, device=device)
+            # silence removal limits torch to one thread, the embeddings can use all of them again
+            threads_before = torch.get_num_threads()
+            torch.set_num_threads(os.cpu_count() if embedding_threads is None else embedding_threads)
+            speaker_embeddings = encode_batched(speaker_embedding_func_ecapa,
+                                                [datapoint[-2] for datapoint in self.datapoints],
+                                                batch_size=embedding_batch_size,
+                                                device=device,
+                                                show_progress=True)
+            torch.set_num_threads(threads_before)
+            print("Writing the feature store...")
+            writer = FeatureStoreWriter(os.path.join(cache_dir, ALIGNER_STORE))
             with torch.no_grad():
-                for wave in tqdm(norm_waves):
-                    self.speaker_embeddings.append(speaker_embedding_func_ecapa.encode_batch(wavs=wave.to(device).unsqueeze(0)).squeeze().cpu())
+                for datapoint, speaker_embedding in zip(tqdm(self.datapoints), speaker_embeddings):
+                    norm_wave = torch.Tensor(datapoint[-2])
+                    _append_to_store(writer,
+                                     datapoint=[torch.Tensor(datapoint[0]),
+                                                torch.LongTensor(datapoint[1]),
+                                                torch.Tensor(datapoint[2]),
+                                                torch.LongTensor(datapoint[3]),
+                                                self.tf.text_vectors_to_id_sequence(torch.Tensor(datapoint[0]))],
+                                     norm_wave=norm_wave,
+                                     speaker_embedding=speaker_embedding,
+                                     filepath=datapoint[-1])
+            writer.finish(info={"version": ALIGNER_CACHE_FORMAT_VERSION})
+            del self.datapoints
 
-            # save to cache
-            torch.save((self.datapoints, norm_waves, self.speaker_embeddings, filepaths), os.path.join(cache_dir, "aligner_train_cache.pt"))
-        else:
-            # just load the datapoints from cache
-            self.datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
-            self.speaker_embeddings = self.datapoints[2]
-            self.datapoints = self.datapoints[0]
+        # the datapoints are read from the memory-mapped store when they are needed
+        self.store = FeatureStore(os.path.join(cache_dir, ALIGNER_STORE))
 
-        self.tf = ArticulatoryCombinedTextFrontend(language=lang)
-        print(f"Prepared an Aligner dataset with {len(self.datapoints)} datapoints in {cache_dir}.")
+        print(f"Prepared an Aligner dataset with {len(self.store)} datapoints in {cache_dir}.")
 
     def cache_builder_process(self,
                               path_list,
@@ -162,22 +182,82 @@ class AlignerDataset(Dataset):
         self.datapoints += process_internal_dataset_chunk
 
     def __getitem__(self, index):
-        text_vector = self.datapoints[index][0]
-        tokens = list()
-        for vector in text_vector:
-            if vector[19] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                for phone in self.tf.phone_to_vector:
-                    if vector.numpy().tolist()[11:] == self.tf.phone_to_vector[phone][11:]:
-                        # the first 10 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                        tokens.append(self.tf.phone_to_id[phone])
-                        # this is terribly inefficient, but it's fine
-                        break
-        tokens = torch.LongTensor(tokens)
+        tokens = self.store.get("tokens", index)
         return tokens, \
                torch.LongTensor([len(tokens)]), \
-               self.datapoints[index][2], \
-               self.datapoints[index][3], \
-               self.speaker_embeddings[index]
+               self.store.get("speech", index), \
+               self.store.get("speech_len", index), \
+               self.store.get("speaker_embedding", index)
 
     def __len__(self):
-        return len(self.datapoints)
+        return len(self.store)
+
+    def get_lengths(self):
+        """
+        the amount of spectrogram frames of every datapoint, read from the index of the store without loading the spectrograms
+        """
+        return [self.store.length_of("speech", index) for index in range(len(self.store))]
+
+
+def get_cache_format_version(cache):
+    if len(cache) == 4:
+        return 1
+    return cache[4]
+
+
+def migrate_cache(cache, tf, path_to_cache=None):
+    """
+    Brings an aligner cache of an older format version to the current one.
+
+    Args:
+        cache: the tuple that was loaded from an aligner_train_cache.pt
+        tf: a text frontend to compute the phone IDs of the texts with
+        path_to_cache: if given, the migrated cache is written back there, so the migration only happens once
+    """
+    datapoints, norm_waves, speaker_embeddings, filepaths = cache[:4]
+    version = get_cache_format_version(cache)
+    if version < 2:
+        print(f"Migrating aligner cache from version {version} to version {ALIGNER_CACHE_FORMAT_VERSION}...")
+        for datapoint in tqdm(datapoints):
+            datapoint.append(tf.text_vectors_to_id_sequence(datapoint[0]))
+    cache = (datapoints, norm_waves, speaker_embeddings, filepaths, ALIGNER_CACHE_FORMAT_VERSION)
+    if path_to_cache is not None:
+        # write to a temporary file first, so an interruption cannot destroy the existing cache
+        torch.save(cache, path_to_cache + ".tmp")
+        os.replace(path_to_cache + ".tmp", path_to_cache)
+    return cache
+
+
+def convert_aligner_cache_to_store(cache_dir, tf, cache=None):
+    """
+    Writes the content of an aligner_train_cache.pt from before the feature store into the feature store of the cache_dir.
+    The old file is left untouched and is not needed anymore afterwards.
+
+    Args:
+        cache_dir: directory that contains the aligner_train_cache.pt
+        tf: a text frontend, only needed if the cache has format version 1
+        cache: the already loaded content of the aligner_train_cache.pt, if it should not be loaded again
+    """
+    print("Converting aligner_train_cache.pt into a feature store...")
+    if cache is None:
+        cache = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
+    if get_cache_format_version(cache) < ALIGNER_CACHE_FORMAT_VERSION:
+        cache = migrate_cache(cache, tf=tf)
+    datapoints, norm_waves, speaker_embeddings, filepaths = cache[:4]
+    writer = FeatureStoreWriter(os.path.join(cache_dir, ALIGNER_STORE))
+    for datapoint, norm_wave, speaker_embedding, filepath in zip(tqdm(datapoints), norm_waves, speaker_embeddings, filepaths):
+        _append_to_store(writer, datapoint=datapoint, norm_wave=norm_wave, speaker_embedding=speaker_embedding, filepath=filepath)
+    return writer.finish(info={"version": ALIGNER_CACHE_FORMAT_VERSION})
+
+
+def _append_to_store(writer, datapoint, norm_wave, speaker_embedding, filepath):
+    writer.append({
+        "text"             : datapoint[0],
+        "text_len"         : datapoint[1],
+        "speech"           : datapoint[2],
+        "speech_len"       : datapoint[3],
+        "tokens"           : datapoint[4],
+        "wave"             : norm_wave,
+        "speaker_embedding": speaker_embedding
+        },
+        strings={"filepath": filepath})
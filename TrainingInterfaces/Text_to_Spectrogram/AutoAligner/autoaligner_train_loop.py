@@ -10,6 +10,9 @@ from tqdm import tqdm
 
 from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import Aligner
 from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.TinyTTS import TinyTTS
+from Utility.utils import backward_with_oom_backoff
+from Utility.LengthBucketedBatchSampler import LengthBucketedBatchSampler
+from Utility.LengthBucketedBatchSampler import get_lengths
 
 
 def collate_and_pad(batch):
@@ -18,7 +21,22 @@ def collate_and_pad(batch):
             torch.stack([datapoint[1] for datapoint in batch]).squeeze(1),
             pad_sequence([datapoint[2] for datapoint in batch], batch_first=True),
             torch.stack([datapoint[3] for datapoint in batch]).squeeze(1),
-            torch.stack([datapoint[4] for datapoint in batch]).squeeze())
+            torch.stack([datapoint[4] for datapoint in batch]).view(len(batch), -1))  # a batch can consist of a single long utterance, so squeeze would be wrong
+
+
+def split_batch(batch):
+    """
+    splits a collated batch into two halves and removes the padding the halves don't need anymore
+    """
+    middle = batch[0].size(0) // 2
+    halves = list()
+    for part in (slice(None, middle), slice(middle, None)):
+        halves.append((batch[0][part, :int(batch[1][part].max())],
+                       batch[1][part],
+                       batch[2][part, :int(batch[3][part].max())],
+                       batch[3][part],
+                       batch[4][part]))
+    return halves
 
 
 def train_loop(train_dataset,
@@ -26,6 +44,7 @@ def train_loop(train_dataset,
                save_directory,
                batch_size,
                steps,
+               max_frames_per_batch=None,
                path_to_checkpoint=None,
                fine_tune=False,
                resume=False,
@@ -41,16 +60,20 @@ def train_loop(train_dataset,
         device: Device to put the loaded tensors on
         save_directory: Where to save the checkpoints
         batch_size: How many elements should be loaded at once
+        max_frames_per_batch: How many spectrogram frames (including padding) a batch may contain at most. If a batch still runs out of memory, it is split in half.
         debug_img_path: where to put images of the training progress if desired
         use_reconstruction: whether to use the auxiliary spectrogram reconstruction procedure/loss, which can make the alignment sharper
     """
     os.makedirs(save_directory, exist_ok=True)
-    train_loader = DataLoader(batch_size=batch_size,
+    # utterances of similar length are batched together, so little of the batch is padding
+    train_loader = DataLoader(batch_sampler=LengthBucketedBatchSampler(get_lengths(train_dataset),
+                                                                          batch_size=batch_size,
+                                                                          max_frames_per_batch=max_frames_per_batch,
+                                                                          drop_last=True,
+                                                                          seed=torch.initial_seed()),  # so the seed of the pipeline controls the batches
                               dataset=train_dataset,
-                              drop_last=True,
-                              num_workers=8,
+                              num_workers=2,  # the phone IDs are precomputed in the cache, so loading is just indexing
                               pin_memory=False,
-                              shuffle=True,
                               prefetch_factor=16,
                               collate_fn=collate_and_pad,
                               persistent_workers=True)
@@ -85,35 +108,49 @@ def train_loop(train_dataset,
 
         asr_model.train()
         tiny_tts.train()
+        splits_this_epoch = 0
         for batch in tqdm(train_loader):
-            tokens = batch[0].to(device)
-            tokens_len = batch[1].to(device)
-            mel = batch[2].to(device)
-            mel_len = batch[3].to(device)
-            speaker_embeddings = batch[4].to(device)
 
-            pred = asr_model(mel, mel_len)
-
-            ctc_loss = asr_model.ctc_loss(pred.transpose(0, 1).log_softmax(2),
-                                          tokens,
-                                          mel_len,
-                                          tokens_len)
-
-            if use_reconstruction:
-                speaker_embeddings_expanded = torch.nn.functional.normalize(speaker_embeddings).unsqueeze(1).expand(-1, pred.size(1), -1)
-                tts_lambda = min([5, step_counter / 2000])  # super simple schedule
-                reconstruction_loss = tiny_tts(x=torch.cat([pred, speaker_embeddings_expanded], dim=-1),
-                                               # combine ASR prediction with speaker embeddings to allow for reconstruction loss on multiple speakers
-                                               lens=mel_len,
-                                               ys=mel) * tts_lambda  # reconstruction loss to make the states more distinct
-                loss = ctc_loss + reconstruction_loss
-            else:
-                loss = ctc_loss
-
-            optim_asr.zero_grad()
-            if use_reconstruction:
-                optim_tts.zero_grad()
-            loss.backward()
+            def compute_loss(part):
+                tokens = part[0].to(device)
+                tokens_len = part[1].to(device)
+                mel = part[2].to(device)
+                mel_len = part[3].to(device)
+                speaker_embeddings = part[4].to(device)
+
+                pred = asr_model(mel, mel_len)
+
+                ctc_loss = asr_model.ctc_loss(pred.transpose(0, 1).log_softmax(2),
+                                              tokens,
+                                              mel_len,
+                                              tokens_len)
+
+                if use_reconstruction:
+                    speaker_embeddings_expanded = torch.nn.functional.normalize(speaker_embeddings).unsqueeze(1).expand(-1, pred.size(1), -1)
+                    tts_lambda = min([5, step_counter / 2000])  # super simple schedule
+                    reconstruction_loss = tiny_tts(x=torch.cat([pred, speaker_embeddings_expanded], dim=-1),
+                                                   # combine ASR prediction with speaker embeddings to allow for reconstruction loss on multiple speakers
+                                                   lens=mel_len,
+                                                   ys=mel) * tts_lambda  # reconstruction loss to make the states more distinct
+                    return ctc_loss + reconstruction_loss
+                return ctc_loss
+
+            def zero_grad():
+                optim_asr.zero_grad()
+                if use_reconstruction:
+                    optim_tts.zero_grad()
+
+            def log_split(amount_of_parts):
+                nonlocal splits_this_epoch
+                splits_this_epoch += 1
+                print(f"Out of memory in step {step_counter} with {batch[0].size(0)} utterances and {int(batch[3].max()) * batch[0].size(0)} frames, retrying in {amount_of_parts} parts.")
+
+            loss = backward_with_oom_backoff(batch,
+                                             compute_loss=compute_loss,
+                                             backward=lambda part_loss: part_loss.backward(),
+                                             zero_grad=zero_grad,
+                                             split_batch=split_batch,
+                                             on_split=log_split)
             torch.nn.utils.clip_grad_norm_(asr_model.parameters(), 1.0)
             if use_reconstruction:
                 torch.nn.utils.clip_grad_norm_(tiny_tts.parameters(), 1.0)
@@ -123,7 +160,7 @@ def train_loop(train_dataset,
 
             step_counter += 1
 
-            loss_sum.append(loss.item())
+            loss_sum.append(loss)
 
         asr_model.eval()
         loss_this_epoch = sum(loss_sum) / len(loss_sum)
@@ -138,9 +175,11 @@ def train_loop(train_dataset,
         print("Total Loss:   {}".format(round(loss_this_epoch, 3)))
         print("Time elapsed: {} Minutes".format(round((time.time() - start_time) / 60)))
         print("Steps:        {}".format(step_counter))
+        if splits_this_epoch > 0:
+            print("OOM Splits:   {}".format(splits_this_epoch))  # if this happens often, max_frames_per_batch is too large
         if debug_img_path is not None:
-            asr_model.inference(mel=mel[0][:mel_len[0]],
-                                tokens=tokens[0][:tokens_len[0]],
+            asr_model.inference(mel=batch[2][0][:batch[3][0]].to(device),
+                                tokens=batch[0][0][:batch[1][0]],
                                 save_img_for_debug=debug_img_path + f"/{step_counter}.png",
                                 train=True)  # for testing
         if step_counter > steps:
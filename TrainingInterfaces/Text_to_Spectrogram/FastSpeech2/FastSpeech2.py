@@ -7,6 +7,7 @@ from abc import ABC
 import torch
 
 from Layers.Conformer import Conformer
+from Layers.Conformer_accent_mha import ACCENT_EMBEDDING_DIR
 from Layers.Conformer_accent_mha import Conformer_accent_mha # Added
 from Layers.DurationPredictor import DurationPredictor
 from Layers.LengthRegulator import LengthRegulator
@@ -100,7 +101,8 @@ class FastSpeech2(torch.nn.Module, ABC):
                  use_dtw_loss=False,
                  utt_embed_dim=704,
                  connect_utt_emb_at_encoder_out=True,
-                 lang_embs=100):
+                 lang_embs=100,
+                 accent_embeddings=ACCENT_EMBEDDING_DIR):
         super().__init__()
 
         # store hyperparameters
@@ -156,7 +158,8 @@ class FastSpeech2(torch.nn.Module, ABC):
                                  dropout_rate=transformer_dec_dropout_rate, positional_dropout_rate=transformer_dec_positional_dropout_rate,
                                  attention_dropout_rate=transformer_dec_attn_dropout_rate, normalize_before=decoder_normalize_before,
                                  concat_after=decoder_concat_after, positionwise_conv_kernel_size=positionwise_conv_kernel_size,
-                                 macaron_style=use_macaron_style_in_conformer, use_cnn_module=use_cnn_in_conformer, cnn_module_kernel=conformer_dec_kernel_size)
+                                 macaron_style=use_macaron_style_in_conformer, use_cnn_module=use_cnn_in_conformer, cnn_module_kernel=conformer_dec_kernel_size,
+                                 accent_embeddings=accent_embeddings)
 
         # define final projection
         self.feat_out = torch.nn.Linear(adim, odim * reduction_factor)
@@ -1,20 +1,37 @@
+import hashlib
+import json
 import os
+import shutil
 import statistics
 
 import torch
+import torch.multiprocessing
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+from Preprocessing.LanguageEmbeddingTable import LANGUAGE_EMBEDDING_DIR
+from Preprocessing.LanguageEmbeddingTable import get_language_embedding_table
 from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
 from Preprocessing.TextFrontend import get_language_id
 from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import Aligner
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import ALIGNER_STORE
 from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import AlignerDataset
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.DurationCalculator import DurationCalculator
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.EnergyCalculator import EnergyCalculator
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator import Parselmouth
+from Utility.FeatureStore import FeatureStore
+from Utility.FeatureStore import FeatureStoreWriter
+from Utility.FeatureStore import feature_store_exists
 #Victor added
 from Preprocessing.Language_embedding import LanguageEmbedding
 
+# the cache is written in shards of datapoints, the manifest keeps track of which shards are complete and which datapoints are filtered out
+SHARD_DIR = "fast_train_cache_shards"
+MANIFEST = "fast_train_cache_manifest.json"
+# the datapoints that survive the filtering are compacted into a memory-mapped feature store, which is what the training reads
+FAST_STORE = "fast_train_store"
+
+
 class FastSpeechDataset(Dataset):
 
     def __init__(self,
@@ -31,11 +48,29 @@ class FastSpeechDataset(Dataset):
                  rebuild_cache=False,
                  ctc_selection=True,
                  save_imgs=False,
-                 use_avg_lang_emb=True):
+                 use_avg_lang_emb=True,
+                 alignment_batch_size=32,
+                 shard_size=1000,
+                 rebuild_shards=None,
+                 embedding_batch_size=32,
+                 embedding_threads=None,
+                 language_embedding_dir=LANGUAGE_EMBEDDING_DIR):
+        """
+        Args:
+            shard_size: how many utterances go into one shard of the cache. If the build is interrupted, it continues after the last complete shard.
+            rebuild_shards: numbers of shards that should be built again, even though they are complete
+            embedding_batch_size: how many waves of similar length the speaker embedding functions encode at once
+            embedding_threads: how many threads torch uses for the alignments and speaker embeddings when they are computed on the CPU. None means one per core
+            language_embedding_dir: directory of the averaged language embeddings. With use_avg_lang_emb, the datapoints only contain the index of their embedding
+        """
         self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(os.path.join(cache_dir, "fast_train_cache.pt")) or rebuild_cache:
-            if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
+        rebuild_shards = set() if rebuild_shards is None else set(rebuild_shards)
+        if not rebuild_cache and _load_manifest(cache_dir) is None and os.path.exists(os.path.join(cache_dir, "fast_train_cache.pt")):
+            migrate_legacy_cache(cache_dir)
+        if rebuild_cache or len(rebuild_shards) > 0 or not _cache_is_complete(cache_dir):
+            if not feature_store_exists(os.path.join(cache_dir, ALIGNER_STORE)) or rebuild_cache:
+                # this also converts an aligner_train_cache.pt from before the feature store
                 AlignerDataset(path_to_transcript_dict=path_to_transcript_dict,
                                cache_dir=cache_dir,
                                lang=lang,
@@ -44,170 +79,429 @@ class FastSpeechDataset(Dataset):
                                max_len_in_seconds=max_len_in_seconds,
                                cut_silences=cut_silence,
                                rebuild_cache=rebuild_cache,
-                               device=device)
-            datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
+                               device=device,
+                               embedding_batch_size=embedding_batch_size,
+                               embedding_threads=embedding_threads)
             # we use the aligner dataset as basis and augment it to contain the additional information we need for fastspeech.
-            dataset = datapoints[0]
-            norm_waves = datapoints[1]
-            # index 2 are the speaker embeddings used for the reconstruction loss of the Aligner, we don't need them anymore
-            filepaths = datapoints[3]
-
-            print("... building dataset cache ...")
-            self.datapoints = list()
-            self.ctc_losses = list()
-
+            aligner_store = FeatureStore(os.path.join(cache_dir, ALIGNER_STORE))
             acoustic_model = Aligner()
             acoustic_model.load_state_dict(torch.load(acoustic_checkpoint_path, map_location='cpu')["asr_model"])
 
-            # ==========================================
-            # actual creation of datapoints starts here
-            # ==========================================
-
-            acoustic_model = acoustic_model.to(device)
-            parsel = Parselmouth(reduction_factor=reduction_factor, fs=16000)
-            energy_calc = EnergyCalculator(reduction_factor=reduction_factor, fs=16000)
-            dc = DurationCalculator(reduction_factor=reduction_factor)
-            vis_dir = os.path.join(cache_dir, "duration_vis")
-            os.makedirs(vis_dir, exist_ok=True)
-            pros_cond_ext = ProsodicConditionExtractor(sr=16000, device=device)
-
-            for index in tqdm(range(len(dataset))):
-                norm_wave = norm_waves[index]
-                norm_wave_length = torch.LongTensor([len(norm_wave)])
-
-                if len(norm_wave) / 16000 < min_len_in_seconds and ctc_selection:
-                    continue
-
-                text = dataset[index][0]
-                melspec = dataset[index][2]
-                melspec_length = dataset[index][3]
-
-                # We deal with the word boundaries by having 2 versions of text: with and without word boundaries.
-                # We note the index of word boundaries and insert durations of 0 afterwards
-                text_without_word_boundaries = list()
-                indexes_of_word_boundaries = list()
-                for phoneme_index, vector in enumerate(text):
-                    if vector[19] == 0:
-                        text_without_word_boundaries.append(vector.numpy().tolist())
-                    else:
-                        indexes_of_word_boundaries.append(phoneme_index)
-                matrix_without_word_boundaries = torch.Tensor(text_without_word_boundaries)
-
-                alignment_path, ctc_loss = acoustic_model.inference(mel=melspec.to(device),
-                                                                    tokens=matrix_without_word_boundaries.to(device),
-                                                                    save_img_for_debug=os.path.join(vis_dir, f"{index}.png") if save_imgs else None,
-                                                                    return_ctc=True)
-
-                cached_duration = dc(torch.LongTensor(alignment_path), vis=None).cpu()
-
-                for index_of_word_boundary in indexes_of_word_boundaries:
-                    cached_duration = torch.cat([cached_duration[:index_of_word_boundary],
-                                                 torch.LongTensor([0]),  # insert a 0 duration wherever there is a word boundary
-                                                 cached_duration[index_of_word_boundary:]])
-
-                last_vec = None
-                for phoneme_index, vec in enumerate(text):
-                    if last_vec is not None:
-                        if last_vec.numpy().tolist() == vec.numpy().tolist():
-                            # we found a case of repeating phonemes!
-                            # now we must repair their durations by giving the first one 3/5 of their sum and the second one 2/5 (i.e. the rest)
-                            dur_1 = cached_duration[phoneme_index - 1]
-                            dur_2 = cached_duration[phoneme_index]
-                            total_dur = dur_1 + dur_2
-                            new_dur_1 = int((total_dur / 5) * 3)
-                            new_dur_2 = total_dur - new_dur_1
-                            cached_duration[phoneme_index - 1] = new_dur_1
-                            cached_duration[phoneme_index] = new_dur_2
-                    last_vec = vec
-
-                cached_energy = energy_calc(input_waves=norm_wave.unsqueeze(0),
-                                            input_waves_lengths=norm_wave_length,
-                                            feats_lengths=melspec_length,
-                                            text=text,
-                                            durations=cached_duration.unsqueeze(0),
-                                            durations_lengths=torch.LongTensor([len(cached_duration)]))[0].squeeze(0).cpu()
-
-                cached_pitch = parsel(input_waves=norm_wave.unsqueeze(0),
-                                      input_waves_lengths=norm_wave_length,
-                                      feats_lengths=melspec_length,
-                                      text=text,
-                                      durations=cached_duration.unsqueeze(0),
-                                      durations_lengths=torch.LongTensor([len(cached_duration)]))[0].squeeze(0).cpu()
-
-                try:
-                    prosodic_condition = pros_cond_ext.extract_condition_from_reference_wave(norm_wave, already_normalized=True).cpu()
-                except RuntimeError:
-                    # if there is an audio without any voiced segments whatsoever we have to skip it.
-                    continue
-                
-                if use_avg_lang_emb:
-                    #loads the embedding from the folder of the audio with the name "{vd,at,goi,ivg,...}_emb.pt"
-                    language_embedding = torch.load(os.path.join('./Preprocessing/embeds_mls_test',filepaths[index].split('/')[-1].split('_')[1] + '_emb_trained.pt' )).squeeze(0)
-                else:
-                    embedder = LanguageEmbedding()
-                    language_embedding = embedder.get_language_embedding(input_waves=norm_wave.unsqueeze(0))
-
-                self.datapoints.append([dataset[index][0],
-                                        dataset[index][1],
-                                        dataset[index][2],
-                                        dataset[index][3],
-                                        cached_duration.cpu(),
-                                        cached_energy,
-                                        cached_pitch,
-                                        prosodic_condition,
-                                        filepaths[index],
-                                        language_embedding])
-                self.ctc_losses.append(ctc_loss)
+            print("... building dataset cache ...")
+            indexes = [index for index in range(len(aligner_store)) if not (aligner_store.length_of("wave", index) / 16000 < min_len_in_seconds and ctc_selection)]
+            shards = [indexes[start:start + shard_size] for start in range(0, len(indexes), shard_size)]
+            manifest = _load_manifest(cache_dir)
+            language_embedding_table = get_language_embedding_table(language_embedding_dir) if use_avg_lang_emb else None
+            # the indexes in the datapoints only mean something together with the names of the table they were taken from
+            language_embedding_names = None if language_embedding_table is None else language_embedding_table.names
+            if rebuild_cache or manifest is None or manifest["num_aligner_datapoints"] != len(aligner_store) or manifest["shard_size"] != shard_size or \
+                    manifest.get("language_embedding_names") != language_embedding_names:
+                manifest = {
+                    "num_aligner_datapoints"  : len(aligner_store),
+                    "shard_size"              : shard_size,
+                    "num_shards"              : len(shards),
+                    "filtered"                : False,
+                    "language_embedding_names": language_embedding_names,
+                    "shards"                  : dict()
+                    }
+            shards_to_build = [shard_number for shard_number in range(len(shards)) if shard_number in rebuild_shards or not _shard_is_complete(cache_dir, manifest, shard_number)]
+            if len(shards_to_build) < len(shards):
+                print(f"{len(shards) - len(shards_to_build)} of {len(shards)} shards are already complete.")
+
+            if len(shards_to_build) > 0:
+                if os.path.exists(os.path.join(cache_dir, FAST_STORE)):
+                    shutil.rmtree(os.path.join(cache_dir, FAST_STORE))  # it would be compacted from the old shards
+                acoustic_model = acoustic_model.to(device)
+                acoustic_model.eval()  # in train mode the batch statistics would make the alignment of an utterance depend on the other utterances in its batch
+                vis_dir = os.path.join(cache_dir, "duration_vis")
+                os.makedirs(vis_dir, exist_ok=True)
+                os.makedirs(os.path.join(cache_dir, SHARD_DIR), exist_ok=True)
+                pros_cond_ext = ProsodicConditionExtractor(sr=16000, device=device)
+                embedder = None if use_avg_lang_emb else LanguageEmbedding()
+                # energy and pitch only need the CPU, so they are spread over a pool of processes
+                with torch.multiprocessing.Pool(processes=loading_processes,
+                                                initializer=_init_feature_extraction_process,
+                                                initargs=(reduction_factor,)) as pool:
+                    # the pool processes use one thread each, this process can use all of them while they wait. This is
+                    # only changed once the pool is forked, processes forked from a process with a busy thread pool can hang
+                    threads_before = torch.get_num_threads()
+                    torch.set_num_threads(os.cpu_count() if embedding_threads is None else embedding_threads)
+                    for shard_number in shards_to_build:
+                        print(f"... building shard {shard_number + 1} of {len(shards)} ...")
+                        shard_datapoints, shard_ctc_losses = _build_datapoints(indexes=shards[shard_number],
+                                                                               aligner_store=aligner_store,
+                                                                               acoustic_model=acoustic_model,
+                                                                               pros_cond_ext=pros_cond_ext,
+                                                                               embedder=embedder,
+                                                                               language_embedding_table=language_embedding_table,
+                                                                               pool=pool,
+                                                                               device=device,
+                                                                               reduction_factor=reduction_factor,
+                                                                               alignment_batch_size=alignment_batch_size,
+                                                                               embedding_batch_size=embedding_batch_size,
+                                                                               save_imgs=save_imgs,
+                                                                               vis_dir=vis_dir)
+                        # write to a temporary file first, so an interruption cannot leave a broken shard behind
+                        path_to_shard = os.path.join(cache_dir, SHARD_DIR, _shard_file(shard_number))
+                        torch.save(shard_datapoints, path_to_shard + ".tmp")
+                        os.replace(path_to_shard + ".tmp", path_to_shard)
+                        manifest["shards"][str(shard_number)] = {
+                            "file"          : _shard_file(shard_number),
+                            "indexes"       : shards[shard_number],
+                            "ctc_losses"    : shard_ctc_losses,
+                            "removed_by_ctc": list(),
+                            "removed"       : list()
+                            }
+                        manifest["filtered"] = False
+                        _save_manifest(cache_dir, manifest)
+                    torch.set_num_threads(threads_before)
 
             # =============================
             # done with datapoint creation
             # =============================
 
-            if ctc_selection:
-                # now we can filter out some bad datapoints based on the CTC scores we collected
-                mean_ctc = sum(self.ctc_losses) / len(self.ctc_losses)
-                std_dev = statistics.stdev(self.ctc_losses)
-                threshold = mean_ctc + std_dev
-                for index in range(len(self.ctc_losses), 0, -1):
-                    if self.ctc_losses[index - 1] > threshold:
-                        self.datapoints.pop(index - 1)
-                        print(
-                            f"Removing datapoint {index - 1}, because the CTC loss is one standard deviation higher than the mean. \n ctc: {round(self.ctc_losses[index - 1], 4)} vs. mean: {round(mean_ctc, 4)}")
-
-            # save to cache
-            if len(self.datapoints) > 0:
-                torch.save(self.datapoints, os.path.join(cache_dir, "fast_train_cache.pt"))
-            else:
-                import sys
-                print("No datapoints were prepared! Exiting...")
-                sys.exit()
-        else:
-            # just load the datapoints from cache
-            self.datapoints = torch.load(os.path.join(cache_dir, "fast_train_cache.pt"), map_location='cpu')
+            if not manifest["filtered"]:
+                _filter_by_ctc(manifest, ctc_selection)
+                _save_manifest(cache_dir, manifest)
+
+        self.store = open_fast_train_store(cache_dir)
+        self.language_embeddings = load_language_embeddings(cache_dir, language_embedding_dir)
+        # the rows of the store that are in use, datapoints that are removed during training are only dropped from here and from the manifest
+        self.rows = list(range(len(self.store)))
+        if len(self.rows) == 0:
+            import sys
+            print("No datapoints were prepared! Exiting...")
+            sys.exit()
 
-        self.cache_dir = cache_dir
         self.language_id = get_language_id(lang)
-        print(f"Prepared a FastSpeech dataset with {len(self.datapoints)} datapoints in {cache_dir}.")
+        print(f"Prepared a FastSpeech dataset with {len(self.rows)} datapoints in {cache_dir}.")
 
     #index[9] added by victor, it is lang_embedd
     def __getitem__(self, index):
-        return self.datapoints[index][0], \
-               self.datapoints[index][1], \
-               self.datapoints[index][2], \
-               self.datapoints[index][3], \
-               self.datapoints[index][4], \
-               self.datapoints[index][5], \
-               self.datapoints[index][6], \
-               self.datapoints[index][7], \
-               self.datapoints[index][9], \
+        row = self.rows[index]
+        return self.store.get("text", row), \
+               self.store.get("text_len", row), \
+               self.store.get("mel", row), \
+               self.store.get("mel_len", row), \
+               self.store.get("duration", row), \
+               self.store.get("energy", row), \
+               self.store.get("pitch", row), \
+               self.store.get("prosodic_condition", row), \
+               self._get_language_embedding(row), \
                self.language_id
 
+    def _get_language_embedding(self, row):
+        language_embedding = self.store.get("language_embedding", row)
+        if self.language_embeddings is not None:
+            # the datapoint only contains the index of its averaged language embedding
+            return self.language_embeddings[language_embedding]
+        return language_embedding
+
 
     def __len__(self):
-        return len(self.datapoints)
+        return len(self.rows)
+
+    def get_lengths(self):
+        """
+        the amount of spectrogram frames of every datapoint, read from the index of the store without loading the spectrograms
+        """
+        return [self.store.length_of("mel", row) for row in self.rows]
 
     def remove_samples(self, list_of_samples_to_remove):
+        manifest = _load_manifest(self.cache_dir)
         for remove_id in sorted(list_of_samples_to_remove, reverse=True):
-            self.datapoints.pop(remove_id)
-        torch.save(self.datapoints, os.path.join(self.cache_dir, "fast_train_cache.pt"))
+            shard_number, position = self.store.get("origin", self.rows.pop(remove_id)).tolist()
+            manifest["shards"][str(shard_number)]["removed"].append(position)
+        # the store no longer matches the manifest, so it is compacted again the next time the cache is loaded
+        _save_manifest(self.cache_dir, manifest)
         print("Dataset updated!")
+
+
+def _build_datapoints(indexes,
+                      aligner_store,
+                      acoustic_model,
+                      pros_cond_ext,
+                      embedder,
+                      language_embedding_table,
+                      pool,
+                      device,
+                      reduction_factor,
+                      alignment_batch_size,
+                      embedding_batch_size,
+                      save_imgs,
+                      vis_dir):
+    """
+    Creates the datapoints for the given indexes of the aligner dataset, returns them together with their CTC losses.
+    """
+    datapoints = list()
+    ctc_losses = list()
+
+    # the aligner runs on batches of utterances with similar lengths, so there is little padding
+    print("... extracting alignments ...")
+    durations = dict()
+    ctc_losses_by_index = dict()
+    dc = DurationCalculator(reduction_factor=reduction_factor)
+    indexes_sorted_by_length = sorted(indexes, key=lambda index: aligner_store.length_of("speech", index))
+    for batch_start in tqdm(range(0, len(indexes_sorted_by_length), alignment_batch_size)):
+        batch_indexes = indexes_sorted_by_length[batch_start:batch_start + alignment_batch_size]
+        alignment_paths, batch_ctc_losses = acoustic_model.inference_batch(mels=[aligner_store.get("speech", index) for index in batch_indexes],
+                                                                           tokens=[aligner_store.get("tokens", index) for index in batch_indexes])
+        for index, alignment_path, ctc_loss in zip(batch_indexes, alignment_paths, batch_ctc_losses):
+            if save_imgs:
+                acoustic_model.inference(mel=aligner_store.get("speech", index).to(device),
+                                         tokens=aligner_store.get("tokens", index),
+                                         save_img_for_debug=os.path.join(vis_dir, f"{index}.png"),
+                                         train=True)
+            durations[index] = _repair_durations(dc(torch.LongTensor(alignment_path), vis=None).cpu(), text=aligner_store.get("text", index))
+            ctc_losses_by_index[index] = ctc_loss
+
+    print("... extracting energy and pitch ...")
+    energies = dict()
+    pitches = dict()
+    jobs = ((index,
+             aligner_store.get("wave", index).numpy(),
+             aligner_store.get("speech_len", index).numpy(),
+             aligner_store.get("text", index).numpy(),
+             durations[index].numpy()) for index in indexes)
+    for index, energy, pitch in tqdm(pool.imap_unordered(_extract_energy_and_pitch, jobs, chunksize=8), total=len(indexes)):
+        energies[index] = torch.from_numpy(energy)
+        pitches[index] = torch.from_numpy(pitch)
+
+    # the speaker conditions and language embeddings come from neural models, so they stay in this process on the device
+    print("... extracting speaker and language conditions ...")
+    prosodic_conditions = dict()
+    indexes_sorted_by_length = sorted(indexes, key=lambda index: aligner_store.length_of("wave", index))
+    for batch_start in tqdm(range(0, len(indexes_sorted_by_length), embedding_batch_size)):
+        batch_indexes = indexes_sorted_by_length[batch_start:batch_start + embedding_batch_size]
+        batch_conditions = pros_cond_ext.extract_conditions_from_reference_waves([aligner_store.get("wave", index) for index in batch_indexes],
+                                                                                 already_normalized=True,
+                                                                                 batch_size=embedding_batch_size)
+        prosodic_conditions.update(zip(batch_indexes, batch_conditions))
+    for index in tqdm(indexes):
+        norm_wave = aligner_store.get("wave", index)
+        filepath = aligner_store.get_string("filepath", index)
+        prosodic_condition = prosodic_conditions[index]
+        if prosodic_condition is None:
+            # if there is an audio without any voiced segments whatsoever we have to skip it.
+            continue
+
+        if embedder is None:
+            # the index of the averaged embedding of the dialect in the name of the audio, e.g. vd for hpo_vd_wean_0002.wav
+            language_embedding = torch.tensor(language_embedding_table.index_of_filepath(filepath))
+        else:
+            language_embedding = embedder.get_language_embedding(input_waves=norm_wave.unsqueeze(0))
+
+        datapoints.append([aligner_store.get("text", index),
+                           aligner_store.get("text_len", index),
+                           aligner_store.get("speech", index),
+                           aligner_store.get("speech_len", index),
+                           durations[index],
+                           energies[index],
+                           pitches[index],
+                           prosodic_condition,
+                           filepath,
+                           language_embedding])
+        ctc_losses.append(ctc_losses_by_index[index])
+    return datapoints, ctc_losses
+
+
+def _filter_by_ctc(manifest, ctc_selection):
+    """
+    Final pass over the manifest: marks the datapoints whose CTC loss is more than one standard
+    deviation above the mean of the whole corpus. Only the manifest is needed for this, not the shards.
+    """
+    shard_numbers = sorted(manifest["shards"], key=int)
+    for shard_number in shard_numbers:
+        manifest["shards"][shard_number]["removed_by_ctc"] = list()
+    ctc_losses = [ctc_loss for shard_number in shard_numbers for ctc_loss in manifest["shards"][shard_number]["ctc_losses"]]
+    if ctc_selection and len(ctc_losses) > 1:
+        # now we can filter out some bad datapoints based on the CTC scores we collected
+        mean_ctc = sum(ctc_losses) / len(ctc_losses)
+        std_dev = statistics.stdev(ctc_losses)
+        threshold = mean_ctc + std_dev
+        for shard_number in shard_numbers:
+            for position, ctc_loss in enumerate(manifest["shards"][shard_number]["ctc_losses"]):
+                if ctc_loss > threshold:
+                    manifest["shards"][shard_number]["removed_by_ctc"].append(position)
+                    print(f"Removing datapoint {position} of shard {shard_number}, because the CTC loss is one standard deviation higher than the mean. \n ctc: {round(ctc_loss, 4)} vs. mean: {round(mean_ctc, 4)}")
+    manifest["filtered"] = True
+
+
+def _cache_is_complete(cache_dir):
+    manifest = _load_manifest(cache_dir)
+    if manifest is None:
+        return False
+    return manifest["filtered"] and all(_shard_is_complete(cache_dir, manifest, shard_number) for shard_number in range(manifest["num_shards"]))
+
+
+def _shard_is_complete(cache_dir, manifest, shard_number):
+    return str(shard_number) in manifest["shards"] and os.path.exists(os.path.join(cache_dir, SHARD_DIR, manifest["shards"][str(shard_number)]["file"]))
+
+
+def open_fast_train_store(cache_dir):
+    """
+    Opens the feature store with all datapoints of the cache that are not filtered out. If the
+    manifest changed since the store was written, the store is compacted from the shards again.
+    """
+    manifest = _load_manifest(cache_dir)
+    fingerprint = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode("utf8")).hexdigest()
+    path_to_store = os.path.join(cache_dir, FAST_STORE)
+    if feature_store_exists(path_to_store):
+        store = FeatureStore(path_to_store)
+        if store.info.get("manifest") == fingerprint:
+            return store
+    print("... compacting the shards into the feature store ...")
+    writer = FeatureStoreWriter(path_to_store)
+    for shard_number in tqdm(sorted(manifest["shards"], key=int)):
+        shard = manifest["shards"][shard_number]
+        removed = set(shard["removed_by_ctc"]) | set(shard["removed"])
+        for position, datapoint in enumerate(torch.load(os.path.join(cache_dir, SHARD_DIR, shard["file"]), map_location='cpu')):
+            if position not in removed:
+                writer.append({
+                    "text"              : datapoint[0],
+                    "text_len"          : datapoint[1],
+                    "mel"               : datapoint[2],
+                    "mel_len"           : datapoint[3],
+                    "duration"          : datapoint[4],
+                    "energy"            : datapoint[5],
+                    "pitch"             : datapoint[6],
+                    "prosodic_condition": datapoint[7],
+                    "language_embedding": datapoint[9],
+                    "origin"            : torch.LongTensor([int(shard_number), position])
+                    },
+                    strings={"filepath": datapoint[8]})
+    return writer.finish(info={"manifest": fingerprint})
+
+
+def migrate_legacy_cache(cache_dir, keep_legacy_file=True):
+    """
+    Caches from before the sharding consist of a single fast_train_cache.pt, which already is filtered.
+    It becomes the only shard of a manifest, so it can be loaded like any other cache.
+
+    Args:
+        cache_dir: directory that contains the fast_train_cache.pt
+        keep_legacy_file: keep the fast_train_cache.pt, so older checkouts and scripts still find it. The shard is a hard link
+                          to it, which takes no space, and only a copy if the filesystem does not allow the link. False moves
+                          it instead, but the fast_train_cache.pt is gone afterwards
+    """
+    os.makedirs(os.path.join(cache_dir, SHARD_DIR), exist_ok=True)
+    if keep_legacy_file:
+        path_to_legacy_file = os.path.join(cache_dir, "fast_train_cache.pt")
+        path_to_shard = os.path.join(cache_dir, SHARD_DIR, _shard_file(0))
+        if os.path.exists(path_to_shard + ".tmp"):
+            os.remove(path_to_shard + ".tmp")  # left behind by an interrupted migration, the link would fail on it
+        try:
+            # shards are only ever replaced and never written in place, so the legacy file stays untouched
+            os.link(path_to_legacy_file, path_to_shard + ".tmp")
+        except OSError:
+            print("Copying fast_train_cache.pt into a shard, since it cannot be linked...")
+            shutil.copyfile(path_to_legacy_file, path_to_shard + ".tmp")
+        os.replace(path_to_shard + ".tmp", path_to_shard)
+    else:
+        print("Moving fast_train_cache.pt into a shard...")
+        os.replace(os.path.join(cache_dir, "fast_train_cache.pt"), os.path.join(cache_dir, SHARD_DIR, _shard_file(0)))
+    _save_manifest(cache_dir, {
+        "num_aligner_datapoints": None,
+        "shard_size"            : None,
+        "num_shards"            : 1,
+        "filtered"              : True,
+        "shards"                : {
+            "0": {
+                "file"          : _shard_file(0),
+                "indexes"       : list(),
+                "ctc_losses"    : list(),
+                "removed_by_ctc": list(),
+                "removed"       : list()
+                }
+            }
+        })
+
+
+def load_language_embeddings(cache_dir, language_embedding_dir=LANGUAGE_EMBEDDING_DIR):
+    """
+    The averaged language embeddings the indexes in the datapoints of a cache refer to, one row per index.
+    None if the datapoints contain their language embeddings themselves.
+    """
+    names = _load_manifest(cache_dir).get("language_embedding_names")
+    if names is None:
+        return None
+    table = get_language_embedding_table(language_embedding_dir)
+    return torch.stack([table.embedding_of(name) for name in names])
+
+
+def _shard_file(shard_number):
+    return f"shard_{shard_number:05d}.pt"
+
+
+def _load_manifest(cache_dir):
+    if not os.path.exists(os.path.join(cache_dir, MANIFEST)):
+        return None
+    with open(os.path.join(cache_dir, MANIFEST), encoding='utf8') as manifest_file:
+        return json.load(manifest_file)
+
+
+def _save_manifest(cache_dir, manifest):
+    with open(os.path.join(cache_dir, MANIFEST + ".tmp"), encoding='utf8', mode="w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(cache_dir, MANIFEST + ".tmp"), os.path.join(cache_dir, MANIFEST))
+
+
+def _repair_durations(cached_duration, text):
+    """
+    Inserts the durations of 0 for the word boundaries, which the aligner does not see,
+    and splits the durations of repeated phonemes.
+    """
+    indexes_of_word_boundaries = (text[:, 19] != 0).nonzero().view(-1).tolist()
+    for index_of_word_boundary in indexes_of_word_boundaries:
+        cached_duration = torch.cat([cached_duration[:index_of_word_boundary],
+                                     torch.LongTensor([0]),  # insert a 0 duration wherever there is a word boundary
+                                     cached_duration[index_of_word_boundary:]])
+
+    last_vec = None
+    for phoneme_index, vec in enumerate(text):
+        if last_vec is not None:
+            if last_vec.numpy().tolist() == vec.numpy().tolist():
+                # we found a case of repeating phonemes!
+                # now we must repair their durations by giving the first one 3/5 of their sum and the second one 2/5 (i.e. the rest)
+                dur_1 = cached_duration[phoneme_index - 1]
+                dur_2 = cached_duration[phoneme_index]
+                total_dur = dur_1 + dur_2
+                new_dur_1 = int((total_dur / 5) * 3)
+                new_dur_2 = total_dur - new_dur_1
+                cached_duration[phoneme_index - 1] = new_dur_1
+                cached_duration[phoneme_index] = new_dur_2
+        last_vec = vec
+    return cached_duration
+
+
+_energy_calc = None
+_parsel = None
+
+
+def _init_feature_extraction_process(reduction_factor):
+    global _energy_calc, _parsel
+    torch.set_num_threads(1)  # the parallelism comes from the processes
+    _energy_calc = EnergyCalculator(reduction_factor=reduction_factor, fs=16000)
+    _parsel = Parselmouth(reduction_factor=reduction_factor, fs=16000)
+
+
+def _extract_energy_and_pitch(job):
+    index, norm_wave, melspec_length, text, duration = job
+    norm_wave = torch.from_numpy(norm_wave)
+    norm_wave_length = torch.LongTensor([len(norm_wave)])
+    melspec_length = torch.from_numpy(melspec_length)
+    text = torch.from_numpy(text)
+    duration = torch.from_numpy(duration)
+    cached_energy = _energy_calc(input_waves=norm_wave.unsqueeze(0),
+                                 input_waves_lengths=norm_wave_length,
+                                 feats_lengths=melspec_length,
+                                 text=text,
+                                 durations=duration.unsqueeze(0),
+                                 durations_lengths=torch.LongTensor([len(duration)]))[0].squeeze(0).cpu()
+    cached_pitch = _parsel(input_waves=norm_wave.unsqueeze(0),
+                           input_waves_lengths=norm_wave_length,
+                           feats_lengths=melspec_length,
+                           text=text,
+                           durations=duration.unsqueeze(0),
+                           durations_lengths=torch.LongTensor([len(duration)]))[0].squeeze(0).cpu()
+    return index, cached_energy.numpy(), cached_pitch.numpy()
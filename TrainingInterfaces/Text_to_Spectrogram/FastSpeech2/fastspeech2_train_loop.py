@@ -11,9 +11,13 @@ from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 import numpy as np
+from Layers.Conformer_accent_mha import load_state_dict_tolerating_missing_accent_weights
 from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
 from Preprocessing.TextFrontend import get_language_id
+from Utility.LengthBucketedBatchSampler import LengthBucketedBatchSampler
+from Utility.LengthBucketedBatchSampler import get_lengths
 from Utility.WarmupScheduler import WarmupScheduler
+from Utility.utils import backward_with_oom_backoff
 from Utility.utils import cumsum_durations
 from Utility.utils import delete_old_checkpoints
 from Utility.utils import get_most_recent_checkpoint
@@ -114,16 +118,48 @@ def collate_and_pad(batch):
             pad_sequence([datapoint[4] for datapoint in batch], batch_first=True),
             pad_sequence([datapoint[5] for datapoint in batch], batch_first=True),
             pad_sequence([datapoint[6] for datapoint in batch], batch_first=True),
-            torch.stack([datapoint[7] for datapoint in batch]).squeeze(),
-            torch.stack(lang_emb).squeeze(),
+            torch.stack([datapoint[7] for datapoint in batch]).view(len(batch), -1),  # a batch can consist of a single long utterance, so squeeze would be wrong
+            torch.stack(lang_emb).view(len(batch), -1),
             torch.stack([datapoint[9] for datapoint in batch]))
 
 
+def split_batch(batch):
+    """
+    splits a collated batch into two halves and removes the padding the halves don't need anymore
+    """
+    middle = batch[0].size(0) // 2
+    halves = list()
+    for part in (slice(None, middle), slice(middle, None)):
+        max_text_len = int(batch[1][part].max())
+        max_speech_len = int(batch[3][part].max())
+        halves.append((batch[0][part, :max_text_len],
+                       batch[1][part],
+                       batch[2][part, :max_speech_len],
+                       batch[3][part],
+                       batch[4][part, :max_text_len],
+                       batch[5][part, :max_text_len],
+                       batch[6][part, :max_text_len],
+                       batch[7][part],
+                       batch[8][part],
+                       batch[9][part]))
+    return halves
+
+
+def frames_of(batch):
+    """
+    the amount of valid spectrogram frames in a collated batch. The spectrogram loss is averaged over them,
+    the duration, pitch and energy losses over the phones, so weighting the halves of a split batch by their
+    frames is exact only for the spectrogram loss and approximates the other terms.
+    """
+    return batch[3].sum()
+
+
 def train_loop(net,
                train_dataset,
                device,
                save_directory,
                batch_size=32,
+               max_frames_per_batch=None,
                steps=300000,
                epochs_per_save=1,
                lang="en",
@@ -146,6 +182,7 @@ def train_loop(net,
         device: Device to put the loaded tensors on
         save_directory: Where to save the checkpoints
         batch_size: How many elements should be loaded at once
+        max_frames_per_batch: How many spectrogram frames (including padding) a batch may contain at most. If a batch still runs out of memory, it is split in half.
         epochs_per_save: how many epochs to train in between checkpoints
 
     """
@@ -154,12 +191,15 @@ def train_loop(net,
     logger = prepare_logger(log_directory=os.path.join(save_directory,'logs')) #Create the logger and the logging dir
 
     torch.multiprocessing.set_sharing_strategy('file_system')
-    train_loader = DataLoader(batch_size=batch_size,
+    # utterances of similar length are batched together, so little of the batch is padding
+    train_loader = DataLoader(batch_sampler=LengthBucketedBatchSampler(get_lengths(train_dataset),
+                                                                          batch_size=batch_size,
+                                                                          max_frames_per_batch=max_frames_per_batch,
+                                                                          drop_last=True,
+                                                                          seed=torch.initial_seed()),  # so the seed of the pipeline controls the batches
                               dataset=train_dataset,
-                              drop_last=True,
                               num_workers=8,
                               pin_memory=True,
-                              shuffle=True,
                               prefetch_factor=8,
                               collate_fn=collate_and_pad,
                               persistent_workers=True)
@@ -181,7 +221,7 @@ def train_loop(net,
         path_to_checkpoint = get_most_recent_checkpoint(checkpoint_dir=save_directory)
     if path_to_checkpoint is not None:
         check_dict = torch.load(path_to_checkpoint, map_location=device)
-        net.load_state_dict(check_dict["model"])
+        load_state_dict_tolerating_missing_accent_weights(net, check_dict["model"])
         if not fine_tune:
             optimizer.load_state_dict(check_dict["optimizer"])
             scheduler.load_state_dict(check_dict["scheduler"])
@@ -193,24 +233,35 @@ def train_loop(net,
         epoch += 1
         optimizer.zero_grad()
         train_losses_this_epoch = list()
+        splits_this_epoch = 0
         for batch in tqdm(train_loader):
-            with autocast():
-                # print("text_lengths=batch[1]", str(batch[1])) prints the text lengths which is the dimension used for encoder (max value per bath is used, and most probably everything is zero padded)
-                train_loss = net(text_tensors=batch[0].to(device),
-                                 text_lengths=batch[1].to(device),
-                                 gold_speech=batch[2].to(device),
-                                 speech_lengths=batch[3].to(device),
-                                 gold_durations=batch[4].to(device),
-                                 gold_pitch=batch[6].to(device),  # mind the switched order
-                                 gold_energy=batch[5].to(device),  # mind the switched order
-                                 utterance_embedding=batch[7].to(device),
-                                 lang_embs=batch[8].to(device),
-                                 return_mels=False)
-                train_losses_this_epoch.append(train_loss.item())
-
-            optimizer.zero_grad()
-            scaler.scale(train_loss).backward()
-            del train_loss
+
+            def compute_loss(part):
+                with autocast():
+                    # print("text_lengths=batch[1]", str(batch[1])) prints the text lengths which is the dimension used for encoder (max value per bath is used, and most probably everything is zero padded)
+                    return net(text_tensors=part[0].to(device),
+                               text_lengths=part[1].to(device),
+                               gold_speech=part[2].to(device),
+                               speech_lengths=part[3].to(device),
+                               gold_durations=part[4].to(device),
+                               gold_pitch=part[6].to(device),  # mind the switched order
+                               gold_energy=part[5].to(device),  # mind the switched order
+                               utterance_embedding=part[7].to(device),
+                               lang_embs=part[8].to(device),
+                               return_mels=False)
+
+            def log_split(amount_of_parts):
+                nonlocal splits_this_epoch
+                splits_this_epoch += 1
+                print(f"Out of memory in step {step_counter} with {batch[0].size(0)} utterances and {int(batch[3].max()) * batch[0].size(0)} frames, retrying in {amount_of_parts} parts.")
+
+            train_losses_this_epoch.append(backward_with_oom_backoff(batch,
+                                                                     compute_loss=compute_loss,
+                                                                     backward=lambda loss: scaler.scale(loss).backward(),
+                                                                     zero_grad=optimizer.zero_grad,
+                                                                     split_batch=split_batch,
+                                                                     on_split=log_split,
+                                                                     weight_of=frames_of))
             step_counter += 1
             scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(net.parameters(), 1.0, error_if_nonfinite=False)
@@ -239,5 +290,8 @@ def train_loop(net,
         print("Steps:        {}".format(step_counter))
 
         logger.log_training(sum(train_losses_this_epoch) / len(train_losses_this_epoch),step_counter) #We add the loss of the specific step to the log
+        if splits_this_epoch > 0:
+            print("OOM Splits:   {}".format(splits_this_epoch))
+        logger.add_scalar("training.oom_splits", splits_this_epoch, step_counter)  # if this is often above 0, max_frames_per_batch is too large
 
         net.train()
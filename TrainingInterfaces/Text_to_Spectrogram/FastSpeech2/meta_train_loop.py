@@ -6,14 +6,20 @@ import torch
 import torch.multiprocessing
 from torch.cuda.amp import GradScaler
 from torch.cuda.amp import autocast
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 
+from Layers.Conformer_accent_mha import load_state_dict_tolerating_missing_accent_weights
 from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
 from Preprocessing.TextFrontend import get_language_id
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.fastspeech2_train_loop import collate_and_pad
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.fastspeech2_train_loop import frames_of
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.fastspeech2_train_loop import split_batch
+from Utility.LengthBucketedBatchSampler import LengthBucketedBatchSampler
+from Utility.LengthBucketedBatchSampler import get_lengths
 from Utility.WarmupScheduler import WarmupScheduler
 from Utility.path_to_transcript_dicts import *
+from Utility.utils import backward_with_oom_backoff
 from Utility.utils import cumsum_durations
 from Utility.utils import delete_old_checkpoints
 from Utility.utils import get_most_recent_checkpoint
@@ -38,7 +44,12 @@ def train_loop(net,
                lr,
                path_to_checkpoint,
                resume=False,
-               warmup_steps=4000):
+               warmup_steps=4000,
+               max_frames_per_batch=None):
+    """
+    Args:
+        max_frames_per_batch: How many spectrogram frames (including padding) a batch of one language may contain at most. If a batch still runs out of memory, it is split in half.
+    """
     # ============
     # Preparations
     # ============
@@ -48,13 +59,16 @@ def train_loop(net,
     torch.multiprocessing.set_sharing_strategy('file_system')
     train_loaders = list()
     train_iters = list()
-    for dataset in datasets:
-        train_loaders.append(DataLoader(batch_size=batch_size,
+    for index, dataset in enumerate(datasets):
+        # utterances of similar length are batched together, so little of the batch is padding
+        train_loaders.append(DataLoader(batch_sampler=LengthBucketedBatchSampler(get_lengths(dataset),
+                                                                                 batch_size=batch_size,
+                                                                                 max_frames_per_batch=max_frames_per_batch,
+                                                                                 drop_last=True,
+                                                                                 seed=torch.initial_seed() + index),  # every language gets its own order
                                         dataset=dataset,
-                                        drop_last=True,
                                         num_workers=2,
                                         pin_memory=True,
-                                        shuffle=True,
                                         prefetch_factor=5,
                                         collate_fn=collate_and_pad,
                                         persistent_workers=True))
@@ -78,7 +92,7 @@ def train_loop(net,
     train_losses_total = list()
     if path_to_checkpoint is not None:
         check_dict = torch.load(os.path.join(path_to_checkpoint), map_location=device)
-        net.load_state_dict(check_dict["model"])
+        load_state_dict_tolerating_missing_accent_weights(net, check_dict["model"])
         if resume:
             optimizer.load_state_dict(check_dict["optimizer"])
             step_counter = check_dict["step_counter"]
@@ -104,27 +118,47 @@ def train_loop(net,
                 batch = next(train_iters[index])
                 batches.append(batch)
         train_loss = 0.0
+        optimizer.zero_grad()
+        task_gradients = dict()
         for batch in batches:
-            with autocast():
-                # we sum the loss for each task, as we would do for the
-                # second order regular MAML, but we do it only over one
-                # step (i.e. iterations of inner loop = 1)
-                #print(type(batch[7]))
-                train_loss = train_loss + net(text_tensors=batch[0].to(device),
-                                              text_lengths=batch[1].to(device),
-                                              gold_speech=batch[2].to(device),
-                                              speech_lengths=batch[3].to(device),
-                                              gold_durations=batch[4].to(device),
-                                              gold_pitch=batch[6].to(device),  # mind the switched order
-                                              gold_energy=batch[5].to(device),  # mind the switched order
-                                              utterance_embedding=batch[7].to(device),
-                                              lang_embs=batch[8].to(device),
-                                              return_mels=False)
+
+            def compute_loss(part):
+                with autocast():
+                    # we sum the loss for each task, as we would do for the
+                    # second order regular MAML, but we do it only over one
+                    # step (i.e. iterations of inner loop = 1)
+                    return net(text_tensors=part[0].to(device),
+                               text_lengths=part[1].to(device),
+                               gold_speech=part[2].to(device),
+                               speech_lengths=part[3].to(device),
+                               gold_durations=part[4].to(device),
+                               gold_pitch=part[6].to(device),  # mind the switched order
+                               gold_energy=part[5].to(device),  # mind the switched order
+                               utterance_embedding=part[7].to(device),
+                               lang_embs=part[8].to(device),
+                               return_mels=False)
+
+            def log_split(amount_of_parts):
+                print(f"Out of memory in step {step} with {batch[0].size(0)} utterances and {int(batch[3].max()) * batch[0].size(0)} frames, retrying in {amount_of_parts} parts.")
+
+            train_loss += backward_with_oom_backoff(batch,
+                                                    compute_loss=compute_loss,
+                                                    backward=lambda loss: grad_scaler.scale(loss).backward(),
+                                                    zero_grad=optimizer.zero_grad,
+                                                    split_batch=split_batch,
+                                                    on_split=log_split,
+                                                    weight_of=frames_of)
+            # the gradients of every task are set aside, because splitting the batch of the next task starts over with zeroed gradients
+            for parameter in net.parameters():
+                if parameter.grad is not None:
+                    task_gradients[parameter] = parameter.grad if parameter not in task_gradients else task_gradients[parameter] + parameter.grad
+                    parameter.grad = None
+        # the sum of the gradients of all tasks is the gradient of the summed loss
+        for parameter, gradient in task_gradients.items():
+            parameter.grad = gradient
         # then we directly update our meta-parameters without
         # the need for any task specific parameters
-        train_losses_total.append(train_loss.item())
-        optimizer.zero_grad()
-        grad_scaler.scale(train_loss).backward()
+        train_losses_total.append(train_loss)
         grad_scaler.unscale_(optimizer)
         torch.nn.utils.clip_grad_norm_(net.parameters(), 1.0, error_if_nonfinite=False)
         grad_scaler.step(optimizer)
@@ -227,17 +261,3 @@ def plot_progress_spec(net, device, save_dir, step, lang, default_emb):
     plt.savefig(os.path.join(os.path.join(save_dir, "spec"), str(step) + ".png"))
     plt.clf()
     plt.close()
-
-def collate_and_pad(batch):
-    # text, text_len, speech, speech_len, durations, energy, pitch, utterance condition,language_embedding, language_id
-    #print(type([datapoint[8] for datapoint in batch][0]))
-    return (pad_sequence([datapoint[0] for datapoint in batch], batch_first=True),
-            torch.stack([datapoint[1] for datapoint in batch]).squeeze(1),
-            pad_sequence([datapoint[2] for datapoint in batch], batch_first=True),
-            torch.stack([datapoint[3] for datapoint in batch]).squeeze(1),
-            pad_sequence([datapoint[4] for datapoint in batch], batch_first=True),
-            pad_sequence([datapoint[5] for datapoint in batch], batch_first=True),
-            pad_sequence([datapoint[6] for datapoint in batch], batch_first=True),
-            torch.stack([datapoint[7] for datapoint in batch]).squeeze(),
-            torch.stack([datapoint[8] for datapoint in batch]).squeeze(),
-            torch.stack([datapoint[9] for datapoint in batch]))
@@ -48,7 +48,8 @@ def run(gpu_id, resume_checkpoint, finetune, model_dir, resume):
                device=device,
                save_directory=save_dir,
                steps=500000,
-               batch_size=8,
+               batch_size=32,
+               max_frames_per_batch=10000,  # about what 8 utterances of the maximum length of 20 seconds used to take up
                lang="de",
                lr=0.0001,
                epochs_per_save=1,
@@ -3,6 +3,7 @@ import random
 import torch
 from torch.utils.data import ConcatDataset
 
+from Preprocessing.ResampledWaveCache import ResampledWaveCache
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.HiFiGAN import HiFiGANGenerator
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.HiFiGAN import HiFiGANMultiScaleMultiPeriodDiscriminator
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.HiFiGANDataset import HiFiGANDataset
@@ -32,6 +33,9 @@ def run(gpu_id, resume_checkpoint, finetune, resume, model_dir):
     if not os.path.exists(model_save_dir):
         os.makedirs(model_save_dir)
 
+    # every file is only read and resampled in the first run that samples it, later runs memory-map it from here
+    wave_cache = ResampledWaveCache(cache_dir="Corpora/ResampledWaveCache", max_size_in_gb=500)
+
     # sampling multiple times from the dataset, because it's to big to fit all at once
     for run_id in range(800):
 
@@ -64,7 +68,7 @@ def run(gpu_id, resume_checkpoint, finetune, resume, model_dir):
         datasets = list()
 
         for index, file_list in enumerate(file_lists):
-            datasets.append(HiFiGANDataset(list_of_paths=file_list, cache_dir=f"Corpora/{index}", use_random_corruption=True))
+            datasets.append(HiFiGANDataset(list_of_paths=file_list, cache_dir=f"Corpora/{index}", use_random_corruption=True, wave_cache=wave_cache))
         train_set = ConcatDataset(datasets)
 
         generator = HiFiGANGenerator()
@@ -12,7 +12,7 @@ from sklearn.decomposition import PCA
 import numpy
 from tqdm import tqdm
 
-from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
+from Preprocessing.ConditionCache import get_condition_cache
 
 
 class Visualizer:
@@ -20,11 +20,12 @@ class Visualizer:
     def __init__(self, sr=48000, device="cpu"):
         """
         Args:
-            sr: The sampling rate of the audios you want to visualize.
+            sr: The sampling rate of the audios you want to visualize. Audios with other sampling rates work just as well.
         """
         self.tsne = TSNE(n_jobs=-1, n_iter_without_progress=4000, n_iter=20000)
         self.pca = PCA(n_components=2)
-        self.pros_cond_ext = ProsodicConditionExtractor(sr=sr, device=device)
+        # the conditions are cached, so files that were already visualized or compared don't have to be encoded again
+        self.condition_cache = get_condition_cache(device=device)
         self.sr = sr
 
     def visualize_speaker_embeddings(self, label_to_filepaths, title_of_plot, save_file_path=None, include_pca=True, legend=True, colors=None):
@@ -33,16 +34,9 @@ class Visualizer:
         ordered_labels = sorted(list(label_to_filepaths.keys()))
         for label in tqdm(ordered_labels):
             for filepath in tqdm(label_to_filepaths[label]):
-                wave, sr = sf.read(filepath)
-                if len(wave) / sr < 1:
+                if sf.info(filepath).duration < 1:
                     continue
-                if self.sr != sr:
-                    print("One of the Audios you included doesn't match the sampling rate of this visualizer object, "
-                          "creating a new condition extractor. Results will be correct, but if there are too many cases "
-                          "of changing samplingrate, this will run very slowly.")
-                    self.pros_cond_ext = ProsodicConditionExtractor(sr=sr)
-                    self.sr = sr
-                embedding_list.append(self.pros_cond_ext.extract_condition_from_reference_wave(wave).squeeze().numpy())
+                embedding_list.append(self.condition_cache.get(filepath).squeeze().numpy())
                 label_list.append(label)
         embeddings_as_array = numpy.array(embedding_list)
 
@@ -105,22 +99,11 @@ class Visualizer:
     def calculate_spk_sim(self, reference_path, comparisons):
         embedding_list = list()
         for filepath in tqdm(comparisons):
-            wave, sr = sf.read(filepath)
-            if len(wave) / sr < 1:
+            if sf.info(filepath).duration < 1:
                 continue
-            if self.sr != sr:
-                print("One of the Audios you included doesn't match the sampling rate of this visualizer object, "
-                      "creating a new condition extractor. Results will be correct, but if there are too many cases "
-                      "of changing samplingrate, this will run very slowly.")
-                self.pros_cond_ext = ProsodicConditionExtractor(sr=sr)
-                self.sr = sr
-            embedding_list.append(self.pros_cond_ext.extract_condition_from_reference_wave(wave).squeeze())
+            embedding_list.append(self.condition_cache.get(filepath).squeeze())
 
-        wave, sr = sf.read(reference_path)
-        if self.sr != sr:
-            self.pros_cond_ext = ProsodicConditionExtractor(sr=sr)
-            self.sr = sr
-        reference_embedding = self.pros_cond_ext.extract_condition_from_reference_wave(wave).squeeze()
+        reference_embedding = self.condition_cache.get(reference_path).squeeze()
 
         sims = list()
         for comp_emb in embedding_list:
@@ -11,6 +11,7 @@ from scipy.spatial.distance import cdist
 from sklearn.metrics import mean_squared_error
 
 from Preprocessing.AudioPreprocessor import AudioPreprocessor
+from Preprocessing.AudioPreprocessor import get_mel_basis
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator import Parselmouth
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator_Crepe import Crepe
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator_Dio import Dio
@@ -146,9 +147,7 @@ def logmelfilterbank(audio, sampling_rate, fmin=40, fmax=8000, eps=1e-10):
     x_stft = librosa.stft(audio, n_fft=1024, hop_length=256, win_length=None, window="hann", pad_mode="reflect")
     spc = numpy.abs(x_stft).T
     # get mel basis
-    fmin = 0 if fmin is None else fmin
-    fmax = sampling_rate / 2 if fmax is None else fmax
-    mel_basis = librosa.filters.mel(sampling_rate, 1024, 80, fmin, fmax)
+    mel_basis = get_mel_basis(sampling_rate, 1024, 80, fmin, fmax)
     # apply log and return
     return numpy.log10(numpy.maximum(eps, numpy.dot(spc, mel_basis.T)))
 
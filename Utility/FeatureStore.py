@@ -0,0 +1,169 @@
+"""
+The dataset caches used to be pickled lists of tensors, which every
+process has to unpickle completely into its own memory. A FeatureStore
+keeps each column of a cache (e.g. all the mels) as one flat binary file
+plus the offsets of the datapoints in it. The files are opened with
+np.memmap, so opening a store takes no time and all processes that read
+from it share the pages through the OS cache.
+
+Every element of a column has to have the same dtype and the same shape
+apart from the first dimension, which is the one the elements are
+concatenated along.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+FEATURE_STORE_FORMAT_VERSION = 1
+
+
+class FeatureStore:
+
+    def __init__(self, path_to_store):
+        """
+        Args:
+            path_to_store: directory that was written by a FeatureStoreWriter
+        """
+        self.path_to_store = path_to_store
+        with open(os.path.join(path_to_store, "meta.json"), encoding='utf8') as meta_file:
+            meta = json.load(meta_file)
+        if meta["format_version"] != FEATURE_STORE_FORMAT_VERSION:
+            raise ValueError(f"{path_to_store} has the format version {meta['format_version']}, but version {FEATURE_STORE_FORMAT_VERSION} is required.")
+        self.length = meta["length"]
+        self.columns = meta["columns"]
+        self.strings = meta["strings"]
+        self.info = meta["info"]
+        self._arrays = dict()
+        self._offsets = dict()
+
+    def __len__(self):
+        return self.length
+
+    def get(self, column, index):
+        """
+        returns the element of the column at the index as a tensor
+        """
+        array, offsets = self._open(column)
+        element = torch.from_numpy(np.array(array[offsets[index]:offsets[index + 1]]))  # copy, so the tensor is writable and does not keep the file open
+        if self.columns[column]["scalar"]:
+            return element[0]
+        return element
+
+    def length_of(self, column, index):
+        """
+        the size of the first dimension of an element, without reading the element
+        """
+        _, offsets = self._open(column)
+        return int(offsets[index + 1] - offsets[index])
+
+    def get_string(self, name, index):
+        return self.strings[name][index]
+
+    def _open(self, column):
+        if column not in self._arrays:
+            description = self.columns[column]
+            offsets = np.load(os.path.join(self.path_to_store, f"{column}.offsets.npy"))
+            shape = (int(offsets[-1]), *description["shape"])
+            if shape[0] == 0:
+                array = np.zeros(shape, dtype=description["dtype"])  # an empty file cannot be memory-mapped
+            else:
+                array = np.memmap(os.path.join(self.path_to_store, f"{column}.bin"), dtype=description["dtype"], mode="r", shape=shape)
+            self._arrays[column] = array
+            self._offsets[column] = offsets
+        return self._arrays[column], self._offsets[column]
+
+    def __getstate__(self):
+        # the memory maps are opened again in every process that needs them
+        state = self.__dict__.copy()
+        state["_arrays"] = dict()
+        state["_offsets"] = dict()
+        return state
+
+
+class FeatureStoreWriter:
+
+    def __init__(self, path_to_store):
+        """
+        Writes a FeatureStore datapoint by datapoint, so the whole cache never needs to be in memory at once.
+        Everything goes into a temporary directory first, which replaces path_to_store when finish is called.
+
+        Args:
+            path_to_store: directory the store should end up in
+        """
+        self.path_to_store = path_to_store
+        self.path_to_tmp = path_to_store.rstrip("/") + ".tmp"
+        if os.path.exists(self.path_to_tmp):
+            shutil.rmtree(self.path_to_tmp)
+        os.makedirs(self.path_to_tmp)
+        self.length = 0
+        self.columns = None
+        self.strings = None
+        self.files = dict()
+        self.offsets = dict()
+
+    def append(self, columns, strings=None):
+        """
+        Args:
+            columns: dict from column name to a tensor or numpy array
+            strings: dict from name to a string, e.g. the filepath of the datapoint
+        """
+        strings = dict() if strings is None else strings
+        if self.columns is None:
+            self.columns = dict()
+            for column, element in columns.items():
+                element = _to_numpy(element)
+                self.columns[column] = {"dtype": element.dtype.str, "shape": list(element.shape[1:]), "scalar": element.ndim == 0}
+                self.files[column] = open(os.path.join(self.path_to_tmp, f"{column}.bin"), mode="wb")
+                self.offsets[column] = [0]
+            self.strings = {name: list() for name in strings}
+        if set(columns) != set(self.columns) or set(strings) != set(self.strings):
+            raise ValueError("Every datapoint of a FeatureStore needs to have the same columns.")
+        for column, element in columns.items():
+            element = _to_numpy(element)
+            description = self.columns[column]
+            if description["scalar"]:
+                element = element.reshape(1)
+            if list(element.shape[1:]) != description["shape"]:
+                raise ValueError(f"The elements of column {column} need the shape (n, {', '.join(str(size) for size in description['shape'])}), got {tuple(element.shape)}.")
+            self.files[column].write(np.ascontiguousarray(element, dtype=description["dtype"]).tobytes())
+            self.offsets[column].append(self.offsets[column][-1] + element.shape[0])
+        for name, string in strings.items():
+            self.strings[name].append(string)
+        self.length += 1
+
+    def finish(self, info=None):
+        """
+        Writes the index and moves the store to its final place.
+
+        Args:
+            info: anything json serializable that should be kept with the store, e.g. a format version
+        """
+        for column in self.files:
+            self.files[column].close()
+            np.save(os.path.join(self.path_to_tmp, f"{column}.offsets.npy"), np.array(self.offsets[column], dtype=np.int64))
+        with open(os.path.join(self.path_to_tmp, "meta.json"), encoding='utf8', mode="w") as meta_file:
+            json.dump({
+                "format_version": FEATURE_STORE_FORMAT_VERSION,
+                "length"        : self.length,
+                "columns"       : dict() if self.columns is None else self.columns,
+                "strings"       : dict() if self.strings is None else self.strings,
+                "info"          : dict() if info is None else info
+                }, meta_file)
+        if os.path.exists(self.path_to_store):
+            shutil.rmtree(self.path_to_store)
+        os.replace(self.path_to_tmp, self.path_to_store)
+        return FeatureStore(self.path_to_store)
+
+
+def feature_store_exists(path_to_store):
+    return os.path.exists(os.path.join(path_to_store, "meta.json"))
+
+
+def _to_numpy(element):
+    if isinstance(element, torch.Tensor):
+        return element.detach().cpu().numpy()
+    return np.asarray(element)
@@ -0,0 +1,97 @@
+"""
+With randomly drawn batches, 1 second and 20 second utterances end up in the
+same batch, so most of the padded spectrograms and attention matrices are
+wasted compute. This batch sampler groups utterances of similar length, while
+the order of the batches and which utterances meet in a batch still change in
+every epoch.
+"""
+
+import random
+
+from torch.utils.data import ConcatDataset
+from torch.utils.data import Sampler
+
+
+class LengthBucketedBatchSampler(Sampler):
+
+    def __init__(self, lengths, batch_size=None, max_frames_per_batch=None, bucket_size=100, drop_last=False, seed=0):
+        """
+        Every epoch, the datapoints are shuffled and split into buckets of bucket_size batches. Each bucket
+        is sorted by length and cut into batches, then the order of all batches is shuffled.
+
+        Args:
+            lengths: the length of every datapoint in the dataset, e.g. the amount of spectrogram frames
+            batch_size: the maximum amount of datapoints in a batch
+            max_frames_per_batch: the maximum amount of frames in a padded batch, i.e. length of the longest datapoint times the amount of datapoints
+            bucket_size: how many batches worth of datapoints are sorted together. Larger buckets mean less padding, but less randomness
+            drop_last: whether to drop the last batch of the epoch, which is usually smaller than the others
+            seed: seed of the shuffling, so the batches of an epoch can be reproduced. The train loops derive it from torch.initial_seed()
+        """
+        if batch_size is None and max_frames_per_batch is None:
+            raise ValueError("Either a batch_size or max_frames_per_batch (or both) need to be given.")
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_frames_per_batch = max_frames_per_batch
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        if batch_size is not None:
+            self.datapoints_per_bucket = batch_size * bucket_size
+        else:
+            average_length = max(1, sum(self.lengths) // max(1, len(self.lengths)))
+            self.datapoints_per_bucket = max(1, max_frames_per_batch // average_length) * bucket_size
+        too_long = [length for length in self.lengths if max_frames_per_batch is not None and length > max_frames_per_batch]
+        if len(too_long) > 0:
+            print(f"{len(too_long)} datapoints are longer than max_frames_per_batch, they will form batches on their own.")
+        self._batches = self._make_batches()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = self._make_batches()
+
+    def __iter__(self):
+        batches = self._batches
+        # the next epoch is drawn right away, so __len__ always matches what the next __iter__ yields
+        self.set_epoch(self.epoch + 1)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def _make_batches(self):
+        rng = random.Random(f"{self.seed}/{self.epoch}")  # not seed + epoch, that would give neighbouring seeds the same epochs shifted by one
+        indexes = list(range(len(self.lengths)))
+        rng.shuffle(indexes)
+        batches = list()
+        for bucket_start in range(0, len(indexes), self.datapoints_per_bucket):
+            bucket = sorted(indexes[bucket_start:bucket_start + self.datapoints_per_bucket], key=lambda index: self.lengths[index])
+            batch = list()
+            longest = 0
+            for index in bucket:
+                # the bucket is sorted, so the current datapoint is the longest in the batch
+                if len(batch) > 0 and self._is_full(len(batch) + 1, self.lengths[index]):
+                    batches.append(batch)
+                    batch = list()
+                batch.append(index)
+                longest = self.lengths[index]
+            is_last_batch_of_epoch = bucket_start + self.datapoints_per_bucket >= len(indexes)
+            if len(batch) > 0 and not (is_last_batch_of_epoch and self.drop_last and not self._is_full(len(batch) + 1, longest)):
+                batches.append(batch)
+        rng.shuffle(batches)
+        return batches
+
+    def _is_full(self, size, longest):
+        if self.batch_size is not None and size > self.batch_size:
+            return True
+        if self.max_frames_per_batch is not None and size * longest > self.max_frames_per_batch:
+            return True
+        return False
+
+
+def get_lengths(dataset):
+    """
+    the lengths the sampler sorts by, for datasets that can tell them without loading their datapoints
+    """
+    if isinstance(dataset, ConcatDataset):
+        return [length for sub_dataset in dataset.datasets for length in get_lengths(sub_dataset)]
+    return dataset.get_lengths()
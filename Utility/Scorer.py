@@ -7,6 +7,7 @@ can help you find outliers in the audio part of text-audio pairs.
 """
 
 import math
+import os
 
 import torch
 from tqdm import tqdm
@@ -14,6 +15,9 @@ from tqdm import tqdm
 from Preprocessing.TextFrontend import get_language_id
 from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import Aligner
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeech2 import FastSpeech2
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import ALIGNER_STORE
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import open_fast_train_store
+from Utility.FeatureStore import FeatureStore
 
 
 class AlignmentScorer:
@@ -29,13 +33,12 @@ class AlignmentScorer:
     def score(self, path_to_aligner_dataset):
         """
         call this to update the path_to_score dict with scores for this dataset
+
+        Args:
+            path_to_aligner_dataset: either the cache directory of an AlignerDataset or an aligner_train_cache.pt from before the feature store
         """
-        datapoints = torch.load(path_to_aligner_dataset, map_location='cpu')
-        dataset = datapoints[0]
-        filepaths = datapoints[3]
-        for index in tqdm(range(len(dataset))):
-            text = dataset[index][0]
-            melspec = dataset[index][2]
+        datapoints = _read_aligner_datapoints(path_to_aligner_dataset)
+        for text, melspec, filepath in tqdm(datapoints, total=len(datapoints)):
             text_without_word_boundaries = list()
             for phoneme_index, vector in enumerate(text):
                 if vector[19] == 0:
@@ -46,8 +49,8 @@ class AlignmentScorer:
                                                  save_img_for_debug=None,
                                                  return_ctc=True)
             if math.isnan(ctc_loss):
-                self.nans.append(filepaths[index])
-            self.path_to_score[filepaths[index]] = ctc_loss
+                self.nans.append(filepath)
+            self.path_to_score[filepath] = ctc_loss
         if len(self.nans) > 0:
             print("The following filepaths had an infinite loss:")
             for path in self.nans:
@@ -91,10 +94,12 @@ class TTSScorer:
     def score(self, path_to_fastspeech_dataset, lang_id):
         """
         call this to update the path_to_score dict with scores for this dataset
+
+        Args:
+            path_to_fastspeech_dataset: either the cache directory of a FastSpeechDataset or a single cache file from before the cache was sharded
         """
-        datapoints = torch.load(path_to_fastspeech_dataset, map_location='cpu')
-        for index in tqdm(range(len(datapoints))):
-            text, text_len, spec, spec_len, duration, energy, pitch, embed, filepath = datapoints[index]
+        datapoints = _read_fastspeech_datapoints(path_to_fastspeech_dataset)
+        for text, text_len, spec, spec_len, duration, energy, pitch, embed, filepath in tqdm(datapoints, total=len(datapoints)):
             loss = self.tts(text_tensors=text.unsqueeze(0).to(self.device),
                             text_lengths=text_len.to(self.device),
                             gold_speech=spec.unsqueeze(0).to(self.device),
@@ -127,3 +132,42 @@ class TTSScorer:
         for index, path in enumerate(sorted(self.path_to_score, key=self.path_to_score.get, reverse=True)):
             if index < n or n == -1:
                 print(f"Loss: {round(self.path_to_score[path], 3)} - Path: {path}")
+
+
+class _LazyDatapoints:
+    """
+    Reads the datapoints of a feature store one at a time, so the whole cache never needs to be in memory.
+    """
+
+    def __init__(self, store, read_datapoint):
+        self.store = store
+        self.read_datapoint = read_datapoint
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        for index in range(len(self.store)):
+            yield self.read_datapoint(self.store, index)
+
+
+def _read_aligner_datapoints(path_to_aligner_dataset):
+    """
+    (text, melspec, filepath) for every datapoint of either the cache directory of an AlignerDataset or an aligner_train_cache.pt from before the feature store
+    """
+    if os.path.isdir(path_to_aligner_dataset):
+        return _LazyDatapoints(FeatureStore(os.path.join(path_to_aligner_dataset, ALIGNER_STORE)),
+                               lambda store, index: (store.get("text", index), store.get("speech", index), store.get_string("filepath", index)))
+    datapoints = torch.load(path_to_aligner_dataset, map_location='cpu')
+    return [(datapoint[0], datapoint[2], filepath) for datapoint, filepath in zip(datapoints[0], datapoints[3])]
+
+
+def _read_fastspeech_datapoints(path_to_fastspeech_dataset):
+    """
+    (text, text_len, spec, spec_len, duration, energy, pitch, embed, filepath) for every datapoint of either the cache directory
+    of a FastSpeechDataset or a fast_train_cache.pt from before the feature store
+    """
+    if os.path.isdir(path_to_fastspeech_dataset):
+        return _LazyDatapoints(open_fast_train_store(path_to_fastspeech_dataset),
+                               lambda store, index: tuple(store.get(column, index) for column in ["text", "text_len", "mel", "mel_len", "duration", "energy", "pitch", "prosodic_condition"]) + (store.get_string("filepath", index),))
+    return [datapoint[:9] for datapoint in torch.load(path_to_fastspeech_dataset, map_location='cpu')]
@@ -0,0 +1,59 @@
+"""
+Times the monotonic alignment search of the Aligner against the pure python
+version it replaced, on random alignments of the sizes that utterances of a
+few seconds produce. That both give identical results is checked by
+Tests/test_aligner.py.
+
+    python -m Utility.benchmark_alignment_search
+    python -m Utility.benchmark_alignment_search --seconds 5 10 20 --repetitions 20
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from Tests.test_aligner import binarize_alignment_in_python
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import binarize_alignment
+
+FRAMES_PER_SECOND = 16000 / 256  # spectrogram frames of the aligner
+PHONES_PER_SECOND = 12
+
+
+def benchmark(rng, seconds, repetitions):
+    binarize_alignment(rng.random((10, 5)).astype(np.float32))  # the first call compiles
+    for duration in seconds:
+        alignment = rng.random((int(duration * FRAMES_PER_SECOND), int(duration * PHONES_PER_SECOND))).astype(np.float32)
+        start_time = time.perf_counter()
+        binarize_alignment_in_python(alignment.copy())
+        python_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for _ in range(repetitions):
+            binarize_alignment(alignment.copy())
+        numba_time = (time.perf_counter() - start_time) / repetitions
+        print(f"{duration:>5}s ({alignment.shape[0]} frames x {alignment.shape[1]} phones): "
+              f"python {python_time * 1000:9.2f}ms   numba {numba_time * 1000:7.2f}ms   speedup {python_time / numba_time:7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='IMS Speech Synthesis Toolkit - Benchmark Monotonic Alignment Search')
+
+    parser.add_argument('--seconds',
+                        nargs="+",
+                        type=float,
+                        help="Durations of the utterances whose alignments are timed.",
+                        default=[5, 10, 20])
+
+    parser.add_argument('--repetitions',
+                        type=int,
+                        help="How often the numba version is timed per duration, the python version runs once.",
+                        default=20)
+
+    parser.add_argument('--seed',
+                        type=int,
+                        help="Seed of the random alignments.",
+                        default=0)
+
+    args = parser.parse_args()
+
+    benchmark(np.random.default_rng(args.seed), args.seconds, args.repetitions)
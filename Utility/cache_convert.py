@@ -0,0 +1,208 @@
+"""
+Converts the caches of a corpus between the pickled files from before the feature store
+(aligner_train_cache.pt and fast_train_cache.pt) and the feature store, in both directions,
+so existing caches can be used without recomputing alignments and features.
+
+Every conversion is verified by comparing the number of datapoints and a checksum over all of
+their elements, and the size on disk and the load time of both formats are reported.
+
+    python -m Utility.cache_convert to_store Corpora/LibriTTS
+    python -m Utility.cache_convert to_legacy Corpora/LibriTTS --overwrite
+"""
+
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import ALIGNER_CACHE_FORMAT_VERSION
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import ALIGNER_STORE
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import convert_aligner_cache_to_store
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import get_cache_format_version
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import migrate_cache
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import FAST_STORE
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import MANIFEST
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import load_language_embeddings
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import migrate_legacy_cache
+from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeechDataset import open_fast_train_store
+from Utility.FeatureStore import FeatureStore
+from Utility.FeatureStore import feature_store_exists
+
+ALIGNER_LEGACY = "aligner_train_cache.pt"
+FAST_LEGACY = "fast_train_cache.pt"
+# the order of the elements of a datapoint in the legacy files, which is also the order they are checksummed in
+ALIGNER_COLUMNS = ["text", "text_len", "speech", "speech_len", "tokens", "wave", "speaker_embedding", "filepath"]
+FAST_COLUMNS = ["text", "text_len", "mel", "mel_len", "duration", "energy", "pitch", "prosodic_condition", "filepath", "language_embedding"]
+
+
+def aligner_to_store(cache_dir, lang="en"):
+    cache, legacy_load_time = _timed(lambda: torch.load(os.path.join(cache_dir, ALIGNER_LEGACY), map_location='cpu'))
+    if get_cache_format_version(cache) < ALIGNER_CACHE_FORMAT_VERSION:
+        from Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
+        cache = migrate_cache(cache, tf=ArticulatoryCombinedTextFrontend(language=lang))
+    convert_aligner_cache_to_store(cache_dir, tf=None, cache=cache)
+    _verify(_legacy_aligner_datapoints(cache), _stored_datapoints(os.path.join(cache_dir, ALIGNER_STORE), ALIGNER_COLUMNS))
+    _report(os.path.join(cache_dir, ALIGNER_LEGACY), legacy_load_time, os.path.join(cache_dir, ALIGNER_STORE))
+
+
+def aligner_to_legacy(cache_dir):
+    store = FeatureStore(os.path.join(cache_dir, ALIGNER_STORE))
+    datapoints, norm_waves, speaker_embeddings, filepaths = list(), list(), list(), list()
+    for index in tqdm(range(len(store))):
+        datapoints.append([store.get(column, index) for column in ALIGNER_COLUMNS[:5]])
+        norm_waves.append(store.get("wave", index))
+        speaker_embeddings.append(store.get("speaker_embedding", index))
+        filepaths.append(store.get_string("filepath", index))
+    cache = (datapoints, norm_waves, speaker_embeddings, filepaths, ALIGNER_CACHE_FORMAT_VERSION)
+    _save_atomically(cache, os.path.join(cache_dir, ALIGNER_LEGACY))
+    cache, legacy_load_time = _timed(lambda: torch.load(os.path.join(cache_dir, ALIGNER_LEGACY), map_location='cpu'))
+    _verify(_stored_datapoints(os.path.join(cache_dir, ALIGNER_STORE), ALIGNER_COLUMNS), _legacy_aligner_datapoints(cache))
+    _report(os.path.join(cache_dir, ALIGNER_LEGACY), legacy_load_time, os.path.join(cache_dir, ALIGNER_STORE))
+
+
+def fast_to_store(cache_dir):
+    datapoints, legacy_load_time = _timed(lambda: torch.load(os.path.join(cache_dir, FAST_LEGACY), map_location='cpu'))
+    migrate_legacy_cache(cache_dir, keep_legacy_file=True)
+    open_fast_train_store(cache_dir)
+    _verify(datapoints, _stored_fast_datapoints(cache_dir))
+    _report(os.path.join(cache_dir, FAST_LEGACY), legacy_load_time, os.path.join(cache_dir, FAST_STORE))
+
+
+def fast_to_legacy(cache_dir):
+    open_fast_train_store(cache_dir)
+    # the legacy file contains the averaged language embeddings themselves instead of their indexes
+    datapoints = list(tqdm(_stored_fast_datapoints(cache_dir)))
+    _save_atomically(datapoints, os.path.join(cache_dir, FAST_LEGACY))
+    datapoints, legacy_load_time = _timed(lambda: torch.load(os.path.join(cache_dir, FAST_LEGACY), map_location='cpu'))
+    _verify(_stored_fast_datapoints(cache_dir), datapoints)
+    _report(os.path.join(cache_dir, FAST_LEGACY), legacy_load_time, os.path.join(cache_dir, FAST_STORE))
+
+
+def _legacy_aligner_datapoints(cache):
+    datapoints, norm_waves, speaker_embeddings, filepaths = cache[:4]
+    for datapoint, norm_wave, speaker_embedding, filepath in zip(datapoints, norm_waves, speaker_embeddings, filepaths):
+        yield list(datapoint[:5]) + [norm_wave, speaker_embedding, filepath]
+
+
+def _stored_datapoints(path_to_store, columns):
+    store = FeatureStore(path_to_store)
+    for index in range(len(store)):
+        yield _read_datapoint(store, index, columns)
+
+
+def _stored_fast_datapoints(cache_dir):
+    language_embeddings = load_language_embeddings(cache_dir)
+    for datapoint in _stored_datapoints(os.path.join(cache_dir, FAST_STORE), FAST_COLUMNS):
+        if language_embeddings is not None:
+            datapoint[9] = language_embeddings[datapoint[9]]
+        yield datapoint
+
+
+def _read_datapoint(store, index, columns):
+    return [store.get_string(column, index) if column in store.strings else store.get(column, index) for column in columns]
+
+
+def _checksum(datapoints):
+    """
+    the number of datapoints and a checksum over the values, dtypes and shapes of all of their elements
+    """
+    checksum = hashlib.sha256()
+    count = 0
+    for datapoint in tqdm(datapoints):
+        for element in datapoint:
+            if isinstance(element, str):
+                checksum.update(element.encode("utf8"))
+            else:
+                element = np.ascontiguousarray(element.numpy() if isinstance(element, torch.Tensor) else element)
+                checksum.update(f"{element.dtype.str}{element.shape}".encode("utf8"))
+                checksum.update(element.tobytes())
+        count += 1
+    return count, checksum.hexdigest()
+
+
+def _verify(source_datapoints, target_datapoints):
+    source_count, source_checksum = _checksum(source_datapoints)
+    target_count, target_checksum = _checksum(target_datapoints)
+    if source_count != target_count:
+        raise RuntimeError(f"The conversion lost datapoints: {source_count} before, {target_count} after.")
+    if source_checksum != target_checksum:
+        raise RuntimeError(f"The content of the converted cache differs from the original: checksum {source_checksum} before, {target_checksum} after.")
+    print(f"Verified {target_count} datapoints, checksum {target_checksum}.")
+
+
+def _report(path_to_legacy, legacy_load_time, path_to_store):
+    store, store_open_time = _timed(lambda: FeatureStore(path_to_store))
+    _, store_read_time = _timed(lambda: [store.get(column, index) for index in range(len(store)) for column in store.columns])
+    print(f"{os.path.basename(path_to_legacy)}: {_size_on_disk(path_to_legacy) / 1e6:.1f} MB, loading took {legacy_load_time:.2f}s")
+    print(f"{os.path.basename(path_to_store)}: {_size_on_disk(path_to_store) / 1e6:.1f} MB, opening took {store_open_time:.4f}s, reading every datapoint once took {store_read_time:.2f}s")
+
+
+def _timed(function):
+    start = time.time()
+    result = function()
+    return result, time.time() - start
+
+
+def _size_on_disk(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, file)) for directory, _, files in os.walk(path) for file in files)
+
+
+def _save_atomically(content, path):
+    torch.save(content, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='IMS Speech Synthesis Toolkit - Convert Caches')
+
+    parser.add_argument('direction',
+                        choices=["to_store", "to_legacy"],
+                        help="Whether the legacy .pt files should be converted into feature stores or the other way around.")
+
+    parser.add_argument('cache_dirs',
+                        nargs="+",
+                        help="Cache directories of the corpora to convert.")
+
+    parser.add_argument('--lang',
+                        type=str,
+                        help="Language of the text frontend that computes the phone IDs of aligner caches with format version 1.",
+                        default="en")
+
+    parser.add_argument('--overwrite',
+                        action="store_true",
+                        help="Replace caches that already exist in the target format.",
+                        default=False)
+
+    args = parser.parse_args()
+
+    for cache_dir in args.cache_dirs:
+        print(f"\n{cache_dir}")
+        if args.direction == "to_store":
+            if os.path.exists(os.path.join(cache_dir, ALIGNER_LEGACY)):
+                if feature_store_exists(os.path.join(cache_dir, ALIGNER_STORE)) and not args.overwrite:
+                    print(f"Skipping {ALIGNER_LEGACY}, there already is a feature store. Use --overwrite to replace it.")
+                else:
+                    aligner_to_store(cache_dir, lang=args.lang)
+            if os.path.exists(os.path.join(cache_dir, FAST_LEGACY)):
+                if os.path.exists(os.path.join(cache_dir, MANIFEST)) and not args.overwrite:
+                    print(f"Skipping {FAST_LEGACY}, there already is a sharded cache. Use --overwrite to replace it.")
+                else:
+                    fast_to_store(cache_dir)
+        else:
+            if feature_store_exists(os.path.join(cache_dir, ALIGNER_STORE)):
+                if os.path.exists(os.path.join(cache_dir, ALIGNER_LEGACY)) and not args.overwrite:
+                    print(f"Skipping {ALIGNER_STORE}, there already is an {ALIGNER_LEGACY}. Use --overwrite to replace it.")
+                else:
+                    aligner_to_legacy(cache_dir)
+            if os.path.exists(os.path.join(cache_dir, MANIFEST)):
+                if os.path.exists(os.path.join(cache_dir, FAST_LEGACY)) and not args.overwrite:
+                    print(f"Skipping the sharded cache, there already is a {FAST_LEGACY}. Use --overwrite to replace it.")
+                else:
+                    fast_to_legacy(cache_dir)
@@ -0,0 +1,35 @@
+"""
+The pretrained SpeechBrain encoders for speaker and language embeddings are
+needed in many places: the cache builders, the condition extractors, the
+progress plots of every epoch and the inference interfaces. Loading them from
+disk every time one of those is created takes seconds, so every encoder is
+loaded only once per process and device and then shared.
+"""
+
+import time
+
+from speechbrain.pretrained import EncoderClassifier
+
+ECAPA_SPEAKER_ENCODER = ("speechbrain/spkrec-ecapa-voxceleb", "Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
+XVECTOR_SPEAKER_ENCODER = ("speechbrain/spkrec-xvect-voxceleb", "Models/SpeakerEmbedding/speechbrain_speaker_embedding_xvector")
+
+_encoders = dict()
+load_times = dict()  # (source, device) -> seconds it took to load the encoder
+
+
+def get_speechbrain_encoder(source, savedir, device="cpu"):
+    """
+    Loads a SpeechBrain EncoderClassifier the first time it is requested for a device and returns the same object afterwards.
+
+    Args:
+        source: huggingface repository or local directory of the model
+        savedir: where the model files are stored locally
+        device: device the encoder runs on
+    """
+    key = (source, str(device))
+    if key not in _encoders:
+        start_time = time.time()
+        _encoders[key] = EncoderClassifier.from_hparams(source=source, run_opts={"device": str(device)}, savedir=savedir)
+        load_times[key] = time.time() - start_time
+        print(f"Loaded {source} on {device} in {load_times[key]:.2f}s")
+    return _encoders[key]
@@ -118,6 +118,31 @@ def make_non_pad_mask(lengths, xs=None, length_dim=-1, device=None):
     return ~make_pad_mask(lengths, xs, length_dim, device=device)
 
 
+def masked_group_norm(xs, norm, pad_masks):
+    """
+    Applies a torch.nn.GroupNorm to a padded batch, but takes the statistics of every sequence only from its own frames,
+    so the valid frames get the same result as if the sequence was normalized on its own.
+
+    Args:
+        xs (Tensor): Batch of padded sequences (B, C, Tmax).
+        norm (torch.nn.GroupNorm): The norm whose groups, eps and affine parameters are used.
+        pad_masks (Tensor): Mask tensor containing indices of padded part (B, Tmax).
+
+    Returns:
+        Tensor: Normalized batch (B, C, Tmax).
+    """
+    batch_size, channels, _ = xs.shape
+    valid = (~pad_masks).to(xs.dtype).view(batch_size, 1, 1, -1)
+    grouped = xs.view(batch_size, norm.num_groups, channels // norm.num_groups, -1)
+    count = valid.sum(dim=-1, keepdim=True) * grouped.size(2)
+    mean = (grouped * valid).sum(dim=(2, 3), keepdim=True) / count
+    variance = ((grouped - mean) ** 2 * valid).sum(dim=(2, 3), keepdim=True) / count
+    xs = ((grouped - mean) / torch.sqrt(variance + norm.eps)).view(batch_size, channels, -1)
+    if norm.affine:
+        xs = xs * norm.weight.view(1, -1, 1) + norm.bias.view(1, -1, 1)
+    return xs
+
+
 def initialize(model, init):
     """
     Initialize weights of a neural network module.
@@ -322,3 +347,62 @@ def to_device(m, x):
             "Expected torch.nn.Module or torch.tensor, " f"bot got: {type(m)}"
         )
     return x.to(device)
+
+
+def is_out_of_memory_error(error):
+    """
+    whether an exception comes from the CUDA or the CPU allocator running out of memory
+    """
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    return isinstance(error, RuntimeError) and ("out of memory" in str(error) or "can't allocate memory" in str(error))
+
+
+def backward_with_oom_backoff(batch, compute_loss, backward, zero_grad, split_batch, on_split=None, weight_of=None):
+    """
+    Computes the loss of a batch and its gradients. If that runs out of memory, the batch is split
+    in half and the halves are processed one after the other, accumulating their gradients, so one
+    optimizer step still sees the whole batch. The halves are split further if they are still too large.
+
+    The loss of every part is weighted by the share of the batch that went into it, i.e. by what the
+    loss is averaged over. By default that is the amount of utterances, which is exact for losses that
+    are averaged per utterance. A loss that is averaged over frames needs weight_of to count frames.
+    If a loss sums terms with different denominators (e.g. frames and phones), a single weight can only
+    be exact for one of them and the gradients of the others are an approximation of the whole batch.
+
+    Args:
+        batch: the collated batch, its first element needs to be a tensor with the batch as first dimension
+        compute_loss: takes a (part of a) batch and returns its loss
+        backward: takes a loss and computes the gradients from it, e.g. with a GradScaler
+        zero_grad: resets the gradients, because a failed attempt can leave partial gradients behind
+        split_batch: takes a (part of a) batch and returns its two halves
+        on_split: called with the amount of parts whenever the batch had to be split further
+        weight_of: takes a (part of a) batch and returns how much of what the loss is averaged over it contains, the amount of utterances if None
+
+    Returns:
+        the loss of the whole batch as a float
+    """
+    if weight_of is None:
+        weight_of = lambda part: part[0].size(0)
+    batch_weight = float(weight_of(batch))
+    parts = [batch]
+    while True:
+        try:
+            zero_grad()
+            total_loss = 0.0
+            for part in parts:
+                loss = compute_loss(part) * (float(weight_of(part)) / batch_weight)  # the parts are weighted, so the gradients match those of the whole batch
+                backward(loss)
+                total_loss += loss.item()
+                del loss
+            return total_loss
+        except RuntimeError as error:
+            if not is_out_of_memory_error(error) or max(part[0].size(0) for part in parts) == 1:
+                raise
+        # the memory of the failed attempt is only freed once we are out of the except block
+        zero_grad()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        parts = [half for part in parts for half in (split_batch(part) if part[0].size(0) > 1 else (part,))]
+        if on_split is not None:
+            on_split(len(parts))
@@ -62,16 +62,8 @@ class UtteranceCloner:
         if on_line_fine_tune:
             # we fine-tune the aligner for a couple steps using SGD. This makes cloning pretty slow, but the results are greatly improved.
             steps = 10
-            tokens = list()  # we need an ID sequence for training rather than a sequence of phonological features
-            for vector in text:
-                if vector[19] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                    for phone in tf.phone_to_vector:
-                        if vector.numpy().tolist()[11:] == tf.phone_to_vector[phone][11:]:
-                            # the first 10 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                            tokens.append(tf.phone_to_id[phone])
-                            # this is terribly inefficient, but it's fine
-                            break
-            tokens = torch.LongTensor(tokens).squeeze().to(self.device)
+            # we need an ID sequence for training rather than a sequence of phonological features
+            tokens = tf.text_vectors_to_id_sequence(text).squeeze().to(self.device)
             tokens_len = torch.LongTensor([len(tokens)]).to(self.device)
             mel = melspec.unsqueeze(0).to(self.device)
             mel.requires_grad = True